@@ -2,13 +2,30 @@
 from flask import (
     Flask,
     request,
-    abort,
-    jsonify
+    abort
 )
 from flask_cors import CORS
 from flask_migrate import Migrate
-from capstone.models import setup_db, db, Actor, Movie, actor_movie
-from capstone.auth import AuthError, requires_auth
+from capstone.json_backend import json_responses, jsonify
+from capstone.models import setup_db, db, Actor, Movie, actor_movie, get_versions
+from capstone.auth import AuthError, requires_auth, jwks_cache
+from capstone.pagination import paginate, get_sort, sort_keys, get_page_args
+from capstone.streaming import wants_stream, stream_response
+from capstone.include import get_include, include_options
+from capstone.fields import get_fields, fields_options
+from capstone.fastpath import fast_path_enabled, page_response, related_response
+from capstone.bulk import get_bulk_items, parse_items, bulk_insert
+from capstone.links import get_link_ids, link, unlink
+from capstone.search import get_search_args, search
+from capstone.costars import movie_ids, costars
+from capstone.graph import cast_graph
+from capstone.etag import conditional
+from capstone.cache import response_cache, cached, cache_tags, tag_rows, invalidate
+from capstone.cache_backends import create_backend
+from capstone.compression import compression, compress_response
+from capstone.singleflight import single_flight
+from capstone.pool import pool_stats
+from capstone.replicas import replica_pool
 
 migrate = Migrate()
 
@@ -17,6 +34,16 @@ def create_app(test_config=None):
     app = Flask(__name__)
     setup_db(app)
     migrate.init_app(app, db)
+    # every response body is encoded by the JSON backend (see capstone/json_backend.py)
+    json_responses.init_app(app)
+    # the response cache and the JWKS cache share the backend,
+    # with the mmap or redis backend it is shared by all the workers
+    cache_backend = create_backend(app.config)
+    response_cache.init_app(app, cache_backend)
+    jwks_cache.shared = cache_backend
+    compression.init_app(app, cache_backend)
+    single_flight.init_app(app)
+    replica_pool.init_app(app, db, cache_backend)
     CORS(app)
 
     # https://developer.mozilla.org/en-US/docs/Glossary/Preflight_request
@@ -26,8 +53,9 @@ def create_app(test_config=None):
     def after_request(response):
         response.headers.add('Access-Control-Allow-Headers', 'Content-Type')
         response.headers.add('Access-Control-Allow-Methods',
-                             'GET,POST,DELETE,PATCH,OPTIONS')
-        return response
+                             'GET,POST,PUT,DELETE,PATCH,OPTIONS')
+        # large JSON bodies are compressed (see capstone/compression.py)
+        return compress_response(response, request.headers.get('Accept-Encoding'))
 
     '''
         Error handlers for all expected errors
@@ -72,6 +100,20 @@ def create_app(test_config=None):
             "message": "Internal Server Error"
         }), 500
 
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        response = jsonify({
+            "success": False,
+            "error": 503,
+            "message": "Service Unavailable"
+        })
+        response.status_code = 503
+        # the Retry-After header of abort(503, retry_after=...)
+        for name, value in error.get_headers():
+            if name == 'Retry-After':
+                response.headers[name] = value
+        return response
+
     @app.errorhandler(AuthError)
     def handle_auth_error(ex):
         response = jsonify(ex.error)
@@ -81,48 +123,135 @@ def create_app(test_config=None):
     @app.route('/')
     def greeting():
         return jsonify({'message': 'Welcome to Capstone app'})
+
+    '''
+        Create an endpoint to handle GET requests for the counters of the response cache,
+        of the coalescing of identical requests, of the compression, of the database connection pool
+        and of the read replicas.
+    '''
+
+    @app.route('/stats')
+    @requires_auth('get:stats')
+    def get_stats():
+        return jsonify({
+            "success": True,
+            "cache": response_cache.stats(),
+            "coalescing": single_flight.stats(),
+            "compression": compression.stats(),
+            "database": pool_stats.stats(db.engine.pool),
+            "graph": cast_graph.stats(),
+            "replicas": replica_pool.stats()
+        })
+
+    '''
+        Create an endpoint to search actors by name and movies by title.
+        Both lists are paged together with `limit` and `cursor`.
+    '''
+
+    @app.route('/search')
+    @requires_auth('get:actors', 'get:movies')
+    @conditional('Actor', 'Movie')
+    @cached
+    def search_all():
+        q, limit, offset = get_search_args()
+        fields = get_fields(Actor, Movie)
+        actors, actors_cursor = search(Actor.query.options(*fields_options(Actor, fields)),
+                                       Actor, q, limit, offset)
+        movies, movies_cursor = search(Movie.query.options(*fields_options(Movie, fields)),
+                                       Movie, q, limit, offset)
+        cache_tags('actors:search', 'movies:search')
+        tag_rows(actors)
+        tag_rows(movies)
+        return jsonify({
+            "success": True,
+            "actors": [actor.format(fields=fields) for actor in actors],
+            "movies": [movie.format(fields=fields) for movie in movies],
+            "next_cursor": actors_cursor or movies_cursor
+        })
     '''
     endpoints for Actors
     '''
 
     '''
         Create an endpoint to handle GET requests for all available actors.
+        Actors are returned by pages of `limit` actors ordered by id
+        (by number of movies with `?sort=movie_count` or `?sort=-movie_count`),
+        the next page is requested with `cursor`=next_cursor.
+        All actors are streamed with `Accept: application/x-ndjson` or `?stream=1`.
+        Their movies are embedded with `?include=movies`.
+        Only the columns of `?fields=` are returned (see capstone/fields.py).
+        Pages without include are served by the fast read path (see capstone/fastpath.py).
+        With `?q=` only the actors whose name match q are returned, best match first.
     '''
 
     @app.route('/actors')
     @requires_auth('get:actors')
+    @conditional('Actor', include=('actor_movie', 'Movie'))
+    @cached
     def get_actors():
-        actors = Actor.query.all()
-        actors_list = [actor.format() for actor in actors]
+        include = get_include('movies')
+        fields = get_fields(Actor)
+        sort = get_sort(Actor)
+        query = Actor.query.options(*include_options(Actor, include),
+                                    *fields_options(Actor, fields, *sort_keys(sort)))
+        if 'q' in request.args:
+            actors, next_cursor = search(query, Actor, *get_search_args())
+            cache_tags('actors:search')
+        elif wants_stream():
+            return stream_response(query, Actor.id, 'actors', include, fields, sort)
+        elif not include and fast_path_enabled():
+            return page_response(Actor, 'actors', fields, sort)
+        else:
+            actors, next_cursor = paginate(query, Actor.id, sort)
+            cache_tags('actors')
+            if sort is not None:
+                cache_tags('actors:by_count')
+        tag_rows(actors, include)
+        actors_list = [actor.format(include, fields) for actor in actors]
         return jsonify({
             "success": True,
-            "actors": actors_list
+            "actors": actors_list,
+            "next_cursor": next_cursor
         })
 
     '''
         Create an endpoint to handle GET requests for the actor
+        Movies of the actor are embedded with `?include=movies`.
     '''
 
     @app.route('/actors/<int:actor_id>')
     @requires_auth('get:actors-detail')
+    @conditional('Actor', include=('actor_movie', 'Movie'))
+    @cached
     def get_actor(actor_id):
-        # print(actor_id)
-        actor = Actor.query.get(actor_id)
+        include = get_include('movies')
+        fields = get_fields(Actor)
+        actor = Actor.query.options(*include_options(Actor, include), *fields_options(Actor, fields)).get(actor_id)
         if actor is None:
             abort(404)
         else:
+            tag_rows([actor], include)
             return jsonify({
                 "success": True,
-                "actor": actor.format()
+                "actor": actor.format(include, fields)
             })
 
     '''
         Create an endpoint to handle GET requests for all movies of the actor
+        (served by the fast read path, see capstone/fastpath.py)
     '''
 
     @app.route('/actors/<int:actor_id>/movies')
     @requires_auth('get:actors-movies')
+    @conditional('Actor', 'actor_movie', 'Movie')
+    @cached
     def get_actor_movies(actor_id):
+        fields = get_fields(Movie)
+        if fast_path_enabled():
+            response = related_response(Actor, actor_id, Movie, fields)
+            if response is None:
+                abort(404)
+            return response
         actor = Actor.query.get(actor_id)
         if actor is None:
             abort(404)
@@ -132,43 +261,148 @@ def create_app(test_config=None):
             # https://stackoverflow.com/questions/48206047/how-to-return-all-the-columns-with-flask-sqlalchemy-query-join-from-two-tables
 
             # get all movies for actor:
-            movies = Movie.query.join(actor_movie).join(Actor) \
+            movies = Movie.query.options(*fields_options(Movie, fields)).join(actor_movie).join(Actor) \
                 .filter(actor_movie.c.movie_id == Movie.id and actor_movie.c.actor_id == Actor.id) \
                 .filter(Actor.id == actor_id) \
                 .all()
+            cache_tags(f'actor:{actor_id}', f'actor:{actor_id}:movies')
+            tag_rows(movies)
             return jsonify({
                 "success": True,
                 "actor_id": actor_id,
-                "totalMovies": len(movies),
-                "movies": [movie.format() for movie in movies]
+                "totalMovies": actor.movie_count,
+                "movies": [movie.format(fields=fields) for movie in movies]
             })
 
     '''
-        Create an endpoint to handle POST requests to connect the actor and the movie
+        Create an endpoint to handle GET requests for the co-stars of an actor,
+        the actors who played in a movie of the actor, with the number of shared movies,
+        most shared movies first, page by page (see capstone/costars.py)
     '''
 
-    @app.route('/actors/<int:actor_id>/movies/<int:movie_id>', methods=['POST'])
-    @requires_auth('post:actors-movie')
-    def add_movie_to_actor(actor_id, movie_id):
-        actor = Actor.query.get(actor_id)
-        movie = Movie.query.get(movie_id)
-        if actor is None or movie is None:
+    @app.route('/actors/<int:actor_id>/costars')
+    @requires_auth('get:actors-movies')
+    @conditional('Actor', 'actor_movie')
+    @cached
+    def get_actor_costars(actor_id):
+        fields = get_fields(Actor)
+        movies = movie_ids(actor_id)
+        if not movies and not Actor.exists(actor_id):
             abort(404)
-        else:
-            # https://docs.sqlalchemy.org/en/14/orm/basic_relationships.html#many-to-many
-            actor.movies.append(movie)
-            try:
-                actor.update()
+        limit, after = get_page_args()
+        rows, next_cursor = [], None
+        if movies:
+            rows, next_cursor = costars(Actor.query.options(*fields_options(Actor, fields)),
+                                        actor_id, limit, after)
+        # a new link to one of the movies adds a co-star
+        cache_tags(f'actor:{actor_id}:movies', *[f'movie:{movie_id}:actors' for movie_id in movies])
+        tag_rows([actor for actor, _ in rows])
+        return jsonify({
+            "success": True,
+            "actor_id": actor_id,
+            "costars": [dict(actor.format(fields=fields), shared_movies=shared_movies)
+                        for actor, shared_movies in rows],
+            "next_cursor": next_cursor
+        })
+
+    '''
+        Create an endpoint to handle GET requests for the shortest chain of co-stars
+        from an actor to another one (degrees of separation), searched in the graph
+        of the cast kept in the process (see capstone/graph.py)
+        the response isn't cached, any link can change it (the ETag is checked)
+    '''
+
+    @app.route('/actors/<int:actor_id>/path/<int:other_id>')
+    @requires_auth('get:actors-movies')
+    @conditional('Actor', 'actor_movie', 'Movie')
+    def get_actors_path(actor_id, other_id):
+        if Actor.query.filter(Actor.id.in_({actor_id, other_id})).count() < len({actor_id, other_id}):
+            abort(404)
+        # an actor or movie of the chain may be deleted before it is read, the chain is searched again
+        for _ in range(2):
+            cast_graph.refresh(get_versions([actor_movie.name])[0])
+            ids = cast_graph.shortest_path(actor_id, other_id)
+            if ids is None:
                 return jsonify({
                     "success": True,
-                    "actor_id": actor_id,
-                    "movie_id": movie_id
+                    "from": actor_id,
+                    "to": other_id,
+                    "degrees": None,
+                    "path": []
                 })
-            except:
-                db.session.rollback()
-                abort(422)
-            finally:
-                db.session.close()
+            actors = {actor.id: actor for actor in Actor.query.filter(Actor.id.in_(ids[::2]))}
+            movies = {movie.id: movie for movie in Movie.query.filter(Movie.id.in_(ids[1::2]))}
+            if len(actors) + len(movies) == len(set(ids[::2])) + len(set(ids[1::2])):
+                return jsonify({
+                    "success": True,
+                    "from": actor_id,
+                    "to": other_id,
+                    "degrees": len(ids) // 2,
+                    "path": [{"movie": movies[row_id].format()} if index % 2 else {"actor": actors[row_id].format()}
+                             for index, row_id in enumerate(ids)]
+                })
+        # the links keep changing under the search, the client can try again
+        abort(503, retry_after=1)
+
+    '''
+        Create an endpoint to handle POST requests to connect the actor and the movie
+    '''
+
+    @app.route('/actors/<int:actor_id>/movies/<int:movie_id>', methods=['POST'])
+    @requires_auth('post:actors-movie')
+    def add_movie_to_actor(actor_id, movie_id):
+        link([(actor_id, movie_id)])
+        return jsonify({
+            "success": True,
+            "actor_id": actor_id,
+            "movie_id": movie_id
+        })
+
+    '''
+        Create an endpoint to handle DELETE requests to disconnect the actor and the movie
+    '''
+
+    @app.route('/actors/<int:actor_id>/movies/<int:movie_id>', methods=['DELETE'])
+    @requires_auth('post:actors-movie')
+    def remove_movie_from_actor(actor_id, movie_id):
+        unlink([(actor_id, movie_id)])
+        return jsonify({
+            "success": True,
+            "actor_id": actor_id,
+            "movie_id": movie_id
+        })
+
+    '''
+        Create an endpoint to handle PUT requests to connect the actor and many movies
+        Body: {"movies": [movie ids]}
+    '''
+
+    @app.route('/actors/<int:actor_id>/movies', methods=['PUT'])
+    @requires_auth('post:actors-movie')
+    def add_movies_to_actor(actor_id):
+        movie_ids = get_link_ids('movies')
+        linked = link([(actor_id, movie_id) for movie_id in movie_ids])
+        return jsonify({
+            "success": True,
+            "actor_id": actor_id,
+            "linked": linked
+        })
+
+    '''
+        Create an endpoint to handle DELETE requests to disconnect the actor and many movies
+        Body: {"movies": [movie ids]}
+    '''
+
+    @app.route('/actors/<int:actor_id>/movies', methods=['DELETE'])
+    @requires_auth('post:actors-movie')
+    def remove_movies_from_actor(actor_id):
+        movie_ids = get_link_ids('movies')
+        unlinked = unlink([(actor_id, movie_id) for movie_id in movie_ids])
+        return jsonify({
+            "success": True,
+            "actor_id": actor_id,
+            "unlinked": unlinked
+        })
 
     '''
         Create an endpoint to POST a new actor 
@@ -190,6 +424,7 @@ def create_app(test_config=None):
             values = [content[c] if c in content else None for c in columns]
             new_actor = Actor(*values)
             new_actor.insert()
+            invalidate('actors', 'actors:search')
             return jsonify({
                 "success": True,
                 "added": new_actor.id
@@ -200,6 +435,32 @@ def create_app(test_config=None):
         finally:
             db.session.close()
 
+    '''
+        Create an endpoint to POST many new actors at once.
+        Body: JSON array (or NDJSON) of actor objects,
+        the valid ones are added, the invalid ones are returned in errors.
+    '''
+
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth('post:actors')
+    def create_actors_bulk():
+        items = get_bulk_items()
+        rows, indexes, errors = parse_items(items, Actor.parse)
+        try:
+            ids = bulk_insert(Actor, rows)
+            db.session.commit()
+            invalidate('actors', 'actors:search')
+            return jsonify({
+                "success": True,
+                "added": [{"index": index, "id": new_id} for index, new_id in zip(indexes, ids)],
+                "errors": errors
+            })
+        except:
+            db.session.rollback()
+            abort(422)
+        finally:
+            db.session.close()
+
     '''
         Create an endpoint to DELETE actor using an actor ID.   
     '''
@@ -207,22 +468,24 @@ def create_app(test_config=None):
     @app.route('/actors/<int:actor_id>', methods=['DELETE'])
     @requires_auth('delete:actors')
     def delete_actor(actor_id):
-        actor = Actor.query.get(actor_id)
-        if actor is None:
+        try:
+            # the actor isn't loaded, it is deleted with its links and the counts
+            # of its movies are decremented in one statement (after locking its row)
+            linked_ids = Actor.delete_by_id(actor_id)
+        except:
+            db.session.rollback()
+            abort(422)
+        finally:
+            db.session.close()
+        if linked_ids is None:
             abort(404)
-        else:
-            try:
-                # db.session.query(actor_movie).filter_by(actor_id=actor_id).delete()
-                actor.delete()
-                return jsonify({
-                    "success": True,
-                    "deleted": actor_id
-                })
-            except:
-                db.session.rollback()
-                abort(422)
-            finally:
-                db.session.close()
+        invalidate(f'actor:{actor_id}', f'actor:{actor_id}:movies',
+                   'actors', 'actors:search', 'movies:by_count',
+                   *[f'movie:{linked_id}' for linked_id in linked_ids])
+        return jsonify({
+            "success": True,
+            "deleted": actor_id
+        })
 
     '''
         Create an endpoint to PATCH actor using an actor ID and actor's parameters that need to be changed.   
@@ -231,80 +494,127 @@ def create_app(test_config=None):
     @app.route('/actors/<int:actor_id>', methods=['PATCH'])
     @requires_auth('patch:actors')
     def update_actor(actor_id):
-        actor = Actor.query.get(actor_id)
-        if actor is None:
+        try:
+            # only the columns of Actor.PATCH_COLUMNS, with valid values
+            values = Actor.parse_patch(request.get_json())
+        except ValueError:
+            # an unknown actor is reported before an invalid patch
+            abort(422 if Actor.exists(actor_id) else 404)
+        try:
+            # a single UPDATE, the actor isn't loaded
+            updated = Actor.update_by_id(actor_id, values)
+        except:
+            db.session.rollback()
+            abort(422)
+        finally:
+            db.session.close()
+        if not updated:
             abort(404)
-        else:
-            try:
-                # https://stackoverflow.com/questions/2612610/how-to-access-object-attribute-given-string-corresponding-to-name-of-that-attrib
-                content = request.get_json()
-                for c in content:
-                    setattr(actor, c, content[c])
-                actor.insert()
-                return jsonify({
-                    "success": True,
-                    "updated": actor_id
-                })
-            except:
-                db.session.rollback()
-                abort(422)
-            finally:
-                db.session.close()
+        invalidate(f'actor:{actor_id}', 'actors:search')
+        return jsonify({
+            "success": True,
+            "updated": actor_id
+        })
 
     '''
     Endpoints for Movies
     '''
     '''
         Create an endpoint to handle GET requests for all available movies.
+        Movies are returned by pages of `limit` movies ordered by id
+        (by number of actors with `?sort=actor_count` or `?sort=-actor_count`),
+        the next page is requested with `cursor`=next_cursor.
+        All movies are streamed with `Accept: application/x-ndjson` or `?stream=1`.
+        Their actors are embedded with `?include=actors`.
+        Only the columns of `?fields=` are returned (see capstone/fields.py).
+        Pages without include are served by the fast read path (see capstone/fastpath.py).
+        With `?q=` only the movies whose title match q are returned, best match first.
     '''
 
     @app.route('/movies')
     @requires_auth('get:movies')
+    @conditional('Movie', include=('actor_movie', 'Actor'))
+    @cached
     def get_movies():
-        movies = Movie.query.all()
-        movies_list = [movie.format() for movie in movies]
+        include = get_include('actors')
+        fields = get_fields(Movie)
+        sort = get_sort(Movie)
+        query = Movie.query.options(*include_options(Movie, include),
+                                    *fields_options(Movie, fields, *sort_keys(sort)))
+        if 'q' in request.args:
+            movies, next_cursor = search(query, Movie, *get_search_args())
+            cache_tags('movies:search')
+        elif wants_stream():
+            return stream_response(query, Movie.id, 'movies', include, fields, sort)
+        elif not include and fast_path_enabled():
+            return page_response(Movie, 'movies', fields, sort)
+        else:
+            movies, next_cursor = paginate(query, Movie.id, sort)
+            cache_tags('movies')
+            if sort is not None:
+                cache_tags('movies:by_count')
+        tag_rows(movies, include)
+        movies_list = [movie.format(include, fields) for movie in movies]
         return jsonify({
             "success": True,
-            "movies": movies_list
+            "movies": movies_list,
+            "next_cursor": next_cursor
         })
 
     '''
         Create an endpoint to handle GET requests for the movie.
+        Actors of the movie are embedded with `?include=actors`.
     '''
 
     @app.route('/movies/<int:movie_id>')
     @requires_auth('get:movies-detail')
+    @conditional('Movie', include=('actor_movie', 'Actor'))
+    @cached
     def get_movie(movie_id):
-        movie = Movie.query.get(movie_id)
+        include = get_include('actors')
+        fields = get_fields(Movie)
+        movie = Movie.query.options(*include_options(Movie, include), *fields_options(Movie, fields)).get(movie_id)
         if movie is None:
             abort(404)
         else:
+            tag_rows([movie], include)
             return jsonify({
                 "success": True,
-                "movie": movie.format()
+                "movie": movie.format(include, fields)
             })
 
     '''
-        Create an endpoint to handle GET requests for all actors in the movie.
+        Create an endpoint to handle GET requests for all actors in the movie
+        (served by the fast read path, see capstone/fastpath.py)
     '''
 
     @app.route('/movies/<int:movie_id>/actors')
     @requires_auth('get:movies-actors')
+    @conditional('Movie', 'actor_movie', 'Actor')
+    @cached
     def get_movie_actors(movie_id):
+        fields = get_fields(Actor)
+        if fast_path_enabled():
+            response = related_response(Movie, movie_id, Actor, fields)
+            if response is None:
+                abort(404)
+            return response
         movie = Movie.query.get(movie_id)
         if movie is None:
             abort(404)
         else:
             # get all actors for movie:
-            actors = Actor.query.join(actor_movie).join(Movie) \
+            actors = Actor.query.options(*fields_options(Actor, fields)).join(actor_movie).join(Movie) \
                 .filter(actor_movie.c.actor_id == Actor.id and actor_movie.c.movie_id == Movie.id) \
                 .filter(Movie.id == movie_id) \
                 .all()
+            cache_tags(f'movie:{movie_id}', f'movie:{movie_id}:actors')
+            tag_rows(actors)
             return jsonify({
                 "success": True,
                 "movie_id": movie_id,
-                "totalActors": len(actors),
-                "actors": [actor.format() for actor in actors]
+                "totalActors": movie.actor_count,
+                "actors": [actor.format(fields=fields) for actor in actors]
             })
 
     '''
@@ -314,25 +624,58 @@ def create_app(test_config=None):
     @app.route('/movies/<int:movie_id>/actors/<int:actor_id>', methods=['POST'])
     @requires_auth('post:movies-actor')
     def add_actor_to_movie(actor_id, movie_id):
-        actor = Actor.query.get(actor_id)
-        movie = Movie.query.get(movie_id)
-        if actor is None or movie is None:
-            abort(404)
-        else:
-            # https://docs.sqlalchemy.org/en/14/orm/basic_relationships.html#many-to-many
-            movie.actors.append(actor)
-            try:
-                movie.update()
-                return jsonify({
-                    "success": True,
-                    "actor_id": actor_id,
-                    "movie_id": movie_id
-                })
-            except:
-                db.session.rollback()
-                abort(422)
-            finally:
-                db.session.close()
+        link([(actor_id, movie_id)])
+        return jsonify({
+            "success": True,
+            "actor_id": actor_id,
+            "movie_id": movie_id
+        })
+
+    '''
+        Create an endpoint to handle DELETE requests to disconnect the actor and the movie
+    '''
+
+    @app.route('/movies/<int:movie_id>/actors/<int:actor_id>', methods=['DELETE'])
+    @requires_auth('post:movies-actor')
+    def remove_actor_from_movie(actor_id, movie_id):
+        unlink([(actor_id, movie_id)])
+        return jsonify({
+            "success": True,
+            "actor_id": actor_id,
+            "movie_id": movie_id
+        })
+
+    '''
+        Create an endpoint to handle PUT requests to connect the movie and many actors
+        Body: {"actors": [actor ids]}
+    '''
+
+    @app.route('/movies/<int:movie_id>/actors', methods=['PUT'])
+    @requires_auth('post:movies-actor')
+    def add_actors_to_movie(movie_id):
+        actor_ids = get_link_ids('actors')
+        linked = link([(actor_id, movie_id) for actor_id in actor_ids])
+        return jsonify({
+            "success": True,
+            "movie_id": movie_id,
+            "linked": linked
+        })
+
+    '''
+        Create an endpoint to handle DELETE requests to disconnect the movie and many actors
+        Body: {"actors": [actor ids]}
+    '''
+
+    @app.route('/movies/<int:movie_id>/actors', methods=['DELETE'])
+    @requires_auth('post:movies-actor')
+    def remove_actors_from_movie(movie_id):
+        actor_ids = get_link_ids('actors')
+        unlinked = unlink([(actor_id, movie_id) for actor_id in actor_ids])
+        return jsonify({
+            "success": True,
+            "movie_id": movie_id,
+            "unlinked": unlinked
+        })
 
     '''
         Create an endpoint to POST a new movie   
@@ -355,6 +698,7 @@ def create_app(test_config=None):
 
             new_movie = Movie(*values)
             new_movie.insert()
+            invalidate('movies', 'movies:search')
             return jsonify({
                 "success": True,
                 "added": new_movie.id
@@ -365,6 +709,32 @@ def create_app(test_config=None):
         finally:
             db.session.close()
 
+    '''
+        Create an endpoint to POST many new movies at once.
+        Body: JSON array (or NDJSON) of movie objects,
+        the valid ones are added, the invalid ones are returned in errors.
+    '''
+
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth('post:movies')
+    def create_movies_bulk():
+        items = get_bulk_items()
+        rows, indexes, errors = parse_items(items, Movie.parse)
+        try:
+            ids = bulk_insert(Movie, rows)
+            db.session.commit()
+            invalidate('movies', 'movies:search')
+            return jsonify({
+                "success": True,
+                "added": [{"index": index, "id": new_id} for index, new_id in zip(indexes, ids)],
+                "errors": errors
+            })
+        except:
+            db.session.rollback()
+            abort(422)
+        finally:
+            db.session.close()
+
     '''
         Create an endpoint to DELETE movie using a movie ID.   
     '''
@@ -372,22 +742,24 @@ def create_app(test_config=None):
     @app.route('/movies/<int:movie_id>', methods=['DELETE'])
     @requires_auth('delete:movies')
     def delete_movie(movie_id):
-        movie = Movie.query.get(movie_id)
-        if movie is None:
+        try:
+            # the movie isn't loaded, it is deleted with its links and the counts
+            # of its actors are decremented in one statement (after locking its row)
+            linked_ids = Movie.delete_by_id(movie_id)
+        except:
+            db.session.rollback()
+            abort(422)
+        finally:
+            db.session.close()
+        if linked_ids is None:
             abort(404)
-        else:
-            try:
-                # db.session.query(actor_movie).filter_by(movie_id=movie_id).delete()
-                movie.delete()
-                return jsonify({
-                    "success": True,
-                    "deleted": movie_id
-                })
-            except:
-                db.session.rollback()
-                abort(422)
-            finally:
-                db.session.close()
+        invalidate(f'movie:{movie_id}', f'movie:{movie_id}:actors',
+                   'movies', 'movies:search', 'actors:by_count',
+                   *[f'actor:{linked_id}' for linked_id in linked_ids])
+        return jsonify({
+            "success": True,
+            "deleted": movie_id
+        })
 
     '''
         Create an endpoint to PATCH movie using a movie ID and movie's parameters that need to be changed.   
@@ -396,25 +768,27 @@ def create_app(test_config=None):
     @app.route('/movies/<int:movie_id>', methods=['PATCH'])
     @requires_auth('patch:movies')
     def update_movie(movie_id):
-        movie = Movie.query.get(movie_id)
-        if movie is None:
+        try:
+            # only the columns of Movie.PATCH_COLUMNS, with valid values
+            values = Movie.parse_patch(request.get_json())
+        except ValueError:
+            # an unknown movie is reported before an invalid patch
+            abort(422 if Movie.exists(movie_id) else 404)
+        try:
+            # a single UPDATE, the movie isn't loaded
+            updated = Movie.update_by_id(movie_id, values)
+        except:
+            db.session.rollback()
+            abort(422)
+        finally:
+            db.session.close()
+        if not updated:
             abort(404)
-        else:
-            try:
-                # https://stackoverflow.com/questions/2612610/how-to-access-object-attribute-given-string-corresponding-to-name-of-that-attrib
-                content = request.get_json()
-                for c in content:
-                    setattr(movie, c, content[c])
-                movie.insert()
-                return jsonify({
-                    "success": True,
-                    "updated": movie_id
-                })
-            except:
-                db.session.rollback()
-                abort(422)
-            finally:
-                db.session.close()
+        invalidate(f'movie:{movie_id}', 'movies:search')
+        return jsonify({
+            "success": True,
+            "updated": movie_id
+        })
 
     return app
 
@@ -0,0 +1,347 @@
+import asyncio
+from functools import wraps
+from sqlalchemy import select
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from starlette.applications import Starlette
+from starlette.responses import Response
+from starlette.routing import Route, Mount
+from starlette.datastructures import MutableHeaders
+from starlette.middleware import Middleware
+from starlette.middleware.wsgi import WSGIMiddleware
+from werkzeug.exceptions import HTTPException, NotFound
+from werkzeug.http import parse_etags, quote_etag
+from capstone.auth import (
+    AuthError, parse_auth_header, get_token_kid, decode_jwt, check_permissions,
+    claims_cache, jwks_cache
+)
+from capstone.models import Actor, Movie, actor_movie, table_version
+from capstone.pagination import parse_page_args, parse_sort, sort_keys, keyset_order, keyset_cursor
+from capstone.include import parse_include, include_options
+from capstone.fields import parse_fields, fields_options
+from capstone.etag import etag_of, matching_etag
+from capstone.compression import compression
+from capstone.json_backend import json_responses
+from capstone.pool import async_engine_options, async_database_url, instrument_engine
+
+'''
+Asynchronous (ASGI) serving mode
+create_asgi_app() serves the API on an event loop, i.e.
+    uvicorn capstone.asgi:app --workers 4
+The read endpoints (GET /, /actors, /movies, /actors/<id>, /movies/<id>,
+/actors/<id>/movies and /movies/<id>/actors) run on the loop with asyncpg,
+so a worker keeps many requests in flight while they wait for the database.
+The signing keys are fetched in a thread, the loop doesn't wait for the identity provider.
+The responses are the same as the Flask app's (body, ETag and error codes).
+Every other request (writes, ?q= search, streaming) is forwarded to the
+Flask app (create_app), which runs in a pool of threads.
+The response cache, request coalescing and read replicas are only used by the Flask app.
+'''
+
+ERROR_MESSAGES = {
+    400: "bed request",
+    404: "resource not found",
+    405: "method not allowed",
+    422: "unprocessable",
+    500: "Internal Server Error"
+}
+
+
+'''
+json_response(data, status_code)
+    the same body as the Flask app's jsonify (see capstone/json_backend.py)
+'''
+def json_response(data, status_code=200):
+    body = json_responses.dumps(data)
+    return Response(body, status_code, media_type='application/json')
+
+
+def full_path(request):
+    # request.full_path of Flask
+    return request.scope['path'] + '?' + request.scope['query_string'].decode('utf-8', 'replace')
+
+
+'''
+Forward
+    a response that hands the request over to the Flask app
+'''
+class Forward:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        await self.app(scope, receive, send)
+
+
+def forwarded(request):
+    return 'q' in request.query_params or 'stream' in request.query_params or \
+        'ndjson' in request.headers.get('Accept', '')
+
+
+'''
+CORSHeaders
+    adds the headers of CORS(app) and after_request of the Flask app
+    to the responses of the ASGI endpoints
+'''
+class CORSHeaders:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        origin = any(name == b'origin' for name, _ in scope['headers'])
+
+        async def send_with_headers(message):
+            if message['type'] == 'http.response.start':
+                headers = MutableHeaders(scope=message)
+                if origin:
+                    headers.setdefault('Access-Control-Allow-Origin', '*')
+                headers.setdefault('Access-Control-Allow-Headers', 'Content-Type')
+                headers.setdefault('Access-Control-Allow-Methods', 'GET,POST,PUT,DELETE,PATCH,OPTIONS')
+            await send(message)
+        await self.app(scope, receive, send_with_headers)
+
+
+'''
+authenticate(request, permission)
+    requires_auth of the ASGI app, returns the payload of the token
+'''
+async def authenticate(request, permission):
+    token = parse_auth_header(request.headers.get('Authorization'))
+    payload = claims_cache.get(token)
+    if payload is None:
+        kid = get_token_kid(token)
+        if jwks_cache.has_kid(kid):
+            # a stale key set is refreshed by a background thread
+            rsa_key = jwks_cache.get_key(kid)
+        else:
+            rsa_key = await asyncio.to_thread(jwks_cache.get_key, kid)
+        payload = decode_jwt(token, kid, rsa_key)
+    check_permissions(permission, payload)
+    return payload
+
+
+'''
+@endpoint(permission, *tables, include=())
+    the endpoint requires the permission and gets an AsyncSession,
+    its responses get an ETag from the versions of the tables (see capstone/etag.py),
+    requests it doesn't handle are forwarded to the Flask app
+'''
+def endpoint(permission, *tables, include=()):
+    def endpoint_decorator(f):
+        @wraps(f)
+        async def wrapper(request):
+            if forwarded(request):
+                return Forward(request.app.state.flask)
+            await authenticate(request, permission)
+            read_tables = list(tables)
+            if include and request.query_params.get('include'):
+                read_tables.extend(include)
+            async with request.app.state.sessions() as session:
+                versions = await get_versions(session, read_tables)
+                etag = etag_of(full_path(request), request.headers.get('Accept', ''),
+                               read_tables, versions)
+                matched = matching_etag(parse_etags(request.headers.get('If-None-Match')), etag)
+                if matched is not None:
+                    return Response(status_code=304, headers={'ETag': quote_etag(matched)})
+                response = await f(request, session)
+            if response.status_code == 200:
+                encoding = compress(request, response)
+                response.headers['ETag'] = quote_etag(f'{etag}-{encoding}' if encoding else etag)
+            return response
+        return wrapper
+    return endpoint_decorator
+
+
+'''
+compress(request, response)
+    compresses the body of the response like the Flask app (see capstone/compression.py),
+    returns the encoding or None
+'''
+def compress(request, response):
+    response.headers['Vary'] = 'Accept-Encoding'
+    body, encoding = compression.compress_body(response.body, response.media_type,
+                                               request.headers.get('Accept-Encoding'))
+    if encoding is not None:
+        response.body = body
+        response.headers['Content-Length'] = str(len(body))
+        response.headers['Content-Encoding'] = encoding
+    return encoding
+
+
+async def get_versions(session, tables):
+    result = await session.execute(
+        select(table_version.c.name, table_version.c.version)
+        .where(table_version.c.name.in_(tables)))
+    versions = dict(result.all())
+    return [versions.get(name, 0) for name in tables]
+
+
+async def get_page(request, session, model, relationship):
+    include = parse_include(request.query_params.get('include', ''), (relationship,))
+    fields = parse_fields(request.query_params.get('fields', ''), model)
+    sort = parse_sort(request.query_params.get('sort'), model)
+    limit, after = parse_page_args(request.query_params, request.app.state.config)
+    query = select(model).options(*include_options(model, include),
+                                  *fields_options(model, fields, *sort_keys(sort)))
+    query = keyset_order(query, model.id, sort, after)
+    result = await session.execute(query.limit(limit + 1))
+    rows, next_cursor = keyset_cursor(result.scalars().all(), limit, model.id, sort)
+    return [row.format(include, fields) for row in rows], next_cursor
+
+
+async def get_one(request, session, model, relationship, row_id):
+    include = parse_include(request.query_params.get('include', ''), (relationship,))
+    fields = parse_fields(request.query_params.get('fields', ''), model)
+    row = await session.get(model, row_id,
+                            options=include_options(model, include) + fields_options(model, fields))
+    if row is None:
+        raise NotFound()
+    return row.format(include, fields)
+
+
+'''
+get_related(request, session, model, row_id, related, column, counter)
+    returns (total, rows), the count of links (counter) of the row and its related rows
+'''
+async def get_related(request, session, model, row_id, related, column, counter):
+    row = await session.get(model, row_id)
+    if row is None:
+        raise NotFound()
+    fields = parse_fields(request.query_params.get('fields', ''), related)
+    result = await session.execute(select(related).options(*fields_options(related, fields))
+                                   .join(actor_movie).where(column == row_id))
+    return getattr(row, counter), [related_row.format(fields=fields)
+                                   for related_row in result.scalars().all()]
+
+
+async def greeting(request):
+    return json_response({'message': 'Welcome to Capstone app'})
+
+
+@endpoint('get:actors', 'Actor', include=('actor_movie', 'Movie'))
+async def get_actors(request, session):
+    actors, next_cursor = await get_page(request, session, Actor, 'movies')
+    return json_response({
+        "success": True,
+        "actors": actors,
+        "next_cursor": next_cursor
+    })
+
+
+@endpoint('get:actors-detail', 'Actor', include=('actor_movie', 'Movie'))
+async def get_actor(request, session):
+    actor = await get_one(request, session, Actor, 'movies', request.path_params['actor_id'])
+    return json_response({
+        "success": True,
+        "actor": actor
+    })
+
+
+@endpoint('get:actors-movies', 'Actor', 'actor_movie', 'Movie')
+async def get_actor_movies(request, session):
+    actor_id = request.path_params['actor_id']
+    total, movies = await get_related(request, session, Actor, actor_id, Movie,
+                                      actor_movie.c.actor_id, 'movie_count')
+    return json_response({
+        "success": True,
+        "actor_id": actor_id,
+        "totalMovies": total,
+        "movies": movies
+    })
+
+
+@endpoint('get:movies', 'Movie', include=('actor_movie', 'Actor'))
+async def get_movies(request, session):
+    movies, next_cursor = await get_page(request, session, Movie, 'actors')
+    return json_response({
+        "success": True,
+        "movies": movies,
+        "next_cursor": next_cursor
+    })
+
+
+@endpoint('get:movies-detail', 'Movie', include=('actor_movie', 'Actor'))
+async def get_movie(request, session):
+    movie = await get_one(request, session, Movie, 'actors', request.path_params['movie_id'])
+    return json_response({
+        "success": True,
+        "movie": movie
+    })
+
+
+@endpoint('get:movies-actors', 'Movie', 'actor_movie', 'Actor')
+async def get_movie_actors(request, session):
+    movie_id = request.path_params['movie_id']
+    total, actors = await get_related(request, session, Movie, movie_id, Actor,
+                                      actor_movie.c.movie_id, 'actor_count')
+    return json_response({
+        "success": True,
+        "movie_id": movie_id,
+        "totalActors": total,
+        "actors": actors
+    })
+
+
+async def handle_http_error(request, error):
+    code = error.code if error.code in ERROR_MESSAGES else 500
+    return json_response({
+        "success": False,
+        "error": code,
+        "message": ERROR_MESSAGES[code]
+    }, code)
+
+
+async def handle_auth_error(request, ex):
+    return json_response(ex.error, ex.status_code)
+
+
+async def handle_server_error(request, error):
+    return json_response({
+        "success": False,
+        "error": 500,
+        "message": ERROR_MESSAGES[500]
+    }, 500)
+
+
+'''
+create_asgi_app(flask_app)
+    returns the ASGI app, flask_app (default: capstone.app) serves the forwarded requests
+'''
+def create_asgi_app(flask_app=None):
+    if flask_app is None:
+        from capstone import app as flask_app
+    config = flask_app.config
+    engine = create_async_engine(async_database_url(config['SQLALCHEMY_DATABASE_URI']),
+                                 **async_engine_options(config))
+    instrument_engine(engine.sync_engine, config)
+
+    flask = WSGIMiddleware(flask_app)
+    routes = [
+        Route('/', greeting, methods=['GET']),
+        Route('/actors', get_actors, methods=['GET']),
+        Route('/actors/{actor_id:int}', get_actor, methods=['GET']),
+        Route('/actors/{actor_id:int}/movies', get_actor_movies, methods=['GET']),
+        Route('/movies', get_movies, methods=['GET']),
+        Route('/movies/{movie_id:int}', get_movie, methods=['GET']),
+        Route('/movies/{movie_id:int}/actors', get_movie_actors, methods=['GET']),
+        # everything else is served by the Flask app
+        Mount('/', flask)
+    ]
+    app = Starlette(routes=routes,
+                    middleware=[Middleware(CORSHeaders)],
+                    exception_handlers={
+                        HTTPException: handle_http_error,
+                        AuthError: handle_auth_error,
+                        500: handle_server_error
+                    },
+                    on_shutdown=[engine.dispose])
+    app.state.config = config
+    app.state.flask = flask
+    app.state.sessions = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    return app
+
+
+app = create_asgi_app()
@@ -1,14 +1,31 @@
 import os
 import json
-from flask import request
+import time
+import logging
+import hashlib
+import threading
+from collections import OrderedDict
+from flask import request, g
 from functools import wraps
-from jose import jwt
+from jose import jwt, jwk
 from urllib.request import urlopen
 
 
 AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN')
 ALGORITHMS = [os.environ.get('ALGORITHMS')]
 API_AUDIENCE = os.environ.get('API_AUDIENCE')
+# how long (in seconds) a fetched key set is considered fresh
+JWKS_CACHE_TTL = int(os.environ.get('JWKS_CACHE_TTL', 3600))
+# minimum number of seconds between two refreshes forced by an unknown kid
+JWKS_MIN_REFRESH_INTERVAL = int(os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+# minimum number of seconds between two fetches while no key set is loaded
+JWKS_MIN_RETRY_INTERVAL = float(os.environ.get('JWKS_MIN_RETRY_INTERVAL', 5))
+# max seconds a fetch of the key set waits for Auth0
+JWKS_TIMEOUT = float(os.environ.get('JWKS_TIMEOUT', 5))
+# optional local jwks.json used to seed the key set (no network needed at start)
+JWKS_FILE = os.environ.get('JWKS_FILE')
+# max number of verified tokens whose payloads are kept in memory
+CLAIMS_CACHE_SIZE = int(os.environ.get('CLAIMS_CACHE_SIZE', 1024))
 print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!", AUTH0_DOMAIN, ALGORITHMS, API_AUDIENCE)
 
 
@@ -34,7 +51,13 @@ class AuthError(Exception):
     return the token part of the header
 '''
 def get_token_auth_header():
-    auth = request.headers.get('Authorization', None)
+    return parse_auth_header(request.headers.get('Authorization', None))
+
+'''
+    parse_auth_header(auth) returns the token of the Authorization header auth,
+    it is shared by the Flask and the ASGI apps (see capstone/asgi.py)
+'''
+def parse_auth_header(auth):
     if not auth:
         raise AuthError({
             'code': 'authorization_header_missing',
@@ -88,6 +111,202 @@ def check_permissions(permission, payload):
         }, 403)
     return True
 
+## JWKS cache
+
+def fetch_jwks():
+    # Auth0 exposes a JWKS endpoint for each tenant,
+    # which is found at https://YOUR_DOMAIN/.well-known/jwks.json
+    # a hung fetch would hold the fetch lock (or the background refresh) forever
+    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json', timeout=JWKS_TIMEOUT)
+    # json.loads() method can be used to parse a valid JSON string and convert it into a Python Dictionary
+    return json.loads(jsonurl.read())
+
+'''
+JWKSCache
+A process-wide cache of the Auth0 key set, so that verify_decode_jwt
+doesn't go to the identity provider on every request.
+    - a fresh key set (younger than ttl) is served as is
+    - a stale key set is still served while a background thread refetches it
+    - an unknown kid forces a synchronous refetch, at most once per
+      min_refresh_interval seconds, so junk tokens can't trigger refresh storms
+    - without any key set (the first fetch failed) a fetch is retried at most once per
+      min_retry_interval seconds, the requests in between fail with 503 right away
+    - the key set can be seeded from a local jwks.json file
+    - with a shared cache backend (see capstone/cache_backends.py) a key set
+      fetched by one worker is used by the others instead of fetching it again
+keys holds the public key objects already constructed from the key set, by kid.
+'''
+class JWKSCache:
+    def __init__(self, fetch=fetch_jwks, ttl=JWKS_CACHE_TTL,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL, seed_file=None, shared=None,
+                 min_retry_interval=JWKS_MIN_RETRY_INTERVAL):
+        self.fetch = fetch
+        self.shared = shared
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.min_retry_interval = min_retry_interval
+        self.jwks = None
+        self.keys = {}
+        self.fetched_at = 0
+        self.last_forced_refresh = None
+        self.refreshing = False
+        self.lock = threading.Lock()
+        self.fetch_lock = threading.Lock()
+        if seed_file:
+            self.load_file(seed_file)
+
+    def load_file(self, path):
+        # seeded keys are treated as stale (older than any ttl),
+        # so they are refetched in the background on first use
+        with open(path) as f:
+            self.set_jwks(json.load(f), fetched_at=float('-inf'))
+
+    def set_jwks(self, jwks, fetched_at=None):
+        keys = {}
+        for key in jwks['keys']:
+            try:
+                keys[key['kid']] = jwk.construct(key, key.get('alg', ALGORITHMS[0]))
+            except Exception:
+                logging.exception('unable to construct JWK %s', key.get('kid'))
+        with self.lock:
+            self.jwks = jwks
+            self.keys = keys
+            self.fetched_at = time.monotonic() if fetched_at is None else fetched_at
+
+    def has_kid(self, kid):
+        return kid in self.keys
+
+    def load_shared(self, kid=None):
+        # returns (jwks, fetched_at) of the shared key set if it is fresh
+        # (and contains kid), None otherwise
+        if self.shared is None:
+            return None
+        entry = self.shared.get('jwks')
+        if entry is None:
+            return None
+        try:
+            entry = json.loads(entry)
+            age = time.time() - entry['fetched_at']
+            jwks = entry['jwks']
+            kids = [key['kid'] for key in jwks['keys']]
+        except (ValueError, KeyError, TypeError):
+            return None
+        if age > self.ttl or (kid is not None and kid not in kids):
+            return None
+        return jwks, time.monotonic() - max(age, 0)
+
+    def store_shared(self, jwks):
+        if self.shared is not None:
+            self.shared.set('jwks', json.dumps({'fetched_at': time.time(), 'jwks': jwks}).encode())
+
+    def refresh(self, kid=None):
+        shared = self.load_shared(kid)
+        if shared is not None:
+            self.set_jwks(*shared)
+            return True
+        try:
+            jwks = self.fetch()
+        except Exception:
+            logging.exception('unable to fetch JWKS')
+            return False
+        self.set_jwks(jwks)
+        self.store_shared(jwks)
+        return True
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        finally:
+            self.refreshing = False
+
+    def refresh_in_background(self):
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+        threading.Thread(target=self._background_refresh, daemon=True).start()
+
+    def _may_force_refresh(self):
+        now = time.monotonic()
+        with self.lock:
+            # without any key every request fails, the fetch is retried sooner
+            interval = self.min_refresh_interval if self.jwks is not None else self.min_retry_interval
+            if self.last_forced_refresh is not None and now - self.last_forced_refresh < interval:
+                return False
+            self.last_forced_refresh = now
+            return True
+
+    def get_jwks(self, kid=None):
+        if self.jwks is None or (kid is not None and not self.has_kid(kid)):
+            # concurrent misses wait for a single synchronous fetch
+            with self.fetch_lock:
+                missing = self.jwks is None or (kid is not None and not self.has_kid(kid))
+                if missing and self._may_force_refresh():
+                    self.refresh(kid)
+            if self.jwks is None:
+                raise AuthError({
+                    'code': 'jwks_unavailable',
+                    'description': 'Unable to fetch the signing keys.'
+                }, 503)
+        elif time.monotonic() - self.fetched_at > self.ttl:
+            self.refresh_in_background()
+        return self.jwks
+
+    def get_key(self, kid):
+        self.get_jwks(kid)
+        return self.keys.get(kid)
+
+
+jwks_cache = JWKSCache(seed_file=JWKS_FILE)
+
+'''
+ClaimsCache
+A bounded LRU of verified payloads keyed by the sha256 digest of the token,
+so a client reusing its bearer token isn't verified again on every request.
+An entry expires at the token's own exp and is ignored once its kid
+is no longer in the key set.
+'''
+class ClaimsCache:
+    def __init__(self, maxsize=CLAIMS_CACHE_SIZE, jwks=jwks_cache):
+        self.maxsize = maxsize
+        self.jwks = jwks
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def digest(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token):
+        key = self.digest(token)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            payload, kid = entry
+            if payload['exp'] <= time.time() or not self.jwks.has_kid(kid):
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return payload
+
+    def put(self, token, payload, kid):
+        if self.maxsize <= 0 or 'exp' not in payload:
+            return
+        key = self.digest(token)
+        with self.lock:
+            self.entries[key] = (payload, kid)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+claims_cache = ClaimsCache()
+
 '''
     implementation of verify_decode_jwt(token) method
     @INPUTS
@@ -95,36 +314,40 @@ def check_permissions(permission, payload):
 
     it should be an Auth0 token with key id (kid)
     it should verify the token using Auth0 /.well-known/jwks.json
+        (served from jwks_cache, see JWKSCache)
     it should decode the payload from the token
     it should validate the claims
-    return the decoded payload
+    return the decoded payload, permissions are returned as a frozenset
+        (payloads of already verified tokens are served from claims_cache)
 
     !!NOTE urlopen has a common certificate error described here: https://stackoverflow.com/questions/50236117/scraping-ssl-certificate-verify-failed-error-for-http-en-wikipedia-org
 '''
 def verify_decode_jwt(token):
-    # Auth0 exposes a JWKS endpoint for each tenant,
-    # which is found at https://YOUR_DOMAIN/.well-known/jwks.json
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    # json.loads() method can be used to parse a valid JSON string and convert it into a Python Dictionary
-    jwks = json.loads(jsonurl.read())
+    payload = claims_cache.get(token)
+    if payload is not None:
+        return payload
+
+    kid = get_token_kid(token)
+    return decode_jwt(token, kid, jwks_cache.get_key(kid))
+
+'''
+    get_token_kid(token) returns the key id (kid) of the unverified header of the token
+'''
+def get_token_kid(token):
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
+    return unverified_header['kid']
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
-    if rsa_key:
+'''
+    decode_jwt(token, kid, rsa_key) verifies the token with the key of its kid
+    (None if it isn't in the key set) and returns the payload
+'''
+def decode_jwt(token, kid, rsa_key):
+    if rsa_key is not None:
         try:
             payload = jwt.decode(
                 token,
@@ -133,7 +356,9 @@ def verify_decode_jwt(token):
                 audience=API_AUDIENCE,
                 issuer='https://' + AUTH0_DOMAIN + '/'
             )
-
+            if 'permissions' in payload:
+                payload['permissions'] = frozenset(payload['permissions'])
+            claims_cache.put(token, payload, kid)
             return payload
 
         except jwt.ExpiredSignatureError:
@@ -161,19 +386,24 @@ def verify_decode_jwt(token):
     implementation of  @requires_auth(permission) decorator method
     @INPUTS
         permission: string permission (i.e. 'post:drink')
+        more_permissions: other permissions the token must also have,
+            checked with the same decoded token (i.e. @requires_auth('get:actors', 'get:movies'))
 
     it should use the get_token_auth_header method to get the token
     it should use the verify_decode_jwt method to decode the jwt
     it should use the check_permissions method validate claims and check the requested permission
     return the decorator which passes the decoded payload to the decorated method
 '''
-def requires_auth(permission=''):
+def requires_auth(permission='', *more_permissions):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
             token = get_token_auth_header()
             payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            for required in (permission, *more_permissions):
+                check_permissions(required, payload)
+            # the subject is used to route its reads after a write (see capstone/replicas.py)
+            g.auth_payload = payload
             return f(*args, **kwargs)
         return wrapper
     return requires_auth_decorator
\ No newline at end of file
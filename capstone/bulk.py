@@ -0,0 +1,80 @@
+import json
+from flask import request, abort, current_app
+from capstone.models import db, bump_versions
+
+'''
+Bulk creation of actors and movies
+The body is a JSON array of objects or NDJSON (one object per line).
+Every item is validated first, then all the valid ones are inserted
+with multi-row INSERT ... RETURNING id statements in a single transaction.
+Invalid items are reported by index and don't abort the batch.
+'''
+
+
+'''
+get_bulk_items()
+    returns the list of items of the request body
+    an NDJSON line that isn't valid JSON is returned as a ValueError
+'''
+def get_bulk_items():
+    if request.mimetype == 'application/x-ndjson':
+        items = []
+        for line in request.get_data(as_text=True).splitlines():
+            if line.strip() == "":
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(ValueError("invalid JSON"))
+    else:
+        items = request.get_json(silent=True)
+        if not isinstance(items, list):
+            abort(400, "body must be a JSON array or NDJSON")
+
+    if len(items) > current_app.config.get('MAX_BULK_SIZE', 10000):
+        abort(400, "too many items")
+    return items
+
+
+'''
+parse_items(items, parse)
+    validates every item with parse (i.e. Actor.parse)
+    returns (rows, indexes, errors): column values of the valid items,
+    their indexes in the batch, and the list of errors of the others
+'''
+def parse_items(items, parse):
+    rows, indexes, errors = [], [], []
+    for index, item in enumerate(items):
+        try:
+            if isinstance(item, ValueError):
+                raise item
+            rows.append(parse(item))
+            indexes.append(index)
+        except ValueError as e:
+            errors.append({'index': index, 'message': str(e)})
+    return rows, indexes, errors
+
+
+'''
+bulk_insert(model, rows)
+    inserts the rows into the table of the model within the current transaction
+    returns the list of new ids, in the order of rows
+'''
+def bulk_insert(model, rows):
+    table = model.__table__
+    if not rows:
+        return []
+    bump_versions(table.name)
+    if not db.engine.dialect.full_returning:
+        # e.g. SQLite: one statement per row, still a single transaction
+        return [db.session.execute(table.insert().values(row)).inserted_primary_key[0]
+                for row in rows]
+
+    ids = []
+    # keep each statement under the limit of bind parameters
+    chunk_size = current_app.config.get('BULK_CHUNK_SIZE', 1000)
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        result = db.session.execute(table.insert().values(chunk).returning(table.c.id))
+        ids.extend(row[0] for row in result)
+    return ids
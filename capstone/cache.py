@@ -0,0 +1,211 @@
+import json
+import time
+import struct
+import threading
+from functools import wraps
+from flask import request, g, make_response
+from capstone.cache_backends import MemoryBackend, create_backend
+from capstone.singleflight import single_flight
+from capstone.replicas import request_replica, staleness
+
+'''
+Response cache of the read endpoints
+Serialized response bodies are kept in a cache backend (see capstone/cache_backends.py),
+in the process or shared by all the workers, keyed by the path,
+query string and Accept header of the request.
+Every entry is tagged with the resources it contains:
+    'actors', 'movies'                      - membership of the lists
+    'actors:search', 'movies:search'        - search results
+    'actor:<id>', 'movie:<id>'              - an actor or movie in the body
+    'actor:<id>:movies', 'movie:<id>:actors' - the links of an actor or movie
+and the write endpoints invalidate exactly the tags they change,
+i.e. linking actor 3 to movie 7 invalidates 'actor:3:movies' and 'movie:7:actors'.
+Every tag has a version counter in the backend, an entry stores the versions of
+its tags and is only served while they are unchanged, so an invalidation
+made by one worker applies to all of them.
+'''
+
+ENTRY_HEADER = struct.Struct('I')
+# incremented by every invalidation, a response computed while
+# an invalidation happened may be stale and isn't stored
+GENERATION = 'generation'
+
+
+def encode_entry(body, mimetype, tags):
+    header = json.dumps({'mimetype': mimetype, 'tags': tags}).encode()
+    return ENTRY_HEADER.pack(len(header)) + header + body
+
+
+def decode_entry(entry):
+    (length,) = ENTRY_HEADER.unpack_from(entry)
+    start = ENTRY_HEADER.size
+    header = json.loads(bytes(entry[start:start + length]))
+    return bytes(entry[start + length:]), header['mimetype'], header['tags']
+
+
+class ResponseCache:
+    def __init__(self, backend=None, max_entry_bytes=1024 * 1024, ttl=None):
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.max_entry_bytes = max_entry_bytes
+        self.ttl = ttl
+        # counters of this process
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+
+    def init_app(self, app, backend=None):
+        self.backend = backend if backend is not None else create_backend(app.config)
+        self.max_entry_bytes = app.config.get('RESPONSE_CACHE_MAX_ENTRY_BYTES', self.max_entry_bytes)
+        self.ttl = app.config.get('RESPONSE_CACHE_TTL', self.ttl)
+
+    def count(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def generation(self):
+        return self.backend.get_counters([GENERATION])[0]
+
+    def get(self, key):
+        entry = self.backend.get('response:' + key)
+        if entry is not None:
+            body, mimetype, tags = decode_entry(entry)
+            names = list(tags)
+            versions = self.backend.get_counters(['tag:' + name for name in names])
+            if versions == [tags[name] for name in names]:
+                self.count('hits')
+                return body, mimetype
+        self.count('misses')
+        return None
+
+    def put(self, key, value, tags, generation, staleness=0):
+        # value is (body, mimetype)
+        # staleness is how many seconds the body may be behind the database (read replica),
+        # it isn't stored when an invalidation happened in that time
+        # returns True if the response was stored
+        body, mimetype = value
+        if len(body) > self.max_entry_bytes:
+            return False
+        if staleness:
+            invalidated_at = self.backend.get('invalidated_at')
+            if invalidated_at is not None and time.time() - float(invalidated_at) < staleness:
+                return False
+        names = sorted(tags)
+        # the tags are read before the generation, and invalidate increments
+        # the generation before the tags: an entry can't get the new version
+        # of a tag unless the generation has changed too
+        counters = self.backend.get_counters(['tag:' + name for name in names] + [GENERATION])
+        if counters[-1] != generation or any(counter < 0 for counter in counters):
+            return False
+        self.backend.set('response:' + key,
+                         encode_entry(body, mimetype, dict(zip(names, counters))),
+                         self.ttl)
+        return True
+
+    def invalidate(self, *tags):
+        self.backend.incr(GENERATION)
+        self.backend.set('invalidated_at', repr(time.time()).encode())
+        for tag in set(tags):
+            self.backend.incr('tag:' + tag)
+            self.count('invalidations')
+
+    def stats(self):
+        stats = self.backend.stats()
+        with self.lock:
+            stats.update({
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations
+            })
+        return stats
+
+
+response_cache = ResponseCache()
+
+
+'''
+cache_tags(*tags)
+    adds tags to the response of the current request
+'''
+def cache_tags(*tags):
+    g.setdefault('cache_tags', set()).update(tags)
+
+
+'''
+tag_rows(rows, include)
+    adds the tags of the actors/movies (and of their included relationships)
+    contained in the response of the current request
+'''
+def tag_rows(rows, include=()):
+    tags = set()
+    for row in rows:
+        name = row.__tablename__.lower()
+        tags.add(f'{name}:{row.id}')
+        for relationship in include:
+            tags.add(f'{name}:{row.id}:{relationship}')
+            tags.update(f'{related.__tablename__.lower()}:{related.id}'
+                        for related in getattr(row, relationship))
+    cache_tags(*tags)
+
+
+'''
+tag_ids(model, ids)
+    adds the tags of the actors/movies of the model with these ids
+'''
+def tag_ids(model, ids):
+    name = model.__tablename__.lower()
+    cache_tags(*[f'{name}:{row_id}' for row_id in ids])
+
+
+def invalidate(*tags):
+    response_cache.invalidate(*tags)
+
+
+'''
+@cached
+    serves the response of the decorated GET endpoint from response_cache,
+    only 200 responses that aren't streamed are stored
+    on a miss, concurrent identical requests are coalesced (see capstone/singleflight.py):
+    one of them runs the endpoint and the others get a copy of its response
+    it should be used below @requires_auth, so the permission is checked first
+'''
+def cached(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        key = request.full_path + '|' + request.headers.get('Accept', '')
+        value = response_cache.get(key)
+        if value is not None:
+            body, mimetype = value
+            response = make_response(body)
+            response.mimetype = mimetype
+            response.headers['X-Cache'] = 'HIT'
+            return response
+
+        def compute():
+            generation = response_cache.generation()
+            response = make_response(f(*args, **kwargs))
+            if response.is_streamed:
+                # a stream can't be replayed, the followers run the endpoint
+                return response, None
+            body = response.get_data()
+            if response.status_code == 200:
+                # the compressed forms of a stored body are kept too (see capstone/compression.py)
+                g.response_stored = response_cache.put(key, (body, response.mimetype),
+                                                       g.get('cache_tags', ()), generation, staleness())
+            return response, (body, response.status_code, response.mimetype)
+
+        # requests reading from the primary (i.e. after a write) don't get a replica's response
+        flight = key + ('|replica' if request_replica() is not None else '|primary')
+        (response, copy), shared = single_flight.do(flight, compute)
+        if shared:
+            if copy is None:
+                response, _ = compute()
+            else:
+                body, status, mimetype = copy
+                response = make_response(body, status)
+                response.mimetype = mimetype
+                response.headers['X-Cache'] = 'COALESCED'
+                return response
+        response.headers['X-Cache'] = 'MISS'
+        return response
+    return wrapper
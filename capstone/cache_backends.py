@@ -0,0 +1,431 @@
+import os
+import mmap
+import time
+import fcntl
+import socket
+import struct
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+'''
+Cache backends
+A backend is a key/value store of bytes with counters, shared by the
+response cache and the JWKS cache:
+    get(key)                 - returns the value or None
+    set(key, value, ttl)     - stores the value, ttl in seconds (None: no expiry)
+    get_counters(keys)       - returns the values of the counters (0 if missing)
+    incr(key)                - increments the counter and returns its new value (-1 if it failed)
+    stats()                  - returns a dict of counters of the backend
+There are three backends:
+    MemoryBackend  - a dict in the process (default)
+    MmapBackend    - a shared memory segment used by every worker on the host
+    RedisBackend   - a Redis server (or anything that speaks its protocol)
+A backend may lose any value at any time (eviction, restart), so it is only
+used for data that can be recomputed.
+'''
+
+
+'''
+MemoryBackend
+    LRU bounded by the total size of the values in bytes
+'''
+class MemoryBackend:
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.values = OrderedDict()
+        self.counters = {}
+        self.size = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.time():
+                self._remove(key)
+                return None
+            self.values.move_to_end(key)
+            return value
+
+    def _remove(self, key):
+        value, _ = self.values.pop(key)
+        self.size -= len(value)
+
+    def set(self, key, value, ttl=None):
+        if len(value) > self.max_bytes:
+            return
+        expires_at = time.time() + ttl if ttl else None
+        with self.lock:
+            if key in self.values:
+                self._remove(key)
+            self.values[key] = (value, expires_at)
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.values)))
+                self.evictions += 1
+
+    def get_counters(self, keys):
+        with self.lock:
+            return [self.counters.get(key, 0) for key in keys]
+
+    def incr(self, key):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+            return self.counters[key]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'backend': 'memory',
+                'entries': len(self.values),
+                'size': self.size,
+                'max_bytes': self.max_bytes,
+                'evictions': self.evictions
+            }
+
+
+'''
+MmapBackend
+A file (i.e. in /dev/shm) mapped in memory by every worker of the host:
+    header   | magic, number of slots, slot size, number of counters
+    counters | array of unsigned 64 bits counters, a key is hashed to one of them
+               (two keys can share a counter: they are just incremented together)
+    slots    | array of fixed size slots, a key is hashed to one of them and
+               replaces the value that was there (direct-mapped cache)
+Slot: key digest (16 bytes), expires_at (double, 0: no expiry),
+      length of the key, length of the value (unsigned 32 bits), key, value.
+Every slot and counter is locked with fcntl record locks between processes
+and with a lock between the threads of a process.
+Every process that maps the file holds a shared lock on a byte beyond its end:
+a file with another layout (i.e. SHARED_CACHE_SLOT_SIZE changed) is only
+initialized again when no process maps it, otherwise the backend refuses to start.
+'''
+class MmapBackend:
+    MAGIC = b'CAPSTONE-CACHE-1'
+    HEADER = struct.Struct('16sIII')
+    SLOT_HEADER = struct.Struct('16sdII')
+    COUNTER = struct.Struct('Q')
+    # byte locked by the processes that map the file
+    USERS_OFFSET = 1 << 62
+    # (device, inode) of the files mapped by this process (its locks don't conflict with each other)
+    mapped = set()
+
+    def __init__(self, path, size=64 * 1024 * 1024, slot_size=64 * 1024, counters=65536):
+        self.path = path
+        self.slot_size = slot_size
+        self.counters = counters
+        self.counters_offset = self.HEADER.size
+        self.slots_offset = self.counters_offset + counters * self.COUNTER.size
+        self.slots = max(1, (size - self.slots_offset) // slot_size)
+        self.size = self.slots_offset + self.slots * slot_size
+        self.lock = threading.Lock()
+
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        header = self.HEADER.pack(self.MAGIC, self.slots, slot_size, counters)
+        stat = os.fstat(self.fd)
+        file_id = (stat.st_dev, stat.st_ino)
+        # the first worker (or a worker with a different layout, once the file is unused) initializes the file
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, self.HEADER.size, 0)
+        try:
+            if os.fstat(self.fd).st_size != self.size or os.pread(self.fd, self.HEADER.size, 0) != header:
+                if file_id in self.mapped or not self._unused():
+                    # the descriptor is left open: closing it would release the locks of this process
+                    raise RuntimeError(f'{path} is mapped by workers with another layout of the cache, '
+                                       'stop them or set another SHARED_CACHE_PATH')
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, self.size)
+                os.pwrite(self.fd, header, 0)
+            self.map = mmap.mmap(self.fd, self.size)
+            # held as long as the backend lives (a closed descriptor of the file releases the locks of the process)
+            fcntl.lockf(self.fd, fcntl.LOCK_SH, 1, self.USERS_OFFSET)
+            self.mapped.add(file_id)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, self.HEADER.size, 0)
+
+    def _unused(self):
+        # no other process holds the lock of the users
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, self.USERS_OFFSET)
+        except OSError:
+            return False
+        return True
+
+    @staticmethod
+    def digest(key):
+        return hashlib.blake2b(key.encode(), digest_size=16).digest()
+
+    @contextmanager
+    def _locked(self, offset, length, exclusive):
+        with self.lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH, length, offset)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, length, offset)
+
+    def _slot(self, digest):
+        index = int.from_bytes(digest[:8], 'little') % self.slots
+        return self.slots_offset + index * self.slot_size
+
+    def _counter(self, key):
+        index = int.from_bytes(self.digest(key)[:8], 'little') % self.counters
+        return self.counters_offset + index * self.COUNTER.size
+
+    def get(self, key):
+        digest = self.digest(key)
+        offset = self._slot(digest)
+        with self._locked(offset, self.slot_size, exclusive=False):
+            slot_digest, expires_at, key_length, value_length = \
+                self.SLOT_HEADER.unpack_from(self.map, offset)
+            if slot_digest != digest or (expires_at and expires_at <= time.time()):
+                return None
+            start = offset + self.SLOT_HEADER.size
+            if self.map[start:start + key_length] != key.encode():
+                return None
+            start += key_length
+            return self.map[start:start + value_length]
+
+    def set(self, key, value, ttl=None):
+        key_bytes = key.encode()
+        if self.SLOT_HEADER.size + len(key_bytes) + len(value) > self.slot_size:
+            return
+        digest = self.digest(key)
+        offset = self._slot(digest)
+        expires_at = time.time() + ttl if ttl else 0
+        with self._locked(offset, self.slot_size, exclusive=True):
+            self.SLOT_HEADER.pack_into(self.map, offset, digest, expires_at,
+                                       len(key_bytes), len(value))
+            start = offset + self.SLOT_HEADER.size
+            self.map[start:start + len(key_bytes) + len(value)] = key_bytes + value
+
+    def get_counters(self, keys):
+        values = []
+        for key in keys:
+            offset = self._counter(key)
+            with self._locked(offset, self.COUNTER.size, exclusive=False):
+                values.append(self.COUNTER.unpack_from(self.map, offset)[0])
+        return values
+
+    def incr(self, key):
+        offset = self._counter(key)
+        with self._locked(offset, self.COUNTER.size, exclusive=True):
+            value = self.COUNTER.unpack_from(self.map, offset)[0] + 1
+            self.COUNTER.pack_into(self.map, offset, value)
+            return value
+
+    def stats(self):
+        return {
+            'backend': 'mmap',
+            'path': self.path,
+            'slots': self.slots,
+            'slot_size': self.slot_size,
+            'max_bytes': self.size
+        }
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisUnavailable(ConnectionError):
+    pass
+
+
+'''
+RedisBackend
+A minimal client of the Redis protocol (RESP) with a single connection per process,
+only GET, SET, MGET, INCR, AUTH and SELECT are used.
+When the server can't be reached the cache behaves as if it was empty,
+it isn't tried again before retry_interval seconds (the requests don't wait
+on the lock of the connection for a dead server).
+An INCR that fails is retried before any other command, until it succeeds
+the cache is bypassed (an invalidation lost would let the old entries be served).
+Every value expires after max_ttl seconds at most, whatever ttl is asked.
+'''
+class RedisBackend:
+    def __init__(self, url, prefix='capstone:', timeout=1.0, max_ttl=86400, retry_interval=5.0):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip('/') or 0)
+        self.prefix = prefix
+        self.timeout = timeout
+        self.max_ttl = max_ttl
+        self.retry_interval = retry_interval
+        # time.monotonic() before which the server isn't tried again
+        self.down_until = 0
+        self.sock = None
+        self.file = None
+        self.errors = 0
+        # counters whose INCR failed, in order
+        self.missed_incrs = []
+        self.lock = threading.Lock()
+        self.missed_lock = threading.Lock()
+
+    def _connect(self):
+        self.sock = socket.create_connection((self.host, self.port), self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.file = self.sock.makefile('rb')
+        if self.password:
+            self._command('AUTH', self.password)
+        if self.db:
+            self._command('SELECT', str(self.db))
+
+    def _close(self):
+        if self.sock is not None:
+            try:
+                self.file.close()
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+        self.file = None
+
+    @staticmethod
+    def encode(*args):
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if isinstance(arg, str):
+                arg = arg.encode()
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        return b''.join(parts)
+
+    def _read(self):
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError('connection closed by the server')
+        kind, data = line[:1], line[1:-2]
+        if kind == b'+':
+            return data
+        if kind == b'-':
+            raise RedisError(data.decode())
+        if kind == b':':
+            return int(data)
+        if kind == b'$':
+            length = int(data)
+            if length == -1:
+                return None
+            value = self.file.read(length + 2)
+            return value[:-2]
+        if kind == b'*':
+            length = int(data)
+            if length == -1:
+                return None
+            return [self._read() for _ in range(length)]
+        raise RedisError(f'unexpected reply {line!r}')
+
+    def _command(self, *args):
+        self.sock.sendall(self.encode(*args))
+        return self._read()
+
+    def command(self, *args):
+        if time.monotonic() < self.down_until:
+            raise RedisUnavailable('redis is unavailable')
+        with self.lock:
+            for attempt in range(2):
+                if self.sock is None:
+                    if time.monotonic() < self.down_until:
+                        raise RedisUnavailable('redis is unavailable')
+                    try:
+                        self._connect()
+                    except (OSError, ConnectionError):
+                        self._close()
+                        self.down_until = time.monotonic() + self.retry_interval
+                        raise
+                try:
+                    return self._command(*args)
+                except (OSError, ConnectionError):
+                    # the connection may have been closed by the server, it is opened again once
+                    self._close()
+                    if attempt:
+                        raise
+
+    def _safe(self, default, *args):
+        try:
+            return self.command(*args)
+        except RedisUnavailable:
+            self.errors += 1
+            return default
+        except (OSError, ConnectionError, RedisError):
+            self.errors += 1
+            logging.exception('redis cache command %s failed', args[0])
+            return default
+
+    '''
+    replay_incrs()
+        retries the INCR that failed, returns False while one of them still fails
+    '''
+    def replay_incrs(self):
+        with self.missed_lock:
+            while self.missed_incrs:
+                if self._safe(None, 'INCR', self.prefix + self.missed_incrs[0]) is None:
+                    return False
+                self.missed_incrs.pop(0)
+            return True
+
+    def get(self, key):
+        if not self.replay_incrs():
+            return None
+        return self._safe(None, 'GET', self.prefix + key)
+
+    def set(self, key, value, ttl=None):
+        ttl = min(ttl, self.max_ttl) if ttl else self.max_ttl
+        self._safe(None, 'SET', self.prefix + key, value, 'PX', str(int(ttl * 1000)))
+
+    def get_counters(self, keys):
+        if not keys:
+            return []
+        values = None
+        if self.replay_incrs():
+            values = self._safe(None, 'MGET', *[self.prefix + key for key in keys])
+        if values is None:
+            # unknown versions, the caller must not trust any entry
+            return [-1] * len(keys)
+        return [int(value) if value is not None else 0 for value in values]
+
+    def incr(self, key):
+        value = None
+        if self.replay_incrs():
+            value = self._safe(None, 'INCR', self.prefix + key)
+        if value is None:
+            with self.missed_lock:
+                self.missed_incrs.append(key)
+            return -1
+        return value
+
+    def stats(self):
+        return {
+            'backend': 'redis',
+            'host': self.host,
+            'port': self.port,
+            'errors': self.errors
+        }
+
+
+'''
+create_backend(config)
+    returns the backend selected by CACHE_BACKEND ('memory', 'mmap' or 'redis')
+    in the config (a dict, i.e. app.config)
+'''
+def create_backend(config):
+    name = config.get('CACHE_BACKEND', 'memory')
+    max_bytes = config.get('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+    if name == 'memory':
+        return MemoryBackend(max_bytes)
+    if name == 'mmap':
+        return MmapBackend(config.get('SHARED_CACHE_PATH', '/dev/shm/capstone-cache'),
+                           size=max_bytes,
+                           slot_size=config.get('SHARED_CACHE_SLOT_SIZE', 64 * 1024))
+    if name == 'redis':
+        return RedisBackend(config.get('CACHE_URL', 'redis://localhost:6379/0'),
+                            max_ttl=config.get('CACHE_MAX_TTL', 86400),
+                            retry_interval=config.get('CACHE_RETRY_INTERVAL', 5.0))
+    raise ValueError(f'unknown cache backend {name}')
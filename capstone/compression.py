@@ -0,0 +1,200 @@
+import gzip
+import hashlib
+import threading
+from flask import g
+from werkzeug.http import parse_accept_header
+from capstone.cache_backends import MemoryBackend
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+'''
+Compression of the responses
+A response body is compressed with the best encoding accepted by the client
+(Accept-Encoding), in order of preference:
+    zstd - if zstandard is installed (pip install zstandard)
+    br   - if brotli is installed (pip install brotli)
+    gzip
+Bodies smaller than COMPRESS_MIN_SIZE bytes aren't compressed (the headers
+would cost more than the saving), nor are streamed responses.
+The compressed forms of the bodies of the response cache (see capstone/cache.py)
+are kept in the cache backend, keyed by the digest of the body and the encoding,
+so a cached response is compressed once and not by every request that gets it.
+They expire with the cached responses (RESPONSE_CACHE_TTL).
+A compressed response has the ETag of the body followed by the encoding,
+i.e. "5d41402a-gzip", both forms are accepted in If-None-Match.
+'''
+
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/x-ndjson'}
+
+
+def gzip_compress(body, level):
+    # mtime=0: the same body is always compressed to the same bytes
+    return gzip.compress(body, compresslevel=level, mtime=0)
+
+
+def brotli_compress(body, level):
+    return brotli.compress(body, quality=level)
+
+
+def zstd_compress(body, level):
+    return zstandard.ZstdCompressor(level=level).compress(body)
+
+
+'''
+available_encodings()
+    returns the names of the encodings that can be used, in order of preference
+'''
+def available_encodings():
+    encodings = []
+    if zstandard is not None:
+        encodings.append('zstd')
+    if brotli is not None:
+        encodings.append('br')
+    encodings.append('gzip')
+    return encodings
+
+
+COMPRESSORS = {
+    'zstd': zstd_compress,
+    'br': brotli_compress,
+    'gzip': gzip_compress
+}
+
+
+class Compression:
+    def __init__(self, min_size=1024, levels=None, encodings=None, backend=None, ttl=None):
+        self.min_size = min_size
+        self.levels = levels or {'gzip': 6, 'br': 5, 'zstd': 3}
+        self.encodings = encodings or available_encodings()
+        self.backend = backend if backend is not None else MemoryBackend()
+        # seconds a compressed body is kept, the ttl of the response cache
+        self.ttl = ttl
+        # counters of this process
+        self.compressed = 0
+        self.cache_hits = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.lock = threading.Lock()
+
+    def init_app(self, app, backend=None):
+        config = app.config
+        self.min_size = config.get('COMPRESS_MIN_SIZE', self.min_size)
+        self.levels = {
+            'gzip': config.get('COMPRESS_GZIP_LEVEL', self.levels['gzip']),
+            'br': config.get('COMPRESS_BROTLI_LEVEL', self.levels['br']),
+            'zstd': config.get('COMPRESS_ZSTD_LEVEL', self.levels['zstd'])
+        }
+        # COMPRESS_ENCODINGS limits the encodings, an empty list disables the compression
+        enabled = config.get('COMPRESS_ENCODINGS')
+        self.encodings = [name for name in available_encodings() if enabled is None or name in enabled]
+        if backend is not None:
+            self.backend = backend
+        self.ttl = config.get('RESPONSE_CACHE_TTL', self.ttl)
+
+    '''
+    negotiate(accept_encoding)
+        returns the encoding of the response for the Accept-Encoding header, None for no compression
+    '''
+    def negotiate(self, accept_encoding):
+        if not accept_encoding or not self.encodings:
+            return None
+        accept = parse_accept_header(accept_encoding)
+        best, best_quality = None, 0
+        for name in self.encodings:
+            quality = accept.quality(name)
+            if quality > best_quality:
+                best, best_quality = name, quality
+        return best
+
+    '''
+    compress(body, encoding, cached)
+        returns the body compressed with the encoding, cached: the body is one of
+        the response cache, its compressed form is kept in the cache backend
+    '''
+    def compress(self, body, encoding, cached=False):
+        level = self.levels[encoding]
+        key = None
+        if cached:
+            key = f'compressed:{encoding}:{level}:' + hashlib.blake2b(body, digest_size=16).hexdigest()
+            compressed = self.backend.get(key)
+            if compressed is not None:
+                self.count(len(body), len(compressed), cache_hit=True)
+                return bytes(compressed)
+        compressed = COMPRESSORS[encoding](body, level)
+        if key is not None:
+            self.backend.set(key, compressed, self.ttl)
+        self.count(len(body), len(compressed))
+        return compressed
+
+    '''
+    compress_body(body, mimetype, accept_encoding, cached)
+        returns (body, encoding), the body compressed for the client, or (body, None)
+        if it isn't compressed (too small, not JSON or not accepted)
+    '''
+    def compress_body(self, body, mimetype, accept_encoding, cached=False):
+        if len(body) < self.min_size or mimetype not in COMPRESSIBLE_MIMETYPES:
+            return body, None
+        encoding = self.negotiate(accept_encoding)
+        if encoding is None:
+            return body, None
+        return self.compress(body, encoding, cached), encoding
+
+    def count(self, bytes_in, bytes_out, cache_hit=False):
+        with self.lock:
+            self.compressed += 1
+            self.cache_hits += cache_hit
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def stats(self):
+        with self.lock:
+            return {
+                'encodings': self.encodings,
+                'min_size': self.min_size,
+                'compressed': self.compressed,
+                'cache_hits': self.cache_hits,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out
+            }
+
+
+compression = Compression()
+
+
+'''
+encoded_etags(etag)
+    returns the ETags of the compressed forms of a body with this ETag (and the ETag itself)
+'''
+def encoded_etags(etag):
+    return [etag] + [f'{etag}-{name}' for name in COMPRESSORS]
+
+
+'''
+compress_response(response, accept_encoding)
+    compresses the body of a Flask response for the client when it is worth it,
+    the responses of the response cache (a hit, or a miss that was stored) are compressed once
+'''
+def compress_response(response, accept_encoding):
+    if response.status_code != 200 or response.direct_passthrough or response.is_streamed \
+            or 'Content-Encoding' in response.headers \
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+    response.vary.add('Accept-Encoding')
+    body, encoding = compression.compress_body(response.get_data(), response.mimetype, accept_encoding,
+                                               cached=response.headers.get('X-Cache') == 'HIT'
+                                               or g.get('response_stored', False))
+    if encoding is not None:
+        response.set_data(body)
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag is not None:
+            response.set_etag(f'{etag}-{encoding}', weak)
+    return response
@@ -0,0 +1,55 @@
+from sqlalchemy import func, select, tuple_
+from capstone.models import db, Actor, actor_movie
+from capstone.pagination import encode_cursor, check_keyset_after
+
+'''
+Co-stars of an actor
+The actors who played in a movie of an actor, with the number of movies they
+shared, are counted by a single self-join of actor_movie grouped by co-star:
+    SELECT b.actor_id, count(*) FROM actor_movie a
+    JOIN actor_movie b ON b.movie_id = a.movie_id AND b.actor_id != a.actor_id
+    WHERE a.actor_id = :id GROUP BY b.actor_id
+a is read with the primary key (actor_id, movie_id) and b with the index
+(movie_id, actor_id), only the links of the movies of the actor are read.
+Co-stars are ordered by shared movies then by id, both descending, and pages
+are selected by the key (shared movies, id) of the last co-star of the previous page.
+'''
+
+
+'''
+movie_ids(actor_id)
+    returns the ids of the movies of the actor
+'''
+def movie_ids(actor_id):
+    return [movie_id for movie_id, in db.session.execute(
+        select(actor_movie.c.movie_id).where(actor_movie.c.actor_id == actor_id))]
+
+
+'''
+costars(query, actor_id, limit, after)
+    returns (rows, next_cursor), the page of (actor, shared movies) of the co-stars
+    of the actor, query is the query of the actors (i.e. with the options of ?fields=)
+'''
+def costars(query, actor_id, limit, after=None):
+    a = actor_movie.alias('a')
+    b = actor_movie.alias('b')
+    shared = func.count().label('shared_movies')
+    grouped = select(b.c.actor_id, shared) \
+        .select_from(a.join(b, (b.c.movie_id == a.c.movie_id) & (b.c.actor_id != a.c.actor_id))) \
+        .where(a.c.actor_id == actor_id) \
+        .group_by(b.c.actor_id)
+    if after is not None:
+        check_keyset_after(after, 2)
+        grouped = grouped.having(tuple_(shared, b.c.actor_id) < tuple_(*after))
+    # the page is selected before the actors are joined, one extra row tells if there is a next page
+    page = grouped.order_by(shared.desc(), b.c.actor_id.desc()).limit(limit + 1).subquery()
+    rows = query.add_columns(page.c.shared_movies) \
+        .join(page, Actor.id == page.c.actor_id) \
+        .order_by(page.c.shared_movies.desc(), Actor.id.desc()) \
+        .all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        actor, shared_movies = rows[-1]
+        next_cursor = encode_cursor([shared_movies, actor.id])
+    return rows, next_cursor
@@ -0,0 +1,71 @@
+import hashlib
+from functools import wraps
+from flask import request, make_response
+from capstone.models import get_versions
+from capstone.compression import encoded_etags
+
+'''
+ETags and conditional GET
+The ETag of a GET response is computed from the request (path, query string
+and Accept header) and the versions of the tables the endpoint reads
+(see table_version in capstone/models.py), so a request with a matching
+If-None-Match is answered 304 Not Modified with a single read of table_version,
+without loading any actor or movie nor building the JSON.
+The versions are read before the data, so a write that happens in between
+can only make the ETag older than the data, never newer.
+A compressed response has the ETag followed by its encoding (see capstone/compression.py).
+'''
+
+
+def compute_etag(tables):
+    versions = get_versions(tables)
+    return etag_of(request.full_path, request.headers.get('Accept', ''), tables, versions)
+
+
+'''
+etag_of(full_path, accept, tables, versions)
+    returns the ETag of a request for the versions of the tables it reads
+'''
+def etag_of(full_path, accept, tables, versions):
+    key = '|'.join([full_path, accept] +
+                   [f'{name}:{version}' for name, version in zip(tables, versions)])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+'''
+matching_etag(if_none_match, etag)
+    returns the ETag of the body (or of one of its compressed forms)
+    contained in If-None-Match (parsed), None if there is none
+'''
+def matching_etag(if_none_match, etag):
+    for candidate in encoded_etags(etag):
+        if if_none_match.contains(candidate):
+            return candidate
+    return None
+
+
+'''
+@conditional(*tables, include=())
+    tables: names of the tables the decorated endpoint reads
+    include: names of the tables it also reads when ?include= is used
+    it should be used below @requires_auth, so the permission is checked first
+'''
+def conditional(*tables, include=()):
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            read_tables = list(tables)
+            if include and request.args.get('include'):
+                read_tables.extend(include)
+            etag = compute_etag(read_tables)
+            matched = matching_etag(request.if_none_match, etag)
+            if matched is not None:
+                response = make_response('', 304)
+                response.set_etag(matched)
+                return response
+            response = make_response(f(*args, **kwargs))
+            if response.status_code == 200:
+                response.set_etag(etag)
+            return response
+        return wrapper
+    return conditional_decorator
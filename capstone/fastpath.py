@@ -0,0 +1,169 @@
+from functools import lru_cache
+from json.encoder import encode_basestring, encode_basestring_ascii
+from flask import current_app
+from sqlalchemy import select, Date, Integer, String
+from capstone.models import db, Actor, Movie, actor_movie
+from capstone.fields import columns
+from capstone.pagination import get_page_args, keyset_order, keyset_cursor
+from capstone.cache import cache_tags, tag_ids
+from capstone.json_backend import json_responses, format_http_date
+
+'''
+Fast read path of the list and association endpoints
+The columns are selected with a Core select (plain tuples, no ORM instances)
+and every row is serialized by an encoder compiled once per model and set of fields,
+i.e. for Actor:
+    '{"age":' + e0(row[0]) + ',"gender":' + e1(row[1]) + ... + '}'
+The output is byte-identical to jsonify(... format() ...) of the JSON backend
+(see capstone/json_backend.py): sorted keys, no spaces, ASCII escapes unless the
+backend emits UTF-8, and dates as HTTP dates.
+It is only used when jsonify is compact (not in debug mode) and FAST_READ_PATH is set.
+'''
+
+
+def encode_integer(value):
+    return 'null' if value is None else str(value)
+
+
+def encode_date(value):
+    return 'null' if value is None else '"' + format_http_date(value) + '"'
+
+
+def string_encoder(ensure_ascii):
+    encode = encode_basestring_ascii if ensure_ascii else encode_basestring
+
+    def encode_string(value):
+        return 'null' if value is None else encode(value)
+    return encode_string
+
+
+def encode_other(value):
+    return json_responses.dumps(value)[:-1].decode()
+
+
+def column_encoder(column, ensure_ascii):
+    if isinstance(column.type, Date):
+        return encode_date
+    if isinstance(column.type, Integer):
+        return encode_integer
+    if isinstance(column.type, String):
+        return string_encoder(ensure_ascii)
+    return encode_other
+
+
+class RowEncoder:
+    def __init__(self, model, fields, ensure_ascii):
+        names = sorted(name for name in columns(model) if fields is None or name in fields)
+        table_columns = [model.__table__.columns[name] for name in names]
+        self.columns = [getattr(model, name) for name in names]
+        self.id_index = names.index('id')
+        key = encode_basestring_ascii if ensure_ascii else encode_basestring
+        namespace = {}
+        parts = []
+        for index, (name, column) in enumerate(zip(names, table_columns)):
+            namespace[f'e{index}'] = column_encoder(column, ensure_ascii)
+            prefix = ('{' if index == 0 else ',') + key(name) + ':'
+            parts.append(f'{prefix!r} + e{index}(row[{index}])')
+        source = 'def encode(row):\n    return ' + ' + '.join(parts) + " + '}'\n"
+        exec(source, namespace)
+        self.encode = namespace['encode']
+
+    def encode_rows(self, rows):
+        encode = self.encode
+        return RawJSON('[' + ','.join([encode(row) for row in rows]) + ']')
+
+    def ids(self, rows):
+        return [row[self.id_index] for row in rows]
+
+
+@lru_cache(maxsize=64)
+def cached_row_encoder(model, fields, ensure_ascii):
+    return RowEncoder(model, fields, ensure_ascii)
+
+
+def row_encoder(model, fields=None, ensure_ascii=True):
+    return cached_row_encoder(model, frozenset(fields) if fields is not None else None, ensure_ascii)
+
+
+class RawJSON(str):
+    '''already encoded JSON value'''
+
+
+'''
+encode_document(document, ensure_ascii)
+    returns the JSON of the dict like jsonify, RawJSON values are inserted as is
+'''
+def encode_document(document, ensure_ascii=True):
+    key = encode_basestring_ascii if ensure_ascii else encode_basestring
+    parts = []
+    for name in sorted(document):
+        value = document[name]
+        if not isinstance(value, RawJSON):
+            value = json_responses.dumps(value)[:-1].decode()
+        parts.append(key(name) + ':' + value)
+    return '{' + ','.join(parts) + '}\n'
+
+
+def fast_path_enabled():
+    config = current_app.config
+    return config.get('FAST_READ_PATH', True) and config.get('JSON_SORT_KEYS', True) and \
+        not (config.get('JSONIFY_PRETTYPRINT_REGULAR') or current_app.debug)
+
+
+def document_response(document):
+    return current_app.response_class(encode_document(document, json_responses.ensure_ascii).encode(),
+                                      mimetype=current_app.config['JSONIFY_MIMETYPE'])
+
+
+'''
+page_response(model, name, fields, sort)
+    the paged response of GET /actors or GET /movies (name: 'actors' or 'movies')
+    sorted by id or by sort (see capstone/pagination.py)
+'''
+def page_response(model, name, fields=None, sort=None):
+    limit, after = get_page_args()
+    encoder = row_encoder(model, fields, json_responses.ensure_ascii)
+    selected = list(encoder.columns)
+    if sort is not None and sort[0].key not in [column.key for column in encoder.columns]:
+        # the key of the cursor, after the encoded columns
+        selected.append(sort[0])
+    statement = keyset_order(select(*selected), model.id, sort, after).limit(limit + 1)
+    rows, next_cursor = keyset_cursor(db.session.execute(statement).all(), limit, model.id, sort)
+    cache_tags(name)
+    if sort is not None:
+        cache_tags(name + ':by_count')
+    tag_ids(model, encoder.ids(rows))
+    return document_response({
+        "success": True,
+        name: encoder.encode_rows(rows),
+        "next_cursor": next_cursor
+    })
+
+
+'''
+related_response(model, row_id, related)
+    the response of GET /actors/<id>/movies (model Actor, related Movie)
+    or GET /movies/<id>/actors (model Movie, related Actor), None if row_id doesn't exist
+'''
+def related_response(model, row_id, related, fields=None):
+    # the total is the count of links of the row (see add_link_counts)
+    count_column = Actor.movie_count if model is Actor else Movie.actor_count
+    row = db.session.execute(select(count_column).where(model.id == row_id)).first()
+    if row is None:
+        return None
+    encoder = row_encoder(related, fields, json_responses.ensure_ascii)
+    statement = select(*encoder.columns).select_from(related) \
+        .join(actor_movie).join(model) \
+        .where(model.id == row_id)
+    rows = db.session.execute(statement).all()
+    name = model.__tablename__.lower()
+    related_name = related.__tablename__.lower() + 's'
+    total = 'totalMovies' if related is Movie else 'totalActors'
+    cache_tags(f'{name}:{row_id}', f'{name}:{row_id}:{related_name}')
+    tag_ids(related, encoder.ids(rows))
+    return document_response({
+        "success": True,
+        f"{name}_id": row_id,
+        total: row[0],
+        related_name: encoder.encode_rows(rows)
+    })
@@ -0,0 +1,45 @@
+from flask import request, abort
+from sqlalchemy.orm import load_only
+
+'''
+Sparse fieldsets (?fields=)
+Only the requested columns are returned, i.e. GET /actors?fields=id,name,
+and only those columns are selected from the database (load_only).
+The id is always returned, it is the key of pages, links and included objects.
+The fields apply to the objects returned by the endpoint, not to the included ones.
+'''
+
+
+def columns(model):
+    return model.__table__.columns.keys()
+
+
+'''
+parse_fields(value, *models)
+    returns the set of columns requested with the fields query parameter value,
+    None when every column is requested
+    aborts with 400 if one of them isn't a column of the models
+'''
+def parse_fields(value, *models):
+    if not value:
+        return None
+    fields = {name.strip() for name in value.split(',') if name.strip()}
+    allowed = set().union(*(columns(model) for model in models))
+    if not fields or not fields.issubset(allowed):
+        abort(400, "invalid fields")
+    return fields | {'id'}
+
+
+def get_fields(*models):
+    return parse_fields(request.args.get('fields', ''), *models)
+
+
+'''
+fields_options(model, fields, *keys)
+    the options of a query of the model that load only the fields,
+    and the keys (columns needed by the endpoint, i.e. the sort column of a page)
+'''
+def fields_options(model, fields, *keys):
+    if fields is None:
+        return []
+    return [load_only(*[getattr(model, name) for name in columns(model) if name in fields or name in keys])]
@@ -0,0 +1,362 @@
+import json
+import time
+import threading
+from array import array
+from flask import current_app
+from sqlalchemy import event, select
+from capstone.models import db, actor_movie, table_version, link_log, RoutingSession
+
+'''
+Graph of the cast
+The links of actor_movie are kept in the process as a bipartite graph of
+actors and movies, to find the shortest chain of co-stars between two actors
+(GET /actors/<a>/path/<b>) without a query per step.
+Each direction (movies of an actor, actors of a movie) is stored in CSR form,
+two integer arrays instead of Python objects (about 4 bytes per link and 8 per id):
+    targets[offsets[id]:offsets[id + 1]]    - the movies of actor id (or actors of movie id)
+Links added or removed after the arrays were built are kept in small sets
+on top of them until they are merged into new arrays (compact).
+The graph is built on the first query from a consistent snapshot of actor_movie,
+and follows the version of actor_movie (table_version):
+    - every transaction that changes actor_movie writes its links to link_log
+      under the new version (see record_link_changes in capstone/models.py)
+    - the transactions of this process apply their links to the graph after the commit
+    - a query that finds the graph behind the database (changed by another worker)
+      applies the versions it missed from link_log, the graph is only rebuilt
+      when they are no longer there (GRAPH_LOG_VERSIONS versions are kept)
+Searches run on the adjacencies of the graph when they start, without the lock:
+the sets of links of a node are replaced rather than changed, and compacted
+adjacencies are new objects.
+'''
+
+
+class CSR:
+    def __init__(self, offsets=None, targets=None):
+        self.offsets = offsets if offsets is not None else array('q', [0])
+        self.targets = targets if targets is not None else array('i')
+        self.view = memoryview(self.targets)
+
+    '''
+    CSR.build(sources, targets)
+        the CSR of the (source, target) pairs of two integer arrays, by a counting sort
+        the targets of a source keep the order of the pairs
+    '''
+    @classmethod
+    def build(cls, sources, targets):
+        size = max(sources) + 1 if sources else 0
+        offsets = array('q', bytes(8 * (size + 1)))
+        for source in sources:
+            offsets[source + 1] += 1
+        for node in range(size):
+            offsets[node + 1] += offsets[node]
+        positions = array('q', offsets)
+        ordered = array('i', bytes(4 * len(targets)))
+        for source, target in zip(sources, targets):
+            ordered[positions[source]] = target
+            positions[source] += 1
+        return cls(offsets, ordered)
+
+    @property
+    def size(self):
+        return len(self.offsets) - 1
+
+    def neighbors(self, node):
+        if node >= len(self.offsets) - 1:
+            return ()
+        return self.view[self.offsets[node]:self.offsets[node + 1]]
+
+    def nbytes(self):
+        return self.offsets.itemsize * len(self.offsets) + self.targets.itemsize * len(self.targets)
+
+
+'''
+Adjacency
+    a CSR with the links added and removed since it was built
+'''
+class Adjacency:
+    def __init__(self, csr=None):
+        self.csr = csr if csr is not None else CSR()
+        # node -> frozenset of targets
+        self.added = {}
+        self.removed = {}
+        self.changes = 0
+
+    def add(self, source, target):
+        removed = self.removed.get(source, frozenset())
+        if target in removed:
+            self.removed[source] = removed - {target}
+        else:
+            self.added[source] = self.added.get(source, frozenset()) | {target}
+        self.changes += 1
+
+    def remove(self, source, target):
+        added = self.added.get(source, frozenset())
+        if target in added:
+            self.added[source] = added - {target}
+        else:
+            self.removed[source] = self.removed.get(source, frozenset()) | {target}
+        self.changes += 1
+
+    def neighbors(self, node):
+        targets = self.csr.neighbors(node)
+        removed = self.removed.get(node)
+        if removed:
+            targets = [target for target in targets if target not in removed]
+        added = self.added.get(node)
+        if added:
+            targets = list(targets) + list(added)
+        return targets
+
+    '''
+    compacted()
+        returns a new Adjacency of the links, with the added and removed links merged into the arrays
+    '''
+    def compacted(self):
+        size = max(self.csr.size, max(self.added, default=-1) + 1)
+        sources, targets = array('i'), array('i')
+        for node in range(size):
+            neighbors = self.neighbors(node)
+            sources.extend([node] * len(neighbors))
+            targets.extend(neighbors)
+        return Adjacency(CSR.build(sources, targets))
+
+    def edges(self):
+        return len(self.csr.targets) + sum(map(len, self.added.values())) \
+            - sum(map(len, self.removed.values()))
+
+
+'''
+load_links(engine)
+    returns (version, actor ids, movie ids) of actor_movie, read in one transaction
+    (REPEATABLE READ on PostgreSQL) so the links are those of the version
+'''
+def load_links(engine):
+    options = {'isolation_level': 'REPEATABLE READ'} if engine.dialect.name == 'postgresql' else {}
+    actor_ids, movie_ids = array('i'), array('i')
+    with engine.connect().execution_options(**options) as connection:
+        with connection.begin():
+            version = connection.execute(select(table_version.c.version)
+                                         .where(table_version.c.name == actor_movie.name)).scalar() or 0
+            # in the order of the primary key, the movies of an actor are sorted
+            result = connection.execution_options(stream_results=True).execute(
+                select(actor_movie.c.actor_id, actor_movie.c.movie_id)
+                .order_by(actor_movie.c.actor_id, actor_movie.c.movie_id))
+            for rows in result.partitions(10000):
+                actor_ids.extend([actor_id for actor_id, _ in rows])
+                movie_ids.extend([movie_id for _, movie_id in rows])
+    return version, actor_ids, movie_ids
+
+
+class CastGraph:
+    def __init__(self, compact_ratio=0.1):
+        # changes are compacted when they are more than compact_ratio of the links
+        self.compact_ratio = compact_ratio
+        self.actors = Adjacency()
+        self.movies = Adjacency()
+        # version of actor_movie the graph is at, None until it is built
+        self.version = None
+        # changes committed while the graph is built, applied after it
+        self.pending = None
+        self.lock = threading.Lock()
+        self.build_lock = threading.Lock()
+        # counters of this process
+        self.builds = 0
+        self.build_seconds = 0.0
+        self.queries = 0
+
+    '''
+    build(actor_ids, movie_ids, version)
+        replaces the graph with the links (actor_ids[i], movie_ids[i])
+    '''
+    def build(self, actor_ids, movie_ids, version=0):
+        start = time.perf_counter()
+        actors = Adjacency(CSR.build(actor_ids, movie_ids))
+        movies = Adjacency(CSR.build(movie_ids, actor_ids))
+        with self.lock:
+            self.actors, self.movies, self.version = actors, movies, version
+            pending, self.pending = self.pending or [], None
+            for changes, changes_version in sorted(pending, key=lambda item: item[1]):
+                self.apply_locked(changes, changes_version)
+            self.builds += 1
+            self.build_seconds = time.perf_counter() - start
+
+    '''
+    refresh(version)
+        brings the graph to version if it is behind (the version of actor_movie read
+        by the request, it may be a replica's), from link_log or else by a rebuild
+    '''
+    def refresh(self, version):
+        if self.version is not None and self.version >= version:
+            return
+        with self.build_lock:
+            # another thread may have built it meanwhile
+            if self.version is not None and self.version >= version:
+                return
+            if self.version is not None:
+                self.catch_up()
+                if self.version >= version:
+                    return
+            with self.lock:
+                self.pending = []
+            try:
+                links_version, actor_ids, movie_ids = load_links(db.engine)
+            except Exception:
+                with self.lock:
+                    self.pending = None
+                raise
+            self.build(actor_ids, movie_ids, links_version)
+
+    '''
+    catch_up()
+        applies the versions after the graph's from link_log, while they follow each other
+    '''
+    def catch_up(self):
+        rows = db.session.execute(select(link_log.c.version, link_log.c.links)
+                                  .where(link_log.c.version > self.version)
+                                  .order_by(link_log.c.version))
+        for version, links in rows:
+            if version != self.version + 1:
+                # removed from the log, or not committed yet
+                break
+            self.apply(json.loads(links), version)
+
+    def tracking(self):
+        return self.version is not None or self.pending is not None
+
+    '''
+    apply(changes, version)
+        applies the changes of the transaction that brought actor_movie to version,
+        changes is a list of ([(actor_id, movie_id)], 1 for linked or -1 for unlinked)
+    '''
+    def apply(self, changes, version):
+        with self.lock:
+            if self.pending is not None:
+                self.pending.append((changes, version))
+            elif self.version is not None:
+                self.apply_locked(changes, version)
+
+    def apply_locked(self, changes, version):
+        if self.version is None or version <= self.version:
+            # already in the links the graph was built from
+            return
+        if version != self.version + 1:
+            # a change of another worker is missing, the next query reads it from link_log
+            return
+        for pairs, sign in changes:
+            for actor_id, movie_id in pairs:
+                if sign > 0:
+                    self.actors.add(actor_id, movie_id)
+                    self.movies.add(movie_id, actor_id)
+                else:
+                    self.actors.remove(actor_id, movie_id)
+                    self.movies.remove(movie_id, actor_id)
+        self.version = version
+        if self.actors.changes > self.compact_ratio * len(self.actors.csr.targets) + 1000:
+            self.actors = self.actors.compacted()
+        if self.movies.changes > self.compact_ratio * len(self.movies.csr.targets) + 1000:
+            self.movies = self.movies.compacted()
+
+    '''
+    shortest_path(source, target)
+        returns the ids [actor, movie, actor, ..., movie, actor] of a shortest chain of
+        co-stars from the actor source to the actor target, None if there is none
+        the graph is searched from both actors at once, the smaller frontier is
+        expanded by one step (actor - movie - actor) at a time
+        the search does not hold the lock, it may see a part of a transaction applied meanwhile
+    '''
+    def shortest_path(self, source, target):
+        if source == target:
+            return [source]
+        with self.lock:
+            self.queries += 1
+            actors, movies = self.actors, self.movies
+        # actor -> (depth, previous actor, movie) for the searches from source and from target
+        parents = ({source: (0, None, None)}, {target: (0, None, None)})
+        frontiers = ([source], [target])
+        seen_movies = (set(), set())
+        while frontiers[0] and frontiers[1]:
+            side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+            own, other = parents[side], parents[1 - side]
+            next_frontier, meeting = [], None
+            for actor in frontiers[side]:
+                depth = own[actor][0] + 1
+                for movie in actors.neighbors(actor):
+                    if movie in seen_movies[side]:
+                        continue
+                    seen_movies[side].add(movie)
+                    for costar in movies.neighbors(movie):
+                        if costar in own:
+                            continue
+                        own[costar] = (depth, actor, movie)
+                        next_frontier.append(costar)
+                        # the meeting closest to the other end is on a shortest path
+                        if costar in other and (meeting is None or other[costar][0] < other[meeting][0]):
+                            meeting = costar
+            if meeting is not None:
+                return self.chain(parents[0], meeting)[::-1] + self.chain(parents[1], meeting)[1:]
+            frontiers = (next_frontier, frontiers[1]) if side == 0 else (frontiers[0], next_frontier)
+        return None
+
+    @staticmethod
+    def chain(parents, actor):
+        # [actor, movie, previous actor, ..., first actor]
+        ids = [actor]
+        _, previous, movie = parents[actor]
+        while previous is not None:
+            ids += [movie, previous]
+            _, previous, movie = parents[previous]
+        return ids
+
+    def stats(self):
+        with self.lock:
+            return {
+                'version': self.version,
+                'links': self.actors.edges(),
+                'changes': self.actors.changes,
+                'bytes': self.actors.csr.nbytes() + self.movies.csr.nbytes(),
+                'builds': self.builds,
+                'build_seconds': round(self.build_seconds, 3),
+                'queries': self.queries
+            }
+
+
+cast_graph = CastGraph()
+
+
+'''
+The changes of actor_movie of a transaction are written to link_log and applied to cast_graph
+once it is committed, the version of actor_movie is read before the commit, in the transaction
+that incremented it (its row is locked until the commit, so the versions follow each other)
+'''
+@event.listens_for(RoutingSession, 'before_commit')
+def log_link_changes(session):
+    if actor_movie.name not in session.info.get('bumped_tables', ()):
+        return
+    version = session.execute(
+        select(table_version.c.version).where(table_version.c.name == actor_movie.name)).scalar()
+    changes = session.info.get('link_changes', [])
+    # a version per increment, the changes are under the last one
+    increments = session.info['bumped_tables'][actor_movie.name]
+    session.execute(link_log.insert(), [
+        {'version': version - increment, 'links': json.dumps(changes if increment == 0 else [])}
+        for increment in range(increments)])
+    kept = current_app.config.get('GRAPH_LOG_VERSIONS', 10000)
+    # the old versions are removed now and then
+    if version % 100 < increments:
+        session.execute(link_log.delete().where(link_log.c.version <= version - kept))
+    if cast_graph.tracking():
+        session.info['links_version'] = version
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def apply_link_changes(session):
+    version = session.info.get('links_version')
+    if version is not None:
+        cast_graph.apply(session.info.get('link_changes', []), version)
+
+
+@event.listens_for(RoutingSession, 'after_transaction_end')
+def forget_link_changes(session, transaction):
+    if transaction.parent is None:
+        for key in ('bumped_tables', 'link_changes', 'links_version'):
+            session.info.pop(key, None)
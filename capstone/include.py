@@ -0,0 +1,30 @@
+from flask import request, abort
+from sqlalchemy.orm import selectinload
+
+'''
+Compound documents (?include=)
+Related objects are embedded in the returned objects when they are
+requested with ?include=, i.e. GET /actors/1?include=movies.
+They are loaded with selectinload: one extra query (WHERE id IN (...))
+for the whole page instead of one query per object.
+'''
+
+
+'''
+get_include(*allowed)
+    returns the set of relationships requested with the include query parameter
+    aborts with 400 if one of them isn't in allowed
+'''
+def get_include(*allowed):
+    return parse_include(request.args.get('include', ''), allowed)
+
+
+def parse_include(value, allowed):
+    include = {name.strip() for name in value.split(',') if name.strip()}
+    if not include.issubset(allowed):
+        abort(400, "invalid include")
+    return include
+
+
+def include_options(model, include):
+    return [selectinload(getattr(model, name)) for name in include]
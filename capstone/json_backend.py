@@ -0,0 +1,151 @@
+from datetime import date, datetime, timezone
+from flask import current_app
+from flask.json import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+'''
+JSON backends of the responses
+Every response body is encoded by the backend selected by JSON_BACKEND:
+    stdlib - the json module with the encoder of the Flask app
+    orjson - orjson, an encoder written in C (pip install orjson)
+    auto   - orjson when it is installed and JSON_AS_ASCII is False, stdlib otherwise (default)
+Both emit the same documents as flask.jsonify: sorted keys, no spaces
+(indented in debug mode or with JSONIFY_PRETTYPRINT_REGULAR), a trailing newline,
+dates and datetimes as HTTP dates.
+orjson always emits UTF-8, non-ASCII characters aren't escaped whatever JSON_AS_ASCII is,
+so auto only picks it when they aren't escaped by stdlib either (same bytes with both).
+The body is encoded to bytes once and handed to the response as is.
+python manage.py benchmark_json compares them on a page of GET /movies.
+'''
+
+
+WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+
+'''
+format_http_date(value)
+    the HTTP date of a date or datetime (naive datetimes are UTC), like werkzeug.http.http_date
+    which is about 20 times slower (it is called for every release_date of a page)
+'''
+def format_http_date(value):
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc)
+        time = (value.hour, value.minute, value.second)
+    else:
+        time = (0, 0, 0)
+    return '%s, %02d %s %04d %02d:%02d:%02d GMT' % (
+        (WEEKDAYS[value.weekday()], value.day, MONTHS[value.month - 1], value.year) + time)
+
+
+'''
+http_default(value)
+    the values the Flask encoder converts and orjson doesn't, as the Flask encoder does
+'''
+def http_default(value):
+    if isinstance(value, date):
+        return format_http_date(value)
+    if hasattr(value, '__html__'):
+        return str(value.__html__())
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+'''
+http_date_encoder(encoder)
+    a subclass of the encoder (i.e. app.json_encoder) with the faster format_http_date
+'''
+def http_date_encoder(encoder):
+    class HTTPDateEncoder(encoder):
+        def default(self, value):
+            if isinstance(value, date):
+                return format_http_date(value)
+            return super().default(value)
+    return HTTPDateEncoder
+
+
+class StdlibBackend:
+    name = 'stdlib'
+
+    def __init__(self, encoder=JSONEncoder, sort_keys=True, ensure_ascii=True):
+        self.ensure_ascii = ensure_ascii
+        encoder = http_date_encoder(encoder)
+        # the encoders are reused, json.dumps builds one per call
+        self.compact = encoder(separators=(',', ':'), sort_keys=sort_keys, ensure_ascii=ensure_ascii)
+        self.pretty = encoder(separators=(', ', ': '), indent=2, sort_keys=sort_keys,
+                              ensure_ascii=ensure_ascii)
+
+    def dumps(self, value, pretty=False):
+        encoder = self.pretty if pretty else self.compact
+        return (encoder.encode(value) + '\n').encode()
+
+
+class OrjsonBackend:
+    name = 'orjson'
+    ensure_ascii = False
+
+    def __init__(self, sort_keys=True):
+        self.options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE
+        if sort_keys:
+            self.options |= orjson.OPT_SORT_KEYS
+
+    def dumps(self, value, pretty=False):
+        options = self.options | orjson.OPT_INDENT_2 if pretty else self.options
+        return orjson.dumps(value, default=http_default, option=options)
+
+
+'''
+create_json_backend(config)
+    returns the backend selected by JSON_BACKEND in the config (a dict, i.e. app.config)
+'''
+def create_json_backend(config, encoder=JSONEncoder):
+    name = config.get('JSON_BACKEND', 'auto')
+    sort_keys = config.get('JSON_SORT_KEYS', True)
+    as_ascii = config.get('JSON_AS_ASCII', True)
+    if name == 'auto':
+        name = 'orjson' if orjson is not None and not as_ascii else 'stdlib'
+    if name == 'orjson':
+        if orjson is None:
+            raise ValueError('JSON_BACKEND is orjson but orjson is not installed')
+        return OrjsonBackend(sort_keys)
+    if name == 'stdlib':
+        return StdlibBackend(encoder, sort_keys, as_ascii)
+    raise ValueError(f'unknown JSON backend {name}')
+
+
+class JSONResponses:
+    def __init__(self):
+        self.backend = StdlibBackend()
+
+    def init_app(self, app):
+        self.backend = create_json_backend(app.config, app.json_encoder)
+
+    @property
+    def ensure_ascii(self):
+        return self.backend.ensure_ascii
+
+    def dumps(self, value, pretty=False):
+        return self.backend.dumps(value, pretty)
+
+
+json_responses = JSONResponses()
+
+
+'''
+jsonify(*args, **kwargs)
+    flask.jsonify with the JSON backend, the body is encoded once to bytes
+'''
+def jsonify(*args, **kwargs):
+    if args and kwargs:
+        raise TypeError('jsonify() behavior undefined when passed both args and kwargs')
+    if len(args) == 1:
+        data = args[0]
+    else:
+        data = args or kwargs
+    pretty = current_app.config['JSONIFY_PRETTYPRINT_REGULAR'] or current_app.debug
+    return current_app.response_class(json_responses.dumps(data, pretty),
+                                      mimetype=current_app.config['JSONIFY_MIMETYPE'])
@@ -0,0 +1,128 @@
+from flask import request, abort, current_app
+from sqlalchemy import tuple_, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
+from capstone.models import db, actor_movie, bump_versions, add_link_counts
+from capstone.cache import invalidate
+
+'''
+Set-based links between actors and movies
+Many (actor_id, movie_id) pairs are linked with a single
+INSERT ... ON CONFLICT DO NOTHING statement and unlinked with a single
+DELETE ... WHERE (actor_id, movie_id) IN (...) statement,
+neither the actors nor the movies are loaded.
+The counts of links of the actors and movies (see add_link_counts) are changed
+by the pairs that were actually linked or unlinked, in the same transaction.
+Only the cached actors and movies of the pairs and their links are invalidated.
+'''
+
+
+'''
+get_link_ids(name)
+    returns the list of ids of the request body, i.e. {"actors": [1, 2]} for name='actors'
+    aborts with 400 if it isn't a non empty list of integers
+'''
+def get_link_ids(name):
+    content = request.get_json(silent=True)
+    ids = content.get(name) if isinstance(content, dict) else None
+    if not isinstance(ids, list) or not ids or \
+            not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+        abort(400, f"{name} must be a non empty list of ids")
+    if len(ids) > current_app.config.get('MAX_BULK_SIZE', 10000):
+        abort(400, "too many ids")
+    return ids
+
+
+def invalidate_links(pairs):
+    if not pairs:
+        return
+    # the counts of links are in the bodies of the actors and movies
+    tags = {'actors:by_count', 'movies:by_count'}
+    for actor_id, movie_id in pairs:
+        tags.update([f'actor:{actor_id}', f'actor:{actor_id}:movies',
+                     f'movie:{movie_id}', f'movie:{movie_id}:actors'])
+    invalidate(*tags)
+
+
+def existing_pairs(pairs):
+    rows = db.session.execute(select(actor_movie.c.actor_id, actor_movie.c.movie_id).where(
+        tuple_(actor_movie.c.actor_id, actor_movie.c.movie_id).in_(pairs)))
+    return {tuple(row) for row in rows}
+
+
+'''
+insert_links(pairs) and delete_links(pairs)
+    return the pairs that were linked (not linked yet) or unlinked (linked)
+    PostgreSQL returns them with RETURNING, other databases (SQLite, which
+    serializes the writes) select the existing pairs first
+'''
+def insert_links(pairs):
+    if db.engine.dialect.name == 'postgresql':
+        statement = postgresql.insert(actor_movie).on_conflict_do_nothing() \
+            .returning(actor_movie.c.actor_id, actor_movie.c.movie_id)
+        result = db.session.execute(statement.values(
+            [{'actor_id': actor_id, 'movie_id': movie_id} for actor_id, movie_id in pairs]))
+        return [tuple(row) for row in result]
+    existing = existing_pairs(pairs)
+    new_pairs = [pair for pair in pairs if pair not in existing]
+    if new_pairs:
+        db.session.execute(actor_movie.insert().values(
+            [{'actor_id': actor_id, 'movie_id': movie_id} for actor_id, movie_id in new_pairs]))
+    return new_pairs
+
+
+def delete_links(pairs):
+    statement = actor_movie.delete().where(
+        tuple_(actor_movie.c.actor_id, actor_movie.c.movie_id).in_(pairs))
+    if db.engine.dialect.name == 'postgresql':
+        result = db.session.execute(statement.returning(actor_movie.c.actor_id, actor_movie.c.movie_id))
+        return [tuple(row) for row in result]
+    old_pairs = list(existing_pairs(pairs))
+    if old_pairs:
+        db.session.execute(statement)
+    return old_pairs
+
+
+'''
+link(pairs)
+    links every (actor_id, movie_id) pair, already linked pairs are ignored
+    returns the number of new links
+    aborts with 404 if one of the actors or movies doesn't exist
+'''
+def link(pairs):
+    try:
+        linked = insert_links(list(set(pairs)))
+        # nothing changed when every pair was already linked, the versions are kept
+        if linked:
+            add_link_counts(linked)
+            bump_versions(actor_movie.name, 'Actor', 'Movie')
+            db.session.commit()
+            invalidate_links(linked)
+        return len(linked)
+    except IntegrityError:
+        # duplicates are ignored, so it is a foreign key violation
+        db.session.rollback()
+        abort(404)
+    finally:
+        db.session.close()
+
+
+'''
+unlink(pairs)
+    removes the links of every (actor_id, movie_id) pair
+    returns the number of removed links
+    aborts with 404 if none of the pairs was linked
+'''
+def unlink(pairs):
+    try:
+        unlinked = delete_links(list(set(pairs)))
+        if unlinked:
+            add_link_counts(unlinked, -1)
+            bump_versions(actor_movie.name, 'Actor', 'Movie')
+            db.session.commit()
+            invalidate_links(unlinked)
+    finally:
+        db.session.close()
+    if not unlinked:
+        abort(404)
+    return len(unlinked)
@@ -1,11 +1,38 @@
 import os
-from flask_sqlalchemy import SQLAlchemy
+import sqlite3
+from datetime import date
+from collections import Counter, defaultdict
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm, func, select, exists
+from sqlalchemy.engine import Engine
+from capstone.pool import engine_options, instrument_engine, warm_up
+from capstone.replicas import request_replica
 # from sqlalchemy import Table, Column, Integer, ForeignKey, String, Date
 
-db = SQLAlchemy()
+'''
+RoutingSession
+    sends the queries of a request to the replica chosen for it (see capstone/replicas.py),
+    flushes (writes) always go to the primary
+'''
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing:
+            replica = request_replica()
+            if replica is not None:
+                return replica.engine
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+    the engine and its connection pool are configured with the DB_* settings (see capstone/pool.py)
 '''
 def setup_db(app):
     # https://stackoverflow.com/questions/54600434/how-to-set-flask-env-inside-config-file
@@ -13,28 +40,152 @@ def setup_db(app):
     # when creating environment variable from command line in Windows don't use quotation marks
     app.config.from_object(os.environ['APP_SETTINGS'])
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
     db.app = app
     db.init_app(app)
+    instrument_engine(db.get_engine(app), app.config)
+    if app.config.get('DB_POOL_WARMUP'):
+        warm_up(db.get_engine(app), app.config['DB_POOL_WARMUP'])
     #db.create_all()
 
+'''
+SQLite doesn't check foreign keys unless it is asked to on every connection,
+the links endpoints rely on them to report unknown actors and movies
+'''
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+'''
+table_version
+    one row per table with a counter that is incremented in the same
+    transaction as every write to the table, it is used to compute the ETags
+    of the GET endpoints without reading the data (see capstone/etag.py)
+'''
+table_version = db.Table('table_version',
+                         db.Column('name', db.String(64), primary_key=True),
+                         db.Column('version', db.BigInteger, nullable=False, default=0)
+                         )
+
+'''
+link_log
+    one row per version of actor_movie with the links it changed, a JSON list of
+    [[[actor_id, movie_id], ...], 1 for linked or -1 for unlinked], written in the
+    transaction that incremented the version, so the workers can follow
+    the changes made by the others (see capstone/graph.py)
+'''
+link_log = db.Table('link_log',
+                    db.Column('version', db.BigInteger, primary_key=True, autoincrement=False),
+                    db.Column('links', db.Text, nullable=False)
+                    )
+
+'''
+bump_versions(*tables)
+    increments the versions of the tables (names) in the current transaction
+    the rows are locked in the order of the names, so concurrent transactions can't deadlock
+'''
+def bump_versions(*tables):
+    # the number of increments of the tables by the transaction (see capstone/graph.py)
+    db.session.info.setdefault('bumped_tables', Counter()).update(set(tables))
+    for name in sorted(set(tables)):
+        result = db.session.execute(
+            table_version.update()
+            .where(table_version.c.name == name)
+            .values(version=table_version.c.version + 1))
+        if result.rowcount == 0:
+            db.session.execute(table_version.insert().values(name=name, version=1))
+
+'''
+get_versions(tables)
+    returns the current versions of the tables (names), in the same order
+'''
+def get_versions(tables):
+    rows = db.session.execute(
+        db.select([table_version.c.name, table_version.c.version])
+        .where(table_version.c.name.in_(tables)))
+    versions = dict(rows.fetchall())
+    return [versions.get(name, 0) for name in tables]
+
 # https://flask-sqlalchemy.palletsprojects.com/en/2.x/models/
 
 '''
 Extend the base Model class to add common methods
+every write increments the version of the table,
+rows are changed and deleted by id (update_by_id, delete_by_id), without loading them,
+a delete also increments the versions of the linked table and the association tables
 '''
 class ModelIUD(db.Model):
     __abstract__ = True
 
+    @classmethod
+    def association_tables(cls):
+        return [rel.secondary.name for rel in cls.__mapper__.relationships
+                if rel.secondary is not None]
+
     def insert(self):
         db.session.add(self)
+        bump_versions(self.__tablename__)
         db.session.commit()
 
-    def update(self):
+    '''
+    parse_patch(content)
+        returns the column values of a PATCH request from the JSON content,
+        only the columns of PATCH_COLUMNS can be changed
+        raises ValueError if a column isn't allowed or a value isn't valid
+    '''
+    @classmethod
+    def parse_patch(cls, content):
+        if not isinstance(content, dict) or not content:
+            raise ValueError("patch must be a non empty JSON object")
+        unknown = sorted(set(content) - set(cls.PATCH_COLUMNS))
+        if unknown:
+            raise ValueError("these columns can't be changed: " + ', '.join(unknown))
+        return cls.parse(content, partial=True)
+
+    @classmethod
+    def exists(cls, row_id):
+        return db.session.query(cls.id).filter(cls.id == row_id).first() is not None
+
+    '''
+    update_by_id(row_id, values) and delete_by_id(row_id)
+        change the row without loading it and commit,
+        return False (and roll back) if there is no row with this id
+        update_by_id is a single UPDATE, delete_by_id deletes the row with its links
+        and decrements the counts of the rows it was linked to (see delete_with_links),
+        it returns their ids or None if there is no row with this id
+    '''
+    @classmethod
+    def update_by_id(cls, row_id, values):
+        table = cls.__table__
+        result = db.session.execute(table.update().where(table.c.id == row_id).values(values))
+        if result.rowcount == 0:
+            db.session.rollback()
+            return False
+        bump_versions(cls.__tablename__)
         db.session.commit()
+        return True
 
-    def delete(self):
-        db.session.delete(self)
+    @classmethod
+    def delete_by_id(cls, row_id):
+        linked_model, linked_ids = delete_with_links(cls, row_id)
+        if linked_ids is None:
+            db.session.rollback()
+            return None
+        bump_versions(cls.__tablename__, linked_model.__tablename__, *cls.association_tables())
         db.session.commit()
+        return linked_ids
+
+    '''
+    format_columns(fields)
+        returns the columns of the object, only the ones in fields if it isn't None
+        (the other columns may not be loaded, see capstone/fields.py)
+    '''
+    def format_columns(self, fields=None):
+        return {name: getattr(self, name) for name in self.__table__.columns.keys()
+                if fields is None or name in fields}
 
 '''
 Movie
@@ -42,48 +193,251 @@ Movie
 '''
 class Movie(ModelIUD):
     __tablename__ = 'Movie'
+    __table_args__ = (
+        # pages sorted by number of actors (keyset on actor_count, id)
+        db.Index('ix_Movie_actor_count_id', 'actor_count', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
-    title = db.Column(db.String, nullable=False)
-    release_date = db.Column(db.Date)
+    title = db.Column(db.String, nullable=False, index=True)
+    release_date = db.Column(db.Date, index=True)
+    # number of actors of the movie, see add_link_counts
+    actor_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    # columns a PATCH request can change
+    PATCH_COLUMNS = ('title', 'release_date')
+    # columns GET /movies can be sorted by (see capstone/pagination.py)
+    SORT_COLUMNS = ('actor_count',)
 
-    actors = db.relationship('Actor', secondary='actor_movie', lazy='subquery',
-                             backref=db.backref('movies', lazy='subquery'))
+    # relationships are loaded lazily,
+    # endpoints load them with selectinload when they are included (see ?include=)
+    # the links of a deleted actor or movie are deleted with it by delete_with_links
+    # (ON DELETE CASCADE also deletes them when the row is deleted outside of the app),
+    # passive_deletes: they aren't loaded to be deleted one by one
+    actors = db.relationship('Actor', secondary='actor_movie', lazy='select', passive_deletes=True,
+                             backref=db.backref('movies', lazy='select', passive_deletes=True))
 
     def __init__(self, title, release_date=None):
         self.title = title
         self.release_date = release_date
 
-    def format(self):
-        return {
-            'id': self.id,
-            'title': self.title,
-            'release_date': self.release_date
-        }
+    '''
+    parse(content, partial)
+        returns the column values of a new movie from the JSON content,
+        only the ones in the content if partial (PATCH)
+        raises ValueError if they aren't valid
+    '''
+    @staticmethod
+    def parse(content, partial=False):
+        if not isinstance(content, dict):
+            raise ValueError("movie must be a JSON object")
+        values = {}
+        if not partial or 'title' in content:
+            title = content.get('title')
+            if not isinstance(title, str) or title.strip() == "":
+                raise ValueError("title of the movie isn't specified")
+            values['title'] = title
+        if not partial or 'release_date' in content:
+            release_date = content.get('release_date')
+            if release_date is not None:
+                try:
+                    release_date = date.fromisoformat(release_date)
+                except (TypeError, ValueError):
+                    raise ValueError("release_date must be a YYYY-MM-DD date")
+            values['release_date'] = release_date
+        return values
+
+    def format(self, include=(), fields=None):
+        movie = self.format_columns(fields)
+        if 'actors' in include:
+            movie['actors'] = [actor.format() for actor in self.actors]
+        return movie
 
 class Actor(ModelIUD):
     __tablename__ = 'Actor'
+    __table_args__ = (
+        # pages sorted by number of movies (keyset on movie_count, id)
+        db.Index('ix_Actor_movie_count_id', 'movie_count', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String, nullable=False)
+    name = db.Column(db.String, nullable=False, index=True)
     age = db.Column(db.Integer)
     gender = db.Column(db.String(50))
+    # number of movies of the actor, see add_link_counts
+    movie_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    # columns a PATCH request can change
+    PATCH_COLUMNS = ('name', 'age', 'gender')
+    # columns GET /actors can be sorted by (see capstone/pagination.py)
+    SORT_COLUMNS = ('movie_count',)
 
     def __init__(self, name, age=None, gender=None):
         self.name = name
         self.age = age
         self.gender = gender
 
-    def format(self):
-        return {
-            'id': self.id,
-            'name': self.name,
-            'age': self.age,
-            'gender': self.gender
-        }
+    '''
+    parse(content, partial)
+        returns the column values of a new actor from the JSON content,
+        only the ones in the content if partial (PATCH)
+        raises ValueError if they aren't valid
+    '''
+    @staticmethod
+    def parse(content, partial=False):
+        if not isinstance(content, dict):
+            raise ValueError("actor must be a JSON object")
+        values = {}
+        if not partial or 'name' in content:
+            name = content.get('name')
+            if not isinstance(name, str) or name.strip() == "":
+                raise ValueError("name of the actor isn't specified")
+            values['name'] = name
+        if not partial or 'age' in content:
+            age = content.get('age')
+            if age is not None:
+                try:
+                    age = int(age)
+                except (TypeError, ValueError):
+                    raise ValueError("age must be an integer")
+            values['age'] = age
+        if not partial or 'gender' in content:
+            gender = content.get('gender')
+            if gender is not None and (not isinstance(gender, str) or len(gender) > 50):
+                raise ValueError("gender must be a string of at most 50 characters")
+            values['gender'] = gender
+        return values
+
+    def format(self, include=(), fields=None):
+        actor = self.format_columns(fields)
+        if 'movies' in include:
+            actor['movies'] = [movie.format() for movie in self.movies]
+        return actor
 
 
 actor_movie = db.Table('actor_movie',
-                       db.Column('actor_id', db.Integer, db.ForeignKey('Actor.id'), primary_key=True),
-                       db.Column('movie_id', db.Integer, db.ForeignKey('Movie.id'), primary_key=True)
+                       db.Column('actor_id', db.Integer, db.ForeignKey('Actor.id', ondelete='CASCADE'),
+                                 primary_key=True),
+                       db.Column('movie_id', db.Integer, db.ForeignKey('Movie.id', ondelete='CASCADE'),
+                                 primary_key=True),
+                       # the primary key (actor_id, movie_id) can't be used to find actors of a movie
+                       db.Index('ix_actor_movie_movie_id_actor_id', 'movie_id', 'actor_id')
                        )
+
+'''
+Counts of links
+Actor.movie_count and Movie.actor_count are the numbers of links of the actor
+or movie, they are changed in the transaction of every change of actor_movie:
+    add_link_counts(pairs, sign)     - after (actor_id, movie_id) pairs are linked (1) or unlinked (-1)
+    delete_with_links(model, row_id) - deletes an actor or movie with its links
+The counters are incremented, not recomputed, so concurrent transactions don't lose updates.
+repair_link_counts() recomputes them (python manage.py repair_counts).
+The changed pairs are also recorded in the session (record_link_changes), they are applied
+to the graph of the cast once the transaction is committed (see capstone/graph.py).
+'''
+
+# (column of actor_movie, model it refers to, counter of links of the model)
+LINK_COUNTERS = [
+    (actor_movie.c.actor_id, Actor, 'movie_count'),
+    (actor_movie.c.movie_id, Movie, 'actor_count'),
+]
+
+
+def increment_counter(model, counter, deltas):
+    # one statement per distinct delta, usually a single one
+    table = model.__table__
+    ids_by_delta = defaultdict(list)
+    for row_id, delta in deltas.items():
+        ids_by_delta[delta].append(row_id)
+    for delta, ids in ids_by_delta.items():
+        db.session.execute(table.update()
+                           .where(table.c.id.in_(ids))
+                           .values({counter: table.c[counter] + delta}))
+
+
+def record_link_changes(pairs, sign):
+    if pairs:
+        db.session.info.setdefault('link_changes', []).append((pairs, sign))
+
+
+def add_link_counts(pairs, sign=1):
+    record_link_changes(pairs, sign)
+    for index, (_, model, counter) in enumerate(LINK_COUNTERS):
+        deltas = Counter()
+        for pair in pairs:
+            deltas[pair[index]] += sign
+        if deltas:
+            increment_counter(model, counter, deltas)
+
+
+'''
+delete_with_links(model, row_id)
+    deletes the row of the model and its links, and decrements the counters of the rows
+    it was linked to, returns (model of the linked rows, their ids), the ids are None
+    if there is no row with this id
+    on PostgreSQL, in two statements:
+        - the row is locked (SELECT ... FOR UPDATE), which blocks the foreign key check
+          of a concurrent link until the transaction ends
+        - the links are deleted, the counters decremented and the row deleted at once:
+              WITH links AS (DELETE FROM actor_movie ... RETURNING ...),
+                   counts AS (UPDATE <linked table> ... FROM (SELECT ... FROM links GROUP BY ...)),
+                   deleted AS (DELETE FROM <table> ...)
+              SELECT ids of links
+          the statement starts after the lock, it sees every link committed before it
+    SQLite serializes the writes, the links are selected then deleted
+    (ON DELETE CASCADE is left to the rows deleted outside of the app)
+'''
+def delete_with_links(model, row_id):
+    (column, _, _), (linked_column, linked_model, counter) = \
+        LINK_COUNTERS if LINK_COUNTERS[0][1] is model else reversed(LINK_COUNTERS)
+    table, linked_table = model.__table__, linked_model.__table__
+    statement = actor_movie.delete().where(column == row_id)
+    if db.engine.dialect.name == 'postgresql':
+        if db.session.execute(select(table.c.id).where(table.c.id == row_id).with_for_update()).first() is None:
+            return linked_model, None
+        links = statement.returning(linked_column).cte('links')
+        grouped = select(links.c[linked_column.name].label('id'), func.count().label('links')) \
+            .group_by(links.c[linked_column.name]).subquery()
+        counts = linked_table.update() \
+            .where(linked_table.c.id == grouped.c.id) \
+            .values({counter: linked_table.c[counter] - grouped.c.links}) \
+            .returning(linked_table.c.id).cte('counts')
+        deleted = table.delete().where(table.c.id == row_id).returning(table.c.id).cte('deleted')
+        linked_ids = [linked_id for linked_id, in db.session.execute(
+            select(counts.c.id).where(exists(select(deleted.c.id))))]
+    else:
+        linked_ids = [linked_id for linked_id, in
+                      db.session.execute(select(linked_column).where(column == row_id))]
+        if linked_ids:
+            db.session.execute(statement)
+            increment_counter(linked_model, counter, {linked_id: -1 for linked_id in linked_ids})
+        if db.session.execute(table.delete().where(table.c.id == row_id)).rowcount == 0:
+            return linked_model, None
+    if linked_ids:
+        record_link_changes([(row_id, linked_id) if linked_model is Movie else (linked_id, row_id)
+                             for linked_id in linked_ids], -1)
+    return linked_model, linked_ids
+
+
+'''
+repair_link_counts(chunk_size)
+    recomputes the counters that are wrong and commits,
+    returns {table name: ids of the repaired rows}
+'''
+def repair_link_counts(chunk_size=1000):
+    repaired = {}
+    for column, model, counter in LINK_COUNTERS:
+        table = model.__table__
+        actual = select(func.count()).select_from(actor_movie) \
+            .where(column == table.c.id).scalar_subquery()
+        ids = [row_id for row_id, in db.session.execute(
+            select(table.c.id).where(table.c[counter] != actual).order_by(table.c.id))]
+        for start in range(0, len(ids), chunk_size):
+            db.session.execute(table.update()
+                               .where(table.c.id.in_(ids[start:start + chunk_size]))
+                               .values({counter: actual}))
+        repaired[model.__tablename__] = ids
+    bump_versions(*[name for name, ids in repaired.items() if ids])
+    db.session.commit()
+    return repaired
+
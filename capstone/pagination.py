@@ -0,0 +1,139 @@
+import json
+import base64
+from flask import request, abort, current_app
+from sqlalchemy import tuple_
+
+'''
+Keyset (cursor) pagination helpers
+A page is selected by the key of the last row of the previous page
+(WHERE id > :after ORDER BY id LIMIT n), so every page is an index range scan
+with the same cost regardless of its depth.
+The cursor is an opaque url-safe string, clients just pass back next_cursor.
+Pages sorted by another column (?sort=) are selected by the key (column, id),
+i.e. WHERE (movie_count, id) > (:count, :id) ORDER BY movie_count, id.
+'''
+
+
+def encode_cursor(values):
+    data = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def decode_cursor(cursor):
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(data)
+    except ValueError:
+        abort(400, "invalid cursor")
+    if not isinstance(values, list):
+        abort(400, "invalid cursor")
+    return values
+
+
+'''
+get_page_args()
+    returns (limit, after) from the limit and cursor query parameters,
+    after is the list of key values encoded in the cursor or None for the first page
+'''
+def get_page_args():
+    return parse_page_args(request.args, current_app.config)
+
+
+'''
+parse_page_args(args, config)
+    get_page_args() of the query parameters args (a dict) and the app config
+'''
+def parse_page_args(args, config):
+    try:
+        limit = int(args.get('limit', config.get('PAGE_SIZE', 50)))
+    except ValueError:
+        abort(400, "invalid limit")
+    if limit < 1:
+        abort(400, "invalid limit")
+    limit = min(limit, config.get('MAX_PAGE_SIZE', 500))
+
+    cursor = args.get('cursor')
+    after = decode_cursor(cursor) if cursor else None
+    return limit, after
+
+
+'''
+get_sort(model)
+    returns the order of the pages of the model requested with ?sort=:
+    None for the default order by id, (column, descending) for sort=<column>
+    or sort=-<column> (descending), the column must be one of model.SORT_COLUMNS
+'''
+def get_sort(model):
+    return parse_sort(request.args.get('sort'), model)
+
+
+def parse_sort(value, model):
+    if not value or value == 'id':
+        return None
+    descending = value.startswith('-')
+    name = value[1:] if descending else value
+    if name not in model.SORT_COLUMNS:
+        abort(400, "invalid sort")
+    return getattr(model, name), descending
+
+
+'''
+sort_keys(sort)
+    returns the names of the columns the rows of a sorted page need besides their fields
+'''
+def sort_keys(sort):
+    return [] if sort is None else [sort[0].key]
+
+
+'''
+keyset_cursor(rows, limit, column, sort)
+    returns (rows, next_cursor) of the limit + 1 rows fetched for a page
+'''
+def keyset_cursor(rows, limit, column, sort=None):
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        values = [getattr(rows[-1], column.key)]
+        if sort is not None:
+            values.insert(0, getattr(rows[-1], sort[0].key))
+        next_cursor = encode_cursor(values)
+    return rows, next_cursor
+
+
+def check_keyset_after(after, size=1):
+    if len(after) != size or not all(isinstance(value, int) for value in after):
+        abort(400, "invalid cursor")
+
+
+'''
+keyset_order(query, column, sort, after)
+    orders the query (Query or select) by column, or by the sort column then column,
+    and selects the rows after the key values of the cursor (after) if it isn't None
+'''
+def keyset_order(query, column, sort=None, after=None):
+    if sort is None:
+        if after is not None:
+            check_keyset_after(after)
+            query = query.where(column > after[0])
+        return query.order_by(column)
+    sort_column, descending = sort
+    if after is not None:
+        check_keyset_after(after, 2)
+        key = tuple_(sort_column, column)
+        query = query.where(key < tuple_(*after) if descending else key > tuple_(*after))
+    if descending:
+        return query.order_by(sort_column.desc(), column.desc())
+    return query.order_by(sort_column, column)
+
+
+'''
+paginate(query, column, sort)
+    applies the keyset condition for the current request to the query ordered by column
+    (or by sort, see get_sort), returns (rows, next_cursor), next_cursor is None on the last page
+'''
+def paginate(query, column, sort=None):
+    limit, after = get_page_args()
+    query = keyset_order(query, column, sort, after)
+    # fetch one extra row to know whether there is a next page
+    rows = query.limit(limit + 1).all()
+    return keyset_cursor(rows, limit, column, sort)
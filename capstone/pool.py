@@ -0,0 +1,192 @@
+import time
+import logging
+import threading
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool, NullPool
+
+'''
+Database connection pool
+The engine and pool options are read from the DB_* settings of the config
+(see config_app.py), they are only applied to PostgreSQL.
+    DB_POOL=queue    - a pool of DB_POOL_SIZE connections per worker, plus up to
+                       DB_MAX_OVERFLOW connections that are closed when returned
+    DB_POOL=null     - a connection per transaction, for a PgBouncer in front
+                       of the database that does the pooling
+    DB_PGBOUNCER=1   - PgBouncer in transaction pooling mode: no connection
+                       startup options (statement_timeout is set by transaction)
+psycopg2 doesn't prepare statements on the server, so the queries don't rely
+on a session of the server outliving a transaction.
+'''
+
+
+class PoolStats:
+    def __init__(self):
+        self.connects = 0
+        self.checkouts = 0
+        self.invalidations = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.lock = threading.Lock()
+
+    def add_wait(self, seconds, timed_out=False):
+        with self.lock:
+            self.wait_time += seconds
+            self.max_wait_time = max(self.max_wait_time, seconds)
+            if timed_out:
+                self.timeouts += 1
+
+    def count(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def stats(self, pool=None):
+        with self.lock:
+            stats = {
+                'connects': self.connects,
+                'checkouts': self.checkouts,
+                'invalidations': self.invalidations,
+                'timeouts': self.timeouts,
+                'wait_time': round(self.wait_time, 6),
+                'max_wait_time': round(self.max_wait_time, 6),
+                'avg_wait_time': round(self.wait_time / self.checkouts, 6) if self.checkouts else 0
+            }
+        if isinstance(pool, QueuePool):
+            stats.update({
+                'size': pool.size(),
+                'checked_in': pool.checkedin(),
+                'checked_out': pool.checkedout(),
+                'overflow': pool.overflow()
+            })
+        return stats
+
+
+pool_stats = PoolStats()
+
+
+'''
+TimedQueuePool
+    QueuePool measuring how long a checkout waits for a connection
+'''
+class TimedQueuePool(QueuePool):
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            pool_stats.add_wait(time.perf_counter() - start, timed_out=True)
+            raise
+        pool_stats.add_wait(time.perf_counter() - start)
+        return connection
+
+
+def is_postgresql(config):
+    return config['SQLALCHEMY_DATABASE_URI'].startswith('postgresql')
+
+
+'''
+engine_options(config)
+    returns the SQLAlchemy engine options of the DB_* settings of the config
+'''
+def engine_options(config):
+    if not is_postgresql(config):
+        return {}
+    connect_args = {}
+    if config.get('DB_CONNECT_TIMEOUT'):
+        connect_args['connect_timeout'] = config['DB_CONNECT_TIMEOUT']
+    if config.get('DB_STATEMENT_TIMEOUT') and not config.get('DB_PGBOUNCER'):
+        connect_args['options'] = '-c statement_timeout=%d' % config['DB_STATEMENT_TIMEOUT']
+    options = {
+        'pool_pre_ping': config.get('DB_POOL_PRE_PING', True),
+        'connect_args': connect_args
+    }
+    if config.get('DB_POOL', 'queue') == 'null':
+        options['poolclass'] = NullPool
+    else:
+        options.update({
+            'poolclass': TimedQueuePool,
+            'pool_size': config.get('DB_POOL_SIZE', 5),
+            'max_overflow': config.get('DB_MAX_OVERFLOW', 10),
+            'pool_timeout': config.get('DB_POOL_TIMEOUT', 30),
+            'pool_recycle': config.get('DB_POOL_RECYCLE', -1)
+        })
+    return options
+
+
+'''
+instrument_engine(engine, config)
+    counts the pool events in pool_stats, and behind PgBouncer
+    sets the statement timeout at the beginning of every transaction
+'''
+def instrument_engine(engine, config):
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        pool_stats.count('connects')
+
+    @event.listens_for(engine, 'checkout')
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        pool_stats.count('checkouts')
+
+    @event.listens_for(engine, 'invalidate')
+    def on_invalidate(dbapi_connection, connection_record, exception):
+        pool_stats.count('invalidations')
+
+    if is_postgresql(config) and config.get('DB_PGBOUNCER') and config.get('DB_STATEMENT_TIMEOUT'):
+        statement = 'SET LOCAL statement_timeout = %d' % config['DB_STATEMENT_TIMEOUT']
+
+        @event.listens_for(engine, 'begin')
+        def on_begin(connection):
+            connection.exec_driver_sql(statement)
+
+
+'''
+warm_up(engine, count)
+    opens count connections of the pool at the start of the worker,
+    so the first requests don't wait for them
+'''
+def warm_up(engine, count):
+    connections = []
+    try:
+        for _ in range(count):
+            connections.append(engine.connect())
+    except exc.SQLAlchemyError:
+        logging.exception('unable to warm up the connection pool')
+    finally:
+        for connection in connections:
+            connection.close()
+    return len(connections)
+
+
+'''
+async_engine_options(config)
+    engine options of the async engine (asyncpg) of the ASGI app, from the same DB_* settings
+    asyncpg prepares every statement: behind PgBouncer in transaction pooling mode
+    the statement caches are disabled (PgBouncer 1.21+ with max_prepared_statements is needed)
+'''
+def async_engine_options(config):
+    connect_args = {}
+    if config.get('DB_CONNECT_TIMEOUT'):
+        connect_args['timeout'] = config['DB_CONNECT_TIMEOUT']
+    if config.get('DB_PGBOUNCER'):
+        connect_args['prepared_statement_cache_size'] = 0
+        connect_args['statement_cache_size'] = 0
+    elif config.get('DB_STATEMENT_TIMEOUT'):
+        connect_args['server_settings'] = {'statement_timeout': str(config['DB_STATEMENT_TIMEOUT'])}
+    options = {
+        'pool_pre_ping': config.get('DB_POOL_PRE_PING', True),
+        'connect_args': connect_args
+    }
+    if config.get('DB_POOL', 'queue') == 'null':
+        options['poolclass'] = NullPool
+    else:
+        options.update({
+            'pool_size': config.get('DB_POOL_SIZE', 5),
+            'max_overflow': config.get('DB_MAX_OVERFLOW', 10),
+            'pool_timeout': config.get('DB_POOL_TIMEOUT', 30),
+            'pool_recycle': config.get('DB_POOL_RECYCLE', -1)
+        })
+    return options
+
+
+def async_database_url(uri):
+    return uri.replace('postgresql://', 'postgresql+asyncpg://', 1)
@@ -0,0 +1,174 @@
+import time
+import logging
+import threading
+from flask import request, g, has_request_context
+from sqlalchemy import event, exc
+
+'''
+Read replicas
+The GET requests read from the replicas configured with DATABASE_REPLICA_URLS
+(SQLALCHEMY_BINDS 'replica1', 'replica2', ...), chosen round-robin,
+every other request uses the primary database, so every write does.
+A request reads from the primary instead when
+    - no replica is healthy, or all of them lag more than REPLICA_MAX_LAG seconds
+      (checked at most every REPLICA_CHECK_INTERVAL seconds)
+    - the client (subject of the token) wrote less than READ_YOUR_WRITES_SECONDS ago,
+      so it reads its own writes (recorded in the cache backend, it should be
+      shared when there are several workers, see capstone/cache_backends.py)
+The choice is made once per request, so a request reads a consistent snapshot.
+'''
+
+# seconds the replica is behind the primary:
+#   - 0 when it streams from the primary and has replayed everything it received
+#     (an idle primary doesn't make a replica lag)
+#   - the age of the last replayed transaction when the WAL receiver isn't streaming
+#     (connection to the primary lost), it grows until the replica is skipped
+#   - NULL (unhealthy) when the replica never received WAL from a primary
+# the status of pg_stat_wal_receiver is only visible to members of pg_read_all_stats
+LAG_QUERY = '''
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN pg_last_wal_receive_lsn() IS NULL THEN NULL
+    WHEN receiver.status = 'streaming' AND pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+END
+FROM (SELECT 1) AS one LEFT JOIN pg_stat_wal_receiver AS receiver ON true
+'''
+
+
+class Replica:
+    def __init__(self, name, engine):
+        self.name = name
+        self.engine = engine
+        self.healthy = True
+        self.lag = 0.0
+        self.checked_at = None
+        self.errors = 0
+        self.reads = 0
+
+
+class ReplicaPool:
+    def __init__(self, max_lag=5, check_interval=5, read_your_writes=10):
+        self.replicas = []
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.read_your_writes = read_your_writes
+        self.backend = None
+        self.next = 0
+        self.fallbacks = 0
+        self.lock = threading.Lock()
+
+    def init_app(self, app, db, backend):
+        self.max_lag = app.config.get('REPLICA_MAX_LAG', self.max_lag)
+        self.check_interval = app.config.get('REPLICA_CHECK_INTERVAL', self.check_interval)
+        self.read_your_writes = app.config.get('READ_YOUR_WRITES_SECONDS', self.read_your_writes)
+        self.backend = backend
+        names = sorted(name for name in app.config.get('SQLALCHEMY_BINDS') or {}
+                       if name.startswith('replica'))
+        self.replicas = [self.add_replica(name, db.get_engine(app, bind=name)) for name in names]
+        app.after_request(self.record_write)
+
+    def add_replica(self, name, engine):
+        replica = Replica(name, engine)
+
+        @event.listens_for(engine, 'handle_error')
+        def on_error(context):
+            # a lost replica isn't used until it is checked again
+            if context.is_disconnect:
+                replica.healthy = False
+                replica.checked_at = time.monotonic()
+        return replica
+
+    def check(self, replica):
+        replica.checked_at = time.monotonic()
+        try:
+            with replica.engine.connect() as connection:
+                if replica.engine.dialect.name == 'postgresql':
+                    lag = connection.exec_driver_sql(LAG_QUERY).scalar()
+                else:
+                    lag = connection.exec_driver_sql('SELECT 0').scalar()
+            if lag is None:
+                logging.warning('read replica %s is not replicating', replica.name)
+                replica.healthy = False
+                return
+            replica.lag = float(lag)
+            replica.healthy = True
+        except exc.SQLAlchemyError:
+            logging.exception('read replica %s is unavailable', replica.name)
+            replica.healthy = False
+            replica.errors += 1
+
+    def available(self, replica):
+        if replica.checked_at is None or time.monotonic() - replica.checked_at > self.check_interval:
+            self.check(replica)
+        return replica.healthy and replica.lag <= self.max_lag
+
+    '''
+    choose()
+        returns the next available replica, None if the primary must be used
+    '''
+    def choose(self):
+        for _ in range(len(self.replicas)):
+            with self.lock:
+                replica = self.replicas[self.next % len(self.replicas)]
+                self.next += 1
+            if self.available(replica):
+                replica.reads += 1
+                return replica
+        with self.lock:
+            self.fallbacks += 1
+        return None
+
+    def subject(self):
+        payload = g.get('auth_payload')
+        return payload.get('sub') if payload else None
+
+    def wrote_recently(self):
+        subject = self.subject()
+        return subject is not None and self.backend is not None and \
+            self.backend.get('writer:' + subject) is not None
+
+    def record_write(self, response):
+        subject = self.subject()
+        if self.replicas and request.method not in ('GET', 'HEAD', 'OPTIONS') \
+                and response.status_code < 400 and subject is not None:
+            self.backend.set('writer:' + subject, b'1', self.read_your_writes)
+        return response
+
+    def stats(self):
+        return {
+            'fallbacks': self.fallbacks,
+            'replicas': [{
+                'name': replica.name,
+                'healthy': replica.healthy,
+                'lag': replica.lag,
+                'reads': replica.reads,
+                'errors': replica.errors
+            } for replica in self.replicas]
+        }
+
+
+replica_pool = ReplicaPool()
+
+
+'''
+request_replica()
+    returns the replica the current request reads from, None for the primary
+'''
+def request_replica():
+    if not replica_pool.replicas or not has_request_context():
+        return None
+    if 'db_replica' not in g:
+        replica = None
+        if request.method in ('GET', 'HEAD') and not replica_pool.wrote_recently():
+            replica = replica_pool.choose()
+        g.db_replica = replica
+    return g.db_replica
+
+
+'''
+staleness()
+    returns how many seconds the data read by the current request may be behind the primary
+'''
+def staleness():
+    return replica_pool.max_lag if request_replica() is not None else 0
@@ -0,0 +1,103 @@
+import re
+from difflib import SequenceMatcher
+from flask import request, abort
+from sqlalchemy import func, or_, literal_column
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from capstone.models import db, Actor, Movie
+from capstone.pagination import encode_cursor, get_page_args
+
+'''
+Search of actors by name and movies by title
+On PostgreSQL every word of the query is matched as a prefix against the
+tsvector of the name/title (GIN expression index, the query uses the same
+expression as the index, see search_vector), and the whole query is matched
+fuzzily against the name/title with pg_trgm (GIN trigram index),
+results are ranked by the best of both scores.
+Other databases (i.e. SQLite test databases) are searched in the process
+with the same rules, it reads every name/title so it is only meant for tests.
+Search pages are selected by offset, the rank isn't a stable key.
+'''
+
+# same default as pg_trgm.similarity_threshold
+SIMILARITY_THRESHOLD = 0.3
+
+
+def search_column(model):
+    return {Actor: Actor.name, Movie: Movie.title}[model]
+
+
+'''
+search_vector(model)
+    the tsvector of the name/title, the expression of the index ix_<table>_search_vector
+'''
+def search_vector(model):
+    return func.to_tsvector(literal_column("'simple'"),
+                            func.coalesce(search_column(model), literal_column("''")), type_=TSVECTOR)
+
+
+def get_terms(q):
+    return re.findall(r'\w+', q.lower())
+
+
+def get_search_args():
+    q = request.args.get('q', '')
+    if not get_terms(q):
+        abort(400, "search query must contain a word")
+    limit, after = get_page_args()
+    offset = 0
+    if after is not None:
+        if len(after) != 1 or not isinstance(after[0], int) or after[0] < 0:
+            abort(400, "invalid cursor")
+        offset = after[0]
+    return q, limit, offset
+
+
+def search_postgresql(query, model, q, limit, offset):
+    column = search_column(model)
+    terms = get_terms(q)
+    tsquery = func.to_tsquery('simple', ' & '.join(term + ':*' for term in terms))
+    vector = search_vector(model)
+    rank = func.greatest(func.ts_rank(vector, tsquery), func.similarity(column, q))
+    rows = query.filter(or_(vector.op('@@')(tsquery), column.op('%')(q))) \
+        .order_by(rank.desc(), model.id) \
+        .offset(offset) \
+        .limit(limit + 1) \
+        .all()
+    return rows
+
+
+def score(terms, q, text):
+    words = get_terms(text)
+    if all(any(word.startswith(term) for word in words) for term in terms):
+        return 1.0
+    similarity = SequenceMatcher(None, q.lower(), text.lower()).ratio()
+    return similarity if similarity >= SIMILARITY_THRESHOLD else 0
+
+
+def search_in_process(query, model, q, limit, offset):
+    column = search_column(model)
+    terms = get_terms(q)
+    scores = []
+    for row_id, text in db.session.query(model.id, column):
+        text_score = score(terms, q, text)
+        if text_score > 0:
+            scores.append((-text_score, row_id))
+    ids = [row_id for _, row_id in sorted(scores)[offset:offset + limit + 1]]
+    rows = {row.id: row for row in query.filter(model.id.in_(ids))}
+    return [rows[row_id] for row_id in ids]
+
+
+'''
+search(query, model, q, limit, offset)
+    returns (rows, next_cursor), the page of rows of the query matching q, best first
+'''
+def search(query, model, q, limit, offset):
+    if db.engine.dialect.name == 'postgresql':
+        rows = search_postgresql(query, model, q, limit, offset)
+    else:
+        rows = search_in_process(query, model, q, limit, offset)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([offset + limit])
+    return rows, next_cursor
@@ -0,0 +1,73 @@
+import threading
+
+'''
+Single-flight request coalescing
+Concurrent calls with the same key share one execution: the first caller
+(the leader) runs the function, the callers arriving while it runs
+(the followers) wait for it and receive its result instead of running it again.
+It flattens the spikes of identical queries after a cache invalidation.
+Calls are coalesced between the threads of a process (gunicorn --threads),
+every worker process still runs its own leader.
+'''
+
+
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.failed = False
+
+
+class SingleFlight:
+    def __init__(self, timeout=10):
+        # max number of seconds a follower waits before running the function itself
+        self.timeout = timeout
+        self.flights = {}
+        self.leaders = 0
+        self.followers = 0
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        self.timeout = app.config.get('COALESCE_TIMEOUT', self.timeout)
+
+    '''
+    do(key, fn)
+        returns (result, shared), the result of fn() or of the call
+        with the same key in flight, shared is True for the followers
+        if the leader fails or is too slow the follower calls fn() itself
+    '''
+    def do(self, key, fn):
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+                self.leaders += 1
+        if not leader:
+            if flight.done.wait(self.timeout) and not flight.failed:
+                with self.lock:
+                    self.followers += 1
+                return flight.result, True
+            return fn(), False
+
+        try:
+            flight.result = fn()
+        except BaseException:
+            flight.failed = True
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+        return flight.result, False
+
+    def stats(self):
+        with self.lock:
+            return {
+                'leaders': self.leaders,
+                'followers': self.followers,
+                'in_flight': len(self.flights)
+            }
+
+
+single_flight = SingleFlight()
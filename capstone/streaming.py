@@ -0,0 +1,67 @@
+from flask import request, current_app, Response, stream_with_context
+from sqlalchemy.orm import lazyload
+from capstone.json_backend import json_responses
+from capstone.pagination import keyset_order
+
+'''
+Streaming mode for the list endpoints
+Rows are read from a server-side cursor by batches (yield_per)
+and sent to the client as soon as they are serialized,
+so the memory of a worker stays flat whatever the size of the table.
+    - Accept: application/x-ndjson  - one JSON object per line
+    - ?stream=1                     - the same JSON document as the paged response
+                                      (same order, sorted keys), sent in chunks
+                                      (next_cursor is always null)
+Rows are in the order of the pages, ?sort= included.
+'''
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+
+def wants_ndjson():
+    return request.accept_mimetypes.best == NDJSON_MIMETYPE
+
+
+def wants_stream():
+    return wants_ndjson() or request.args.get('stream', '0') not in ('0', 'false', '')
+
+
+def iter_rows(query, column, sort=None):
+    batch_size = current_app.config.get('STREAM_BATCH_SIZE', 1000)
+    # relationships that aren't included must not be eagerly loaded per batch
+    return keyset_order(query.options(lazyload('*')), column, sort) \
+        .execution_options(stream_results=True) \
+        .yield_per(batch_size)
+
+
+def generate_ndjson(rows, include, fields=None):
+    for row in rows:
+        yield json_responses.dumps(row.format(include, fields))
+
+
+def generate_document(rows, name, include, fields=None):
+    # the keys in order, as in the paged documents (the name of a list is before next_cursor)
+    yield '{"%s":[' % name
+    separator = b''
+    for row in rows:
+        # without the trailing newline
+        yield separator + json_responses.dumps(row.format(include, fields))[:-1]
+        separator = b','
+    yield '],"next_cursor":null,"success":true}\n'
+
+
+'''
+stream_response(query, column, name, include, fields, sort)
+    returns a streamed response with every row of the query ordered by column
+    (or by sort, see capstone.pagination.get_sort),
+    name is the key of the list in the JSON document (i.e. 'actors'),
+    include is the set of relationships embedded in every row (see capstone.include),
+    fields the set of columns of every row (see capstone.fields)
+'''
+def stream_response(query, column, name, include=(), fields=None, sort=None):
+    rows = iter_rows(query, column, sort)
+    if wants_ndjson():
+        return Response(stream_with_context(generate_ndjson(rows, include, fields)),
+                        mimetype=NDJSON_MIMETYPE)
+    return Response(stream_with_context(generate_document(rows, name, include, fields)),
+                    mimetype='application/json')
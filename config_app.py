@@ -2,11 +2,81 @@ import os
 
 # https: // flask.palletsprojects.com / en / 2.0.x / config /
 
+def env_flag(name, default):
+    return os.environ.get(name, default).lower() in ('1', 'true', 'yes', 'on')
+
+
 class Config(object):
     DEBUG = False
     TESTING = False
     SECRET_KEY = os.environ.get('SECRET_KEY', 'default_sekret')
     SQLALCHEMY_DATABASE_URI = os.environ['DATABASE_URL']
+    # comma separated URLs of read replicas used by the GET requests (see capstone/replicas.py)
+    DATABASE_REPLICA_URLS = [url.strip() for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+                             if url.strip()]
+    SQLALCHEMY_BINDS = {'replica%d' % index: url for index, url in enumerate(DATABASE_REPLICA_URLS, 1)}
+    # seconds a replica may lag behind the primary, and between two checks of the lag
+    REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG', 5))
+    REPLICA_CHECK_INTERVAL = float(os.environ.get('REPLICA_CHECK_INTERVAL', 5))
+    # seconds a client reads from the primary after a write
+    READ_YOUR_WRITES_SECONDS = int(os.environ.get('READ_YOUR_WRITES_SECONDS', 10))
+    # connection pool of each worker (PostgreSQL only, see capstone/pool.py)
+    # queue: DB_POOL_SIZE connections kept open, null: a connection per transaction
+    DB_POOL = os.environ.get('DB_POOL', 'queue')
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+    # seconds a request waits for a connection of the pool
+    DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+    # seconds after which a connection is replaced (-1: never)
+    DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+    # test connections with a round trip when they are checked out
+    DB_POOL_PRE_PING = env_flag('DB_POOL_PRE_PING', '1')
+    # number of connections opened at the start of a worker
+    DB_POOL_WARMUP = int(os.environ.get('DB_POOL_WARMUP', 0))
+    # seconds to establish a connection, milliseconds a statement may run (0: no limit)
+    DB_CONNECT_TIMEOUT = int(os.environ.get('DB_CONNECT_TIMEOUT', 10))
+    DB_STATEMENT_TIMEOUT = int(os.environ.get('DB_STATEMENT_TIMEOUT', 0))
+    # the database is behind a PgBouncer in transaction pooling mode
+    DB_PGBOUNCER = env_flag('DB_PGBOUNCER', '0')
+    # default and max number of items in a page of GET /actors and GET /movies
+    PAGE_SIZE = int(os.environ.get('PAGE_SIZE', 50))
+    MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 500))
+    # number of rows fetched from the server-side cursor at once in streaming mode
+    STREAM_BATCH_SIZE = int(os.environ.get('STREAM_BATCH_SIZE', 1000))
+    # max number of items in a POST /actors/bulk or POST /movies/bulk request
+    MAX_BULK_SIZE = int(os.environ.get('MAX_BULK_SIZE', 10000))
+    # max total size and max size of one response body in the response cache, in bytes
+    RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+    RESPONSE_CACHE_MAX_ENTRY_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRY_BYTES', 1024 * 1024))
+    # seconds a response stays in the cache (0: until it is evicted or invalidated)
+    RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 0))
+    # cache backend of the response cache and the JWKS cache: memory, mmap or redis
+    CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'memory')
+    # file mapped by all the workers of the host with the mmap backend
+    SHARED_CACHE_PATH = os.environ.get('SHARED_CACHE_PATH', '/dev/shm/capstone-cache')
+    SHARED_CACHE_SLOT_SIZE = int(os.environ.get('SHARED_CACHE_SLOT_SIZE', 64 * 1024))
+    # redis://[:password@]host[:port][/db] with the redis backend
+    CACHE_URL = os.environ.get('CACHE_URL', 'redis://localhost:6379/0')
+    # max seconds a value is kept by the redis backend, even without RESPONSE_CACHE_TTL
+    CACHE_MAX_TTL = int(os.environ.get('CACHE_MAX_TTL', 86400))
+    # seconds the redis backend isn't tried again after a failed connection
+    CACHE_RETRY_INTERVAL = float(os.environ.get('CACHE_RETRY_INTERVAL', 5))
+    # max seconds a request waits for an identical request in flight before running itself
+    COALESCE_TIMEOUT = float(os.environ.get('COALESCE_TIMEOUT', 10))
+    # versions of actor_movie kept in link_log for the graphs of the other workers (see capstone/graph.py)
+    GRAPH_LOG_VERSIONS = int(os.environ.get('GRAPH_LOG_VERSIONS', 10000))
+    # serve the pages and the related lists without ORM instances (see capstone/fastpath.py)
+    FAST_READ_PATH = env_flag('FAST_READ_PATH', '1')
+    # encoder of the response bodies: auto, orjson or stdlib (see capstone/json_backend.py)
+    JSON_BACKEND = os.environ.get('JSON_BACKEND', 'auto')
+    # responses of at least COMPRESS_MIN_SIZE bytes are compressed (see capstone/compression.py)
+    # with the comma separated COMPRESS_ENCODINGS (zstd, br, gzip, default: the installed ones)
+    COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+    COMPRESS_ENCODINGS = [name.strip() for name in os.environ['COMPRESS_ENCODINGS'].split(',') if name.strip()] \
+        if 'COMPRESS_ENCODINGS' in os.environ else None
+    COMPRESS_GZIP_LEVEL = int(os.environ.get('COMPRESS_GZIP_LEVEL', 6))
+    COMPRESS_BROTLI_LEVEL = int(os.environ.get('COMPRESS_BROTLI_LEVEL', 5))
+    COMPRESS_ZSTD_LEVEL = int(os.environ.get('COMPRESS_ZSTD_LEVEL', 3))
 
 class ProductionConfig(Config):
     DEBUG = False
@@ -14,6 +84,8 @@ class ProductionConfig(Config):
     if uri and uri.startswith("postgres://"):
         uri = uri.replace("postgres://", "postgresql://", 1)
     SQLALCHEMY_DATABASE_URI = uri
+    SQLALCHEMY_BINDS = {name: url.replace("postgres://", "postgresql://", 1) if url.startswith("postgres://") else url
+                        for name, url in Config.SQLALCHEMY_BINDS.items()}
 
 class DevelopmentConfig(Config):
     DEVELOPMENT = True
@@ -6,5 +6,102 @@ from flask_migrate import MigrateCommand, Manager
 manager = Manager(create_app)
 manager.add_command('db', MigrateCommand)
 
+
+@manager.option('-c', '--chunk-size', dest='chunk_size', type=int, default=1000,
+                help='rows updated per statement')
+def repair_counts(chunk_size):
+    """Recomputes the numbers of movies of the actors and of actors of the movies"""
+    from capstone.models import repair_link_counts
+    from capstone.cache import invalidate
+    repaired = repair_link_counts(chunk_size)
+    # with a shared cache backend the workers stop serving the old counts
+    invalidate('actors:by_count', 'movies:by_count',
+               *[f'actor:{actor_id}' for actor_id in repaired['Actor']],
+               *[f'movie:{movie_id}' for movie_id in repaired['Movie']])
+    print(f"repaired movie_count of {len(repaired['Actor'])} actors "
+          f"and actor_count of {len(repaired['Movie'])} movies")
+
+
+@manager.option('-n', '--movies', dest='count', type=int, default=500, help='movies in the page')
+@manager.option('-r', '--repeat', dest='repeat', type=int, default=200, help='responses per backend')
+def benchmark_json(count, repeat):
+    """Times the body of a page of GET /movies with every JSON backend"""
+    import timeit
+    from datetime import date, timedelta
+    import flask
+    from capstone.json_backend import json_responses, jsonify, create_json_backend, orjson
+    from capstone.models import Movie
+
+    movies = [movie.format() for movie in Movie.query.order_by(Movie.id).limit(count)]
+    # the page is completed with made up movies when the table is too small
+    for index in range(len(movies), count):
+        movies.append({'id': index + 1, 'title': f'Movie {index + 1}',
+                       'release_date': date(1970, 1, 1) + timedelta(days=index * 37)})
+    page = {'success': True, 'movies': movies, 'next_cursor': 'eyJhZnRlciI6IFs1MDBdfQ=='}
+
+    def run(make_response):
+        seconds = min(timeit.repeat(lambda: make_response(page).get_data(), number=repeat, repeat=3))
+        return seconds / repeat * 1e6, len(make_response(page).get_data())
+
+    baseline, size = run(flask.jsonify)
+    print(f'{len(movies)} movies, {repeat} responses per backend')
+    print(f'{"flask.jsonify":<15}{baseline:>10.1f} us{size:>10} bytes')
+    backend = json_responses.backend
+    try:
+        for name in ['stdlib', 'orjson']:
+            if name == 'orjson' and orjson is None:
+                print(f'{name:<15}   not installed')
+                continue
+            json_responses.backend = create_json_backend(dict(flask.current_app.config, JSON_BACKEND=name))
+            elapsed, size = run(jsonify)
+            print(f'{name:<15}{elapsed:>10.1f} us{size:>10} bytes'
+                  f'{baseline - elapsed:>10.1f} us saved per response ({baseline / elapsed:.1f}x)')
+    finally:
+        json_responses.backend = backend
+
+
+@manager.option('-a', '--actors', dest='actors', type=int, default=1000000, help='actors of the graph')
+@manager.option('-m', '--movies', dest='movies', type=int, default=200000, help='movies of the graph')
+@manager.option('-l', '--links', dest='links', type=int, default=3000000, help='links of the graph')
+@manager.option('-q', '--queries', dest='queries', type=int, default=200, help='paths searched')
+def benchmark_graph(actors, movies, links, queries):
+    """Times the graph of the cast on a synthetic graph (build, memory, paths, changes)"""
+    import time
+    import random
+    import statistics
+    from array import array
+    from capstone.graph import CastGraph
+
+    rng = random.Random(0)
+    # a few actors and movies have most of the links, as in a real cast
+    actor_ids = array('i', [int(actors * rng.random() ** 2) + 1 for _ in range(links)])
+    movie_ids = array('i', [int(movies * rng.random() ** 2) + 1 for _ in range(links)])
+    graph = CastGraph()
+    start = time.perf_counter()
+    graph.build(actor_ids, movie_ids, version=0)
+    print(f'{links} links of {actors} actors and {movies} movies')
+    print(f'build           {time.perf_counter() - start:>10.2f} s')
+    print(f'arrays          {graph.stats()["bytes"] / 2 ** 20:>10.1f} MiB')
+
+    timings, degrees = [], []
+    for _ in range(queries):
+        source, target = rng.choice(actor_ids), rng.choice(actor_ids)
+        start = time.perf_counter()
+        path = graph.shortest_path(source, target)
+        timings.append((time.perf_counter() - start) * 1000)
+        if path is not None:
+            degrees.append(len(path) // 2)
+    timings.sort()
+    print(f'path            {statistics.mean(timings):>10.2f} ms mean'
+          f'{timings[len(timings) // 2]:>10.2f} ms median{timings[-1]:>10.2f} ms max')
+    if degrees:
+        print(f'degrees         {statistics.mean(degrees):>10.2f} mean, {len(degrees)} of {queries} connected')
+
+    start = time.perf_counter()
+    for version in range(1, 1001):
+        graph.apply([([(rng.choice(actor_ids), rng.choice(movie_ids))], 1)], version)
+    print(f'link            {(time.perf_counter() - start) * 1000:>10.3f} us per link applied')
+
+
 if __name__ == "__main__":
     manager.run()
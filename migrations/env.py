@@ -25,6 +25,16 @@ config.set_main_option(
     str(current_app.extensions['migrate'].db.engine.url).replace('%', '%%'))
 target_metadata = current_app.extensions['migrate'].db.metadata
 
+# search indexes are PostgreSQL only and aren't declared in the models
+# (see migration 5c2e9d41a7f3), autogenerate ignores them
+SEARCH_OBJECTS = {'ix_Actor_search_vector', 'ix_Movie_search_vector',
+                  'ix_Actor_name_trgm', 'ix_Movie_title_trgm'}
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    return not (reflected and name in SEARCH_OBJECTS)
+
+
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
@@ -45,7 +55,8 @@ def run_migrations_offline():
     """
     url = config.get_main_option("sqlalchemy.url")
     context.configure(
-        url=url, target_metadata=target_metadata, literal_binds=True
+        url=url, target_metadata=target_metadata, literal_binds=True,
+        include_object=include_object
     )
 
     with context.begin_transaction():
@@ -77,6 +88,7 @@ def run_migrations_online():
             connection=connection,
             target_metadata=target_metadata,
             process_revision_directives=process_revision_directives,
+            include_object=include_object,
             **current_app.extensions['migrate'].configure_args
         )
 
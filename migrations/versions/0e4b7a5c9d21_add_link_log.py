@@ -0,0 +1,28 @@
+"""add link_log
+
+Revision ID: 0e4b7a5c9d21
+Revises: f6b1c2d8a934
+Create Date: 2026-10-18 21:07:42.519360
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0e4b7a5c9d21'
+down_revision = 'f6b1c2d8a934'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('link_log',
+    sa.Column('version', sa.BigInteger(), autoincrement=False, nullable=False),
+    sa.Column('links', sa.Text(), nullable=False),
+    sa.PrimaryKeyConstraint('version')
+    )
+
+
+def downgrade():
+    op.drop_table('link_log')
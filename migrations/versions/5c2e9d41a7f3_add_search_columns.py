@@ -0,0 +1,53 @@
+"""add search columns
+
+Revision ID: 5c2e9d41a7f3
+Revises: 847a82c19b25
+Create Date: 2026-10-18 11:03:17.482961
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c2e9d41a7f3'
+down_revision = '847a82c19b25'
+branch_labels = None
+depends_on = None
+
+
+# (table, searched column)
+SEARCHED = [
+    ('Actor', 'name'),
+    ('Movie', 'title'),
+]
+
+
+def upgrade():
+    # full-text and trigram search only exist on PostgreSQL,
+    # other databases are searched in the process (see capstone/search.py)
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    # the tsvector is an index expression rather than a column: the tables aren't
+    # rewritten and the queries must use the same expression (see capstone/search.py)
+    with op.get_context().autocommit_block():
+        for table, column in SEARCHED:
+            op.create_index(f'ix_{table}_search_vector', table,
+                            [sa.text(f"to_tsvector('simple', coalesce({column}, ''))")],
+                            postgresql_using='gin',
+                            postgresql_concurrently=True)
+            op.create_index(f'ix_{table}_{column}_trgm', table, [column],
+                            postgresql_using='gin',
+                            postgresql_ops={column: 'gin_trgm_ops'},
+                            postgresql_concurrently=True)
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    for table, column in SEARCHED:
+        op.drop_index(f'ix_{table}_{column}_trgm', table_name=table)
+        op.drop_index(f'ix_{table}_search_vector', table_name=table)
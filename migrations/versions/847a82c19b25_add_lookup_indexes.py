@@ -0,0 +1,41 @@
+"""add lookup indexes
+
+Revision ID: 847a82c19b25
+Revises: 393edb22138d
+Create Date: 2026-10-18 10:12:41.305217
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '847a82c19b25'
+down_revision = '393edb22138d'
+branch_labels = None
+depends_on = None
+
+
+# (index name, table, columns)
+INDEXES = [
+    ('ix_actor_movie_movie_id_actor_id', 'actor_movie', ['movie_id', 'actor_id']),
+    ('ix_Actor_name', 'Actor', ['name']),
+    ('ix_Movie_title', 'Movie', ['title']),
+    ('ix_Movie_release_date', 'Movie', ['release_date']),
+]
+
+
+def upgrade():
+    # CREATE INDEX CONCURRENTLY doesn't lock writes on a live database,
+    # but PostgreSQL can't run it inside a transaction
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, unique=False,
+                            postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns in reversed(INDEXES):
+            op.drop_index(name, table_name=table,
+                          postgresql_concurrently=True)
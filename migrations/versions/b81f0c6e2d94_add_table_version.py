@@ -0,0 +1,33 @@
+"""add table_version
+
+Revision ID: b81f0c6e2d94
+Revises: 5c2e9d41a7f3
+Create Date: 2026-10-18 12:20:54.118304
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b81f0c6e2d94'
+down_revision = '5c2e9d41a7f3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    table_version = op.create_table('table_version',
+    sa.Column('name', sa.String(length=64), nullable=False),
+    sa.Column('version', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    op.bulk_insert(table_version, [
+        {'name': 'Actor', 'version': 0},
+        {'name': 'Movie', 'version': 0},
+        {'name': 'actor_movie', 'version': 0},
+    ])
+
+
+def downgrade():
+    op.drop_table('table_version')
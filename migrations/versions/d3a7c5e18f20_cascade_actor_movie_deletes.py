@@ -0,0 +1,56 @@
+"""cascade actor_movie deletes
+
+Revision ID: d3a7c5e18f20
+Revises: b81f0c6e2d94
+Create Date: 2026-10-18 18:02:41.730512
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3a7c5e18f20'
+down_revision = 'b81f0c6e2d94'
+branch_labels = None
+depends_on = None
+
+
+# (column of actor_movie, referred table)
+FOREIGN_KEYS = [
+    ('actor_id', 'Actor'),
+    ('movie_id', 'Movie'),
+]
+
+# the names PostgreSQL gave to the foreign keys of the first revision,
+# the unnamed foreign keys of SQLite are reflected with the same names
+NAMING_CONVENTION = {'fk': '%(table_name)s_%(column_0_name)s_fkey'}
+
+
+def recreate_foreign_keys(ondelete):
+    if op.get_bind().dialect.name == 'postgresql':
+        # NOT VALID doesn't scan actor_movie while the table is locked,
+        # the links are validated afterwards without blocking writes
+        for column, table in FOREIGN_KEYS:
+            name = f'actor_movie_{column}_fkey'
+            op.execute(f'ALTER TABLE actor_movie DROP CONSTRAINT {name}, '
+                       f'ADD CONSTRAINT {name} FOREIGN KEY ({column}) REFERENCES "{table}" (id)'
+                       + (f' ON DELETE {ondelete}' if ondelete else '') + ' NOT VALID')
+        with op.get_context().autocommit_block():
+            for column, _ in FOREIGN_KEYS:
+                op.execute(f'ALTER TABLE actor_movie VALIDATE CONSTRAINT actor_movie_{column}_fkey')
+        return
+
+    # other databases (SQLite) recreate the table
+    with op.batch_alter_table('actor_movie', naming_convention=NAMING_CONVENTION) as batch_op:
+        for column, table in FOREIGN_KEYS:
+            name = f'actor_movie_{column}_fkey'
+            batch_op.drop_constraint(name, type_='foreignkey')
+            batch_op.create_foreign_key(name, table, [column], ['id'], ondelete=ondelete)
+
+
+def upgrade():
+    recreate_foreign_keys('CASCADE')
+
+
+def downgrade():
+    recreate_foreign_keys(None)
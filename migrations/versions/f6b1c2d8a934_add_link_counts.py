@@ -0,0 +1,44 @@
+"""add link counts
+
+Revision ID: f6b1c2d8a934
+Revises: d3a7c5e18f20
+Create Date: 2026-10-18 18:41:09.264817
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f6b1c2d8a934'
+down_revision = 'd3a7c5e18f20'
+branch_labels = None
+depends_on = None
+
+
+# (table, counter, column of actor_movie referring to the table)
+COUNTERS = [
+    ('Actor', 'movie_count', 'actor_id'),
+    ('Movie', 'actor_count', 'movie_id'),
+]
+
+
+def upgrade():
+    for table, counter, column in COUNTERS:
+        op.add_column(table, sa.Column(counter, sa.Integer(), nullable=False, server_default='0'))
+        op.execute(f'UPDATE "{table}" SET {counter} = '
+                   f'(SELECT count(*) FROM actor_movie WHERE actor_movie.{column} = "{table}".id)')
+
+    with op.get_context().autocommit_block():
+        for table, counter, _ in COUNTERS:
+            op.create_index(f'ix_{table}_{counter}_id', table, [counter, 'id'], unique=False,
+                            postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for table, counter, _ in reversed(COUNTERS):
+            op.drop_index(f'ix_{table}_{counter}_id', table_name=table,
+                          postgresql_concurrently=True)
+    for table, counter, _ in reversed(COUNTERS):
+        op.drop_column(table, counter)
@@ -0,0 +1,104 @@
+import time
+import threading
+import socketserver
+
+'''
+RESPServer
+An in-process stand-in of a Redis server for the tests of RedisBackend,
+it speaks the Redis protocol (RESP) and implements GET, SET (with PX),
+MGET, INCR, AUTH and SELECT on a dict.
+'''
+class RESPHandler(socketserver.StreamRequestHandler):
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:-2])):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    @staticmethod
+    def encode(value):
+        if value is True:
+            return b'+OK\r\n'
+        if value is None:
+            return b'$-1\r\n'
+        if isinstance(value, int):
+            return b':%d\r\n' % value
+        if isinstance(value, list):
+            return b'*%d\r\n' % len(value) + b''.join(RESPHandler.encode(item) for item in value)
+        return b'$%d\r\n%s\r\n' % (len(value), value)
+
+    def handle(self):
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            self.server.commands += 1
+            try:
+                method = getattr(self.server, 'command_' + args[0].decode().lower())
+                reply = self.encode(method(*args[1:]))
+            except (AttributeError, TypeError, ValueError):
+                reply = b'-ERR unsupported command ' + args[0] + b'\r\n'
+            self.wfile.write(reply)
+
+
+class RESPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), RESPHandler)
+        self.values = {}
+        self.commands = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address
+        return f'redis://{host}:{port}/0'
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def _get(self, key):
+        value, expires_at = self.values.get(key, (None, None))
+        if expires_at is not None and expires_at <= time.time():
+            del self.values[key]
+            return None
+        return value
+
+    def command_get(self, key):
+        with self.lock:
+            return self._get(key)
+
+    def command_mget(self, *keys):
+        with self.lock:
+            return [self._get(key) for key in keys]
+
+    def command_set(self, key, value, *options):
+        expires_at = None
+        if options and options[0].upper() == b'PX':
+            expires_at = time.time() + int(options[1]) / 1000
+        with self.lock:
+            self.values[key] = (value, expires_at)
+        return True
+
+    def command_incr(self, key):
+        with self.lock:
+            value = int(self._get(key) or 0) + 1
+            self.values[key] = (str(value).encode(), None)
+        return value
+
+    def command_auth(self, *args):
+        return True
+
+    def command_select(self, db):
+        return True
@@ -1,10 +1,27 @@
 import os
+import sys
+import time
+import tempfile
+import threading
 import unittest
+import subprocess
 import json
+from array import array
 from flask_sqlalchemy import SQLAlchemy
 
 from capstone import create_app
-from capstone.models import Actor, Movie, db
+from capstone.models import Actor, Movie, db, repair_link_counts, get_versions, bump_versions
+from capstone.graph import CastGraph, cast_graph
+from capstone.auth import AuthError, JWKSCache, ClaimsCache
+from capstone.cache import ResponseCache, response_cache
+from capstone.cache_backends import MemoryBackend, MmapBackend, RedisBackend
+from capstone.singleflight import SingleFlight
+from capstone.json_backend import StdlibBackend, OrjsonBackend, orjson, create_json_backend
+from capstone.compression import Compression, compression
+from capstone.pool import TimedQueuePool, engine_options, pool_stats
+from capstone.replicas import ReplicaPool
+from sqlalchemy import create_engine, event, exc
+from test_app.resp_server import RESPServer
 from sqlalchemy import func
 
 class CapstoneTestCase(unittest.TestCase):
@@ -46,6 +63,32 @@ class CapstoneTestCase(unittest.TestCase):
 
     # Unit Tests
 
+    def test_search(self):
+        """Test searching actors and movies by a word prefix"""
+        res = self.client().get('/search?q=fath',
+                                headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['actors'], [])
+        self.assertEqual([movie['title'] for movie in data['movies']], ['Father Brown'])
+
+    def test_400_if_search_query_is_empty(self):
+        """Test searching without a query, should return 400 error"""
+        res = self.client().get('/search?q=',
+                                headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_search_actors(self):
+        """Gets the /actors endpoint with a search query"""
+        res = self.client().get('/actors?q=ale',
+                                headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(sorted(actor['name'] for actor in data['actors']), ['Alen', 'Alex'])
+
     # For actors
     def test_create_new_actor(self):
         """Test creating of an actor"""
@@ -89,6 +132,51 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(data['description'], 'Permission not found')
 
 
+    def test_create_actors_bulk(self):
+        """Test creating of many actors at once, invalid ones are reported"""
+        num_actors_before = Actor.query.count()
+        res = self.client().post('/actors/bulk',
+                                 headers={'Authorization': 'Bearer ' + self.CASTING_DIRECTOR},
+                                 json=[self.new_actor, {'name': ''}, {'name': 'Linda Hamilton', 'age': 65}])
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual([item['index'] for item in data['added']], [0, 2])
+        self.assertEqual([error['index'] for error in data['errors']], [1])
+        self.assertEqual(Actor.query.count(), num_actors_before + 2)
+        actor = Actor.query.get(data['added'][1]['id'])
+        self.assertEqual(actor.name, 'Linda Hamilton')
+        # remove the new actors, other tests rely on the number of actors
+        Actor.query.filter(Actor.id.in_([item['id'] for item in data['added']])) \
+            .delete(synchronize_session=False)
+        db.session.commit()
+
+    def test_create_movies_bulk_ndjson(self):
+        """Test creating of many movies at once from an NDJSON body"""
+        body = '\n'.join(json.dumps(movie) for movie in [
+            self.new_movie,
+            {'title': 'Terminator 2', 'release_date': 'July 1991'}
+        ])
+        res = self.client().post('/movies/bulk',
+                                 headers={'Authorization': 'Bearer ' + self.EXECUTIVE_PRODUCER},
+                                 data=body, content_type='application/x-ndjson')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['added']), 1)
+        self.assertEqual(data['errors'][0]['index'], 1)
+        Movie.query.filter(Movie.id == data['added'][0]['id']).delete(synchronize_session=False)
+        db.session.commit()
+
+    def test_403_if_created_actors_bulk_by_CASTING_ASSISTANT(self):
+        """Test creating of many actors by CASTING_ASSISTANT who is not authorized to that,
+         should return 403 error"""
+        res = self.client().post('/actors/bulk',
+                                 headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT},
+                                 json=[self.new_actor])
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(data['code'], 'unauthorized')
+
     def test_get_actors(self):
         """Gets the /actors endpoint and checks valid results"""
         res = self.client().get('/actors',
@@ -98,6 +186,148 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertEqual(len(data['actors']), 4)
 
+    def test_get_actors_pages(self):
+        """Gets the /actors endpoint page by page using next_cursor"""
+        res = self.client().get('/actors?limit=2',
+                                headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([actor['id'] for actor in data['actors']], [1, 2])
+        self.assertIsNotNone(data['next_cursor'])
+
+        res = self.client().get('/actors?limit=2&cursor=' + data['next_cursor'],
+                                headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([actor['id'] for actor in data['actors']], [5, 6])
+
+    def test_get_actors_sorted_by_movie_count(self):
+        """Gets the /actors endpoint by number of movies, page by page"""
+        actors = []
+        cursor = ''
+        while cursor is not None:
+            res = self.client().get('/actors?sort=-movie_count&limit=2' + cursor,
+                                    headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT})
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            actors += data['actors']
+            cursor = data['next_cursor'] and '&cursor=' + data['next_cursor']
+        keys = [(actor['movie_count'], actor['id']) for actor in actors]
+        self.assertEqual(keys, sorted(keys, reverse=True))
+        self.assertEqual(len({actor['id'] for actor in actors}), len(actors))
+        with self.app.app_context():
+            self.assertEqual(len(actors), Actor.query.count())
+
+    def test_400_get_actors_if_sort_is_invalid(self):
+        """Test getting actors sorted by a column that can't be sorted, should return 400 error"""
+        res = self.client().get('/actors?sort=name',
+                                headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_400_get_actors_if_limit_is_invalid(self):
+        """Test getting actors with a limit that isn't a positive integer, should return 400 error"""
+        for limit in ['abc', '0']:
+            res = self.client().get('/actors?limit=' + limit,
+                                    headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT})
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(data['success'], False)
+
+    def test_400_get_actors_if_cursor_is_invalid(self):
+        """Test getting actors with a malformed cursor, should return 400 error"""
+        res = self.client().get('/actors?cursor=foo',
+                                headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_get_actors_ndjson_stream(self):
+        """Gets all actors from the /actors endpoint as NDJSON"""
+        res = self.client().get('/actors',
+                                headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT,
+                                         'Accept': 'application/x-ndjson'})
+        actors = [json.loads(line) for line in res.data.splitlines()]
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual(len(actors), Actor.query.count())
+
+    def test_304_get_actors_if_not_modified(self):
+        """Test getting actors again with the ETag of the previous response"""
+        res = self.client().get('/actors',
+                                headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT})
+        etag = res.headers['ETag']
+        res = self.client().get('/actors',
+                                headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT,
+                                         'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+    def test_etag_changes_when_actor_is_updated(self):
+        """Test that updating an actor changes the ETag of the actor"""
+        res = self.client().get('/actors/2',
+                                headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT})
+        etag = res.headers['ETag']
+        self.client().patch('/actors/2',
+                            headers={'Authorization': 'Bearer ' + self.CASTING_DIRECTOR},
+                            json={'age': 13})
+        res = self.client().get('/actors/2',
+                                headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT,
+                                         'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_get_actors_from_cache(self):
+        """Test that the second identical request is served from the cache"""
+        res = self.client().get('/actors/1',
+                                headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT})
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        res = self.client().get('/actors/1',
+                                headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT})
+        data = json.loads(res.data)
+        self.assertEqual(res.headers['X-Cache'], 'HIT')
+        self.assertEqual(data['actor']['id'], 1)
+
+    def test_get_actors_compressed(self):
+        """Test that a large response is compressed once and keeps a matching ETag"""
+        import gzip
+        compression.min_size = 0
+        headers = {'Authorization': 'Bearer ' + self.CASTING_ASSISTANT, 'Accept-Encoding': 'gzip'}
+        plain = self.client().get('/actors?compressed=0',
+                                  headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT})
+        res = self.client().get('/actors?compressed=1', headers=headers)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(gzip.decompress(res.data), plain.data)
+        etag = res.headers['ETag']
+        self.assertTrue(etag.endswith('-gzip"'))
+        cache_hits = compression.stats()['cache_hits']
+        res = self.client().get('/actors?compressed=1', headers=headers)
+        self.assertEqual(res.headers['X-Cache'], 'HIT')
+        self.assertEqual(compression.stats()['cache_hits'], cache_hits + 1)
+        res = self.client().get('/actors?compressed=1', headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['ETag'], etag)
+
+    def test_uncached_response_compression_is_not_stored(self):
+        """Test that the compressed form of a response too large for the cache isn't kept"""
+        compression.min_size = 0
+        response_cache.max_entry_bytes = 0
+        headers = {'Authorization': 'Bearer ' + self.CASTING_ASSISTANT, 'Accept-Encoding': 'gzip'}
+        cache_hits = compression.stats()['cache_hits']
+        for _ in range(2):
+            res = self.client().get('/actors?uncached=1', headers=headers)
+            self.assertEqual(res.headers['X-Cache'], 'MISS')
+            self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(compression.stats()['cache_hits'], cache_hits)
+
+    def test_small_response_is_not_compressed(self):
+        """Test that a response below COMPRESS_MIN_SIZE isn't compressed"""
+        res = self.client().get('/', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertEqual(json.loads(res.data)['message'], 'Welcome to Capstone app')
+
     def test_get_actors_by_id(self):
         """Test searching for an actor by id"""
         res = self.client().get('/actors/1',
@@ -110,6 +340,59 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(data['actor']['age'], 13)
         self.assertEqual(data['actor']['gender'], 'male')
 
+    def test_get_actor_include_movies(self):
+        """Test getting an actor with the movies embedded"""
+        res = self.client().get('/actors/5?include=movies',
+                                headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([movie['id'] for movie in data['actor']['movies']], [2])
+
+    def test_400_get_actor_if_include_is_invalid(self):
+        """Test getting an actor with an unknown include, should return 400 error"""
+        res = self.client().get('/actors/5?include=actors',
+                                headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_get_actors_fields(self):
+        """Test that only the requested columns are selected and returned"""
+        statements = []
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        with self.app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                res = self.client().get('/actors?fields=name&limit=2',
+                                        headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT})
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(set(data['actors'][0]), {'id', 'name'})
+        actor_queries = [statement for statement in statements if 'FROM "Actor"' in statement]
+        self.assertTrue(actor_queries)
+        self.assertNotIn('gender', actor_queries[-1])
+
+    def test_fast_read_path_is_byte_identical(self):
+        """Test that the fast read path returns the same bytes as the ORM path"""
+        headers = {'Authorization': 'Bearer ' + self.CASTING_ASSISTANT}
+        for url in ['/actors?limit=3', '/movies?fields=release_date', '/actors/1/movies', '/movies/2/actors']:
+            separator = '&' if '?' in url else '?'
+            self.app.config['FAST_READ_PATH'] = True
+            fast = self.client().get(url + separator + 'path=fast', headers=headers)
+            self.app.config['FAST_READ_PATH'] = False
+            orm = self.client().get(url + separator + 'path=orm', headers=headers)
+            self.assertEqual(fast.status_code, 200, url)
+            self.assertEqual(fast.data, orm.data, url)
+
+    def test_400_get_actor_if_fields_are_invalid(self):
+        """Test getting an actor with an unknown field, should return 400 error"""
+        res = self.client().get('/actors/1?fields=title',
+                                headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT})
+        self.assertEqual(res.status_code, 400)
+
     def test_400_get_actor_if_id_does_not_exist(self):
         """Test searching for an actor by id who's id s not in the DB,
          should return 400 error"""
@@ -137,6 +420,34 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(data['updated'], 1)
         self.assertEqual(actor.age, age)
 
+    def test_update_actor_without_loading_it(self):
+        """Test that updating an actor doesn't select it"""
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        with self.app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                res = self.client().patch('/actors/2',
+                                          headers={'Authorization': 'Bearer ' + self.CASTING_DIRECTOR},
+                                          json={'gender': 'male'})
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertEqual(res.status_code, 200)
+        actor_statements = [statement for statement in statements if '"Actor"' in statement]
+        self.assertEqual(len(actor_statements), 1)
+        self.assertTrue(actor_statements[0].startswith('UPDATE'))
+
+    def test_422_if_patch_is_not_allowed(self):
+        """Test updating the id or an invalid age of an actor, should return 422 error"""
+        for patch in [{'id': 1000}, {'age': 'old'}, {'name': ''}, {}]:
+            res = self.client().patch('/actors/1',
+                                      headers={'Authorization': 'Bearer ' + self.CASTING_DIRECTOR},
+                                      json=patch)
+            self.assertEqual(res.status_code, 422, patch)
+        self.assertIsNone(Actor.query.get(1000))
+
     def test_400_if_updated_actor_does_not_exist(self):
         """Test updating of an actor that doesn't exist,
         should return 404 error"""
@@ -175,6 +486,71 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(data['deleted'], max_id)
         self.assertEqual(actor, None)
 
+    def test_delete_linked_actor(self):
+        """Test that deleting an actor deletes its links to movies"""
+        res = self.client().post('/actors',
+                                 headers={'Authorization': 'Bearer ' + self.CASTING_DIRECTOR},
+                                 json=self.new_actor)
+        actor_id = json.loads(res.data)['added']
+        self.client().post(f'/actors/{actor_id}/movies/1',
+                           headers={'Authorization': 'Bearer ' + self.CASTING_DIRECTOR})
+        res = self.client().delete(f'/actors/{actor_id}',
+                                   headers={'Authorization': 'Bearer ' + self.CASTING_DIRECTOR})
+        self.assertEqual(res.status_code, 200)
+        res = self.client().get('/movies/1/actors',
+                                headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT})
+        self.assertNotIn(actor_id, [actor['id'] for actor in json.loads(res.data)['actors']])
+
+    def test_link_counts(self):
+        """Test that the numbers of movies and actors follow the links"""
+        def counts():
+            with self.app.app_context():
+                return Actor.query.get(actor_id).movie_count, Movie.query.get(1).actor_count
+
+        res = self.client().post('/actors',
+                                 headers={'Authorization': 'Bearer ' + self.CASTING_DIRECTOR},
+                                 json=self.new_actor)
+        actor_id = json.loads(res.data)['added']
+        _, actor_count = counts()
+        self.client().put('/movies/1/actors',
+                          headers={'Authorization': 'Bearer ' + self.CASTING_DIRECTOR},
+                          json={'actors': [actor_id]})
+        # already linked, nothing changes
+        with self.app.app_context():
+            versions = get_versions(['actor_movie', 'Actor', 'Movie'])
+        self.client().post(f'/actors/{actor_id}/movies/1',
+                           headers={'Authorization': 'Bearer ' + self.CASTING_DIRECTOR})
+        self.assertEqual(counts(), (1, actor_count + 1))
+        with self.app.app_context():
+            self.assertEqual(get_versions(['actor_movie', 'Actor', 'Movie']), versions)
+        res = self.client().get('/movies/1/actors',
+                                headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT})
+        self.assertEqual(json.loads(res.data)['totalActors'], actor_count + 1)
+
+        self.client().delete('/movies/1/actors',
+                             headers={'Authorization': 'Bearer ' + self.CASTING_DIRECTOR},
+                             json={'actors': [actor_id]})
+        self.assertEqual(counts(), (0, actor_count))
+
+        self.client().post(f'/actors/{actor_id}/movies/1',
+                           headers={'Authorization': 'Bearer ' + self.CASTING_DIRECTOR})
+        self.client().delete(f'/actors/{actor_id}',
+                             headers={'Authorization': 'Bearer ' + self.CASTING_DIRECTOR})
+        with self.app.app_context():
+            self.assertEqual(Movie.query.get(1).actor_count, actor_count)
+
+    def test_repair_link_counts(self):
+        """Test that wrong numbers of movies are recomputed"""
+        with self.app.app_context():
+            actor = Actor.query.get(2)
+            movie_count = actor.movie_count
+            actor.movie_count = movie_count + 5
+            db.session.commit()
+            repaired = repair_link_counts()
+            self.assertIn(2, repaired['Actor'])
+            self.assertEqual(Actor.query.get(2).movie_count, movie_count)
+            self.assertEqual(repair_link_counts(), {'Actor': [], 'Movie': []})
+
     def test_404_if_deleted_actor_does_not_exist(self):
         """Test deleting of an actor that doesn't exist, should return 404 error"""
         res = self.client().delete('/actors/100',
@@ -217,6 +593,108 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'resource not found')
 
+    def test_get_actor_costars(self):
+        """Gets the co-stars of an actor with the numbers of shared movies, page by page"""
+        ids = []
+        for _ in range(3):
+            res = self.client().post('/actors',
+                                     headers={'Authorization': 'Bearer ' + self.CASTING_DIRECTOR},
+                                     json=self.new_actor)
+            ids.append(json.loads(res.data)['added'])
+        self.client().put('/movies/1/actors',
+                          headers={'Authorization': 'Bearer ' + self.CASTING_DIRECTOR},
+                          json={'actors': ids[:2]})
+        self.client().put('/movies/2/actors',
+                          headers={'Authorization': 'Bearer ' + self.CASTING_DIRECTOR},
+                          json={'actors': ids})
+
+        res = self.client().get(f'/actors/{ids[0]}/costars?limit=1',
+                                headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actor_id'], ids[0])
+        self.assertEqual([(actor['id'], actor['shared_movies']) for actor in data['costars']], [(ids[1], 2)])
+        costars = {}
+        while data['next_cursor'] is not None:
+            res = self.client().get(f'/actors/{ids[0]}/costars?limit=1&cursor=' + data['next_cursor'],
+                                    headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT})
+            data = json.loads(res.data)
+            costars.update((actor['id'], actor['shared_movies']) for actor in data['costars'])
+        self.assertEqual(costars[ids[2]], 1)
+        self.assertNotIn(ids[0], costars)
+        self.assertNotIn(ids[1], costars)
+
+        for actor_id in ids:
+            self.client().delete(f'/actors/{actor_id}',
+                                 headers={'Authorization': 'Bearer ' + self.CASTING_DIRECTOR})
+
+    def test_404_if_costars_actor_does_not_exist(self):
+        """Test getting the co-stars of an actor that doesn't exist, should return 404 error"""
+        res = self.client().get('/actors/100000/costars',
+                                headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    def test_get_actors_path(self):
+        """Gets the shortest chain of co-stars between two actors as the links change"""
+        def path(source, target):
+            res = self.client().get(f'/actors/{source}/path/{target}',
+                                    headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT})
+            self.assertEqual(res.status_code, 200)
+            return json.loads(res.data)
+
+        def link(method, actor_id, movie_id):
+            getattr(self.client(), method)(f'/actors/{actor_id}/movies/{movie_id}',
+                                           headers={'Authorization': 'Bearer ' + self.CASTING_DIRECTOR})
+
+        ids = []
+        for _ in range(3):
+            res = self.client().post('/actors',
+                                     headers={'Authorization': 'Bearer ' + self.CASTING_DIRECTOR},
+                                     json=self.new_actor)
+            actor_id = json.loads(res.data)['added']
+            ids.append(actor_id)
+            self.addCleanup(self.client().delete, f'/actors/{actor_id}',
+                            headers={'Authorization': 'Bearer ' + self.CASTING_DIRECTOR})
+        x, y, z = ids
+        link('post', x, 1)
+        link('post', y, 1)
+        data = path(x, y)
+        self.assertEqual(data['degrees'], 1)
+        self.assertEqual(data['path'], [{'actor': {**self.new_actor, 'age': 74, 'id': x, 'movie_count': 1}},
+                                        {'movie': data['path'][1]['movie']},
+                                        {'actor': {**self.new_actor, 'age': 74, 'id': y, 'movie_count': 1}}])
+        self.assertEqual(data['path'][1]['movie']['id'], 1)
+        self.assertEqual(path(x, z)['degrees'], None)
+
+        # the graph follows the links without being rebuilt
+        builds = cast_graph.builds
+        link('post', y, 2)
+        link('post', z, 2)
+        data = path(x, z)
+        self.assertEqual(data['degrees'], 2)
+        self.assertEqual((data['path'][0]['actor']['id'], data['path'][-1]['actor']['id']), (x, z))
+        link('delete', y, 2)
+        data = path(x, z)
+        self.assertNotIn(y, [step['actor']['id'] for step in data['path'][::2]])
+        self.assertEqual(cast_graph.builds, builds)
+
+        # the changes of another worker are read from link_log
+        cast_graph.apply = lambda changes, version: None
+        link('post', x, 2)
+        del cast_graph.apply
+        self.assertEqual(path(x, z)['degrees'], 1)
+        self.assertEqual(cast_graph.builds, builds)
+
+    def test_404_if_path_actor_does_not_exist(self):
+        """Test getting the path to an actor that doesn't exist, should return 404 error"""
+        res = self.client().get('/actors/1/path/100000',
+                                headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
     def test_add_movie_to_actor(self):
         """Test adding movie to actor"""
         res = self.client().post('/actors/1/movies/2',
@@ -227,6 +705,25 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(data['actor_id'], 1)
         self.assertEqual(data['movie_id'], 2)
 
+    def test_adding_movie_invalidates_cached_actor_movies(self):
+        """Test that adding a movie to an actor evicts the cached movies of the actor"""
+        self.client().get('/actors/5/movies',
+                          headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT})
+        self.client().get('/actors/2/movies',
+                          headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT})
+        self.client().post('/actors/5/movies/3',
+                           headers={'Authorization': 'Bearer ' + self.CASTING_DIRECTOR})
+        res = self.client().get('/actors/5/movies',
+                                headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT})
+        data = json.loads(res.data)
+        other = self.client().get('/actors/2/movies',
+                                  headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT})
+        self.client().delete('/actors/5/movies/3',
+                             headers={'Authorization': 'Bearer ' + self.CASTING_DIRECTOR})
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        self.assertEqual(data['totalMovies'], 2)
+        self.assertEqual(other.headers['X-Cache'], 'HIT')
+
     def test_404_if_actor_of_movie_does_not_exist(self):
         """Test adding movie to actor who does not exist"""
         res = self.client().post('/actors/100/movies/1',
@@ -300,6 +797,47 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertEqual(len(data['movies']), 3)
 
+    def test_get_movies_pages(self):
+        """Gets the /movies endpoint page by page using next_cursor"""
+        res = self.client().get('/movies?limit=1',
+                                headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['movies']), 1)
+
+        res = self.client().get('/movies?limit=1&cursor=' + data['next_cursor'],
+                                headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT})
+        next_data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertGreater(next_data['movies'][0]['id'], data['movies'][0]['id'])
+
+    def test_get_movies_stream(self):
+        """Gets all movies from the /movies endpoint as a streamed JSON document"""
+        res = self.client().get('/movies?stream=1',
+                                headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(data['movies']), Movie.query.count())
+        self.assertEqual(list(data), sorted(data))
+
+    def test_get_movies_stream_sorted(self):
+        """Streams the movies in the order of ?sort="""
+        res = self.client().get('/movies?stream=1&sort=-actor_count',
+                                headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT})
+        keys = [(movie['actor_count'], movie['id']) for movie in json.loads(res.data)['movies']]
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(keys, sorted(keys, reverse=True))
+
+    def test_get_movies_include_actors(self):
+        """Gets the /movies endpoint with the actors embedded"""
+        res = self.client().get('/movies?include=actors',
+                                headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        movie = next(movie for movie in data['movies'] if movie['id'] == 1)
+        self.assertEqual([actor['id'] for actor in movie['actors']], [1])
+
     def test_get_movies_by_id(self):
         """Test searching for a movie by id"""
         res = self.client().get('/movies/1',
@@ -412,6 +950,77 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(data['movie_id'], 3)
         self.assertEqual(data['actor_id'], 6)
 
+    def test_versions_are_bumped_in_order(self):
+        """Test that the version rows are locked in the same order by every transaction"""
+        names = []
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('UPDATE table_version'):
+                names.append(context.compiled_parameters[0]['name_1'])
+        with self.app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                bump_versions('actor_movie', 'Movie', 'Actor', 'Movie')
+                db.session.rollback()
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertEqual(names, ['Actor', 'Movie', 'actor_movie'])
+
+    def test_link_and_unlink_actors_of_movie(self):
+        """Test adding and removing many actors of a movie at once"""
+        res = self.client().put('/movies/2/actors',
+                                headers={'Authorization': 'Bearer ' + self.CASTING_DIRECTOR},
+                                json={'actors': [2, 5]})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        # actor 5 was already in the movie
+        self.assertEqual(data['linked'], 1)
+
+        res = self.client().delete('/movies/2/actors',
+                                   headers={'Authorization': 'Bearer ' + self.CASTING_DIRECTOR},
+                                   json={'actors': [2]})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['unlinked'], 1)
+
+    def test_404_if_linked_actor_does_not_exist(self):
+        """Test adding many actors to a movie when one of them doesn't exist"""
+        res = self.client().put('/movies/2/actors',
+                                headers={'Authorization': 'Bearer ' + self.CASTING_DIRECTOR},
+                                json={'actors': [1, 100]})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    def test_400_if_linked_actors_are_not_ids(self):
+        """Test adding actors to a movie with a malformed body, should return 400 error"""
+        res = self.client().put('/movies/2/actors',
+                                headers={'Authorization': 'Bearer ' + self.CASTING_DIRECTOR},
+                                json={'actors': ['Tom']})
+        self.assertEqual(res.status_code, 400)
+
+    def test_404_if_removed_movie_of_actor_is_not_linked(self):
+        """Test removing a movie from an actor who doesn't play in it"""
+        res = self.client().delete('/actors/2/movies/3',
+                                   headers={'Authorization': 'Bearer ' + self.CASTING_DIRECTOR})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['message'], 'resource not found')
+
+    def test_etag_changes_when_actor_is_added_to_movie(self):
+        """Test that adding an actor to a movie changes the ETag of the movie's actors"""
+        res = self.client().get('/movies/2/actors',
+                                headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT})
+        etag = res.headers['ETag']
+        self.client().post('/movies/2/actors/6',
+                           headers={'Authorization': 'Bearer ' + self.CASTING_DIRECTOR})
+        res = self.client().get('/movies/2/actors',
+                                headers={'Authorization': 'Bearer ' + self.CASTING_ASSISTANT,
+                                         'If-None-Match': etag})
+        self.client().delete('/movies/2/actors/6',
+                             headers={'Authorization': 'Bearer ' + self.CASTING_DIRECTOR})
+        self.assertEqual(res.status_code, 200)
+
     def test_404_if_movie_of_actor_does_not_exist(self):
         """Test adding actor to movie which does not exist"""
         res = self.client().post('/movies/100/actors/1',
@@ -434,6 +1043,526 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(data['description'], 'Permission not found')
 
 
+class JWKSCacheTestCase(unittest.TestCase):
+    """This class represents the JWKS cache test case"""
+
+    def setUp(self):
+        self.fetches = 0
+        self.jwks = {'keys': [{'kid': 'kid1', 'kty': 'oct', 'alg': 'HS256', 'k': 'c2VjcmV0'}]}
+
+    def fetch(self):
+        self.fetches += 1
+        return self.jwks
+
+    def test_jwks_is_fetched_once(self):
+        """Test that a fresh key set is served from the cache"""
+        cache = JWKSCache(fetch=self.fetch, ttl=3600)
+        cache.get_jwks('kid1')
+        cache.get_jwks('kid1')
+        self.assertEqual(self.fetches, 1)
+        self.assertIsNotNone(cache.get_key('kid1'))
+
+    def test_unknown_kid_refresh_is_rate_limited(self):
+        """Test that unknown kids force at most one refresh per interval"""
+        cache = JWKSCache(fetch=self.fetch, ttl=3600, min_refresh_interval=3600)
+        cache.set_jwks(self.jwks)
+        cache.get_jwks('unknown')
+        cache.get_jwks('unknown')
+        self.assertEqual(self.fetches, 1)
+
+    def test_jwks_unavailable(self):
+        """Test that a failing fetch without cached keys raises 503"""
+        def fetch():
+            raise OSError('network is unreachable')
+        cache = JWKSCache(fetch=fetch)
+        with self.assertRaises(AuthError) as cm:
+            cache.get_jwks('kid1')
+        self.assertEqual(cm.exception.status_code, 503)
+
+
+    def test_first_fetch_is_retried(self):
+        """Test that a failed fetch without any key is retried after a short backoff"""
+        fetches = []
+        def fetch():
+            fetches.append(1)
+            if len(fetches) == 1:
+                raise OSError('network is unreachable')
+            return self.jwks
+        cache = JWKSCache(fetch=fetch, min_refresh_interval=3600, min_retry_interval=0.2)
+        with self.assertRaises(AuthError):
+            cache.get_jwks('kid1')
+        # during the backoff the requests fail without fetching
+        with self.assertRaises(AuthError) as context:
+            cache.get_jwks('kid1')
+        self.assertEqual(context.exception.status_code, 503)
+        self.assertEqual(len(fetches), 1)
+        time.sleep(0.2)
+        self.assertIsNotNone(cache.get_key('kid1'))
+
+    def test_seeded_keys_are_stale(self):
+        """Test that keys seeded from a file are refetched in the background"""
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as f:
+            json.dump(self.jwks, f)
+            f.flush()
+            cache = JWKSCache(fetch=self.fetch, ttl=10 ** 9, seed_file=f.name)
+        cache.get_jwks('kid1')
+        for _ in range(100):
+            if self.fetches:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.fetches, 1)
+
+class ClaimsCacheTestCase(unittest.TestCase):
+    """This class represents the verified claims cache test case"""
+
+    def setUp(self):
+        self.kid = 'kid1'
+        self.jwks = JWKSCache(fetch=None)
+        self.jwks.set_jwks({'keys': [{'kid': 'kid1', 'kty': 'oct', 'alg': 'HS256', 'k': 'c2VjcmV0'}]})
+
+    def test_cached_payload_is_returned(self):
+        """Test that a verified payload is served until its exp"""
+        cache = ClaimsCache(maxsize=2, jwks=self.jwks)
+        payload = {'exp': time.time() + 60, 'permissions': frozenset(['get:actors'])}
+        cache.put('token', payload, self.kid)
+        self.assertIs(cache.get('token'), payload)
+
+    def test_expired_payload_is_evicted(self):
+        """Test that a payload isn't served after its exp"""
+        cache = ClaimsCache(maxsize=2, jwks=self.jwks)
+        cache.put('token', {'exp': time.time() - 1}, self.kid)
+        self.assertIsNone(cache.get('token'))
+
+    def test_least_recently_used_is_evicted(self):
+        """Test that the cache is bounded"""
+        cache = ClaimsCache(maxsize=2, jwks=self.jwks)
+        for token in ['a', 'b', 'c']:
+            cache.put(token, {'exp': time.time() + 60}, self.kid)
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('c'))
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    """This class represents the response cache test case"""
+
+    def test_invalidate_by_tag(self):
+        """Test that only the entries with an invalidated tag are removed"""
+        cache = ResponseCache()
+        cache.put('/actors/3/movies', (b'{}', 'application/json'), {'actor:3:movies'}, cache.generation())
+        cache.put('/actors/4/movies', (b'{}', 'application/json'), {'actor:4:movies'}, cache.generation())
+        cache.invalidate('actor:3:movies')
+        self.assertIsNone(cache.get('/actors/3/movies'))
+        self.assertIsNotNone(cache.get('/actors/4/movies'))
+        self.assertEqual(cache.stats()['invalidations'], 1)
+
+    def test_evict_least_recently_used_by_size(self):
+        """Test that the total size of the values is bounded"""
+        backend = MemoryBackend(max_bytes=10)
+        for key in ['a', 'b', 'c']:
+            backend.set(key, b'12345')
+        self.assertIsNone(backend.get('a'))
+        self.assertIsNotNone(backend.get('c'))
+        self.assertEqual(backend.stats()['evictions'], 1)
+
+    def test_stale_response_is_not_stored(self):
+        """Test that a response computed during an invalidation isn't stored"""
+        cache = ResponseCache()
+        generation = cache.generation()
+        cache.invalidate('actors')
+        cache.put('/actors', (b'{}', 'application/json'), {'actors'}, generation)
+        self.assertIsNone(cache.get('/actors'))
+
+
+class SharedCacheTestCase(unittest.TestCase):
+    """This class represents the shared cache backends test case,
+    two caches on the same backend stand for two workers"""
+
+    def setUp(self):
+        self.server = RESPServer().start()
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'cache')
+
+    def tearDown(self):
+        self.server.stop()
+        self.directory.cleanup()
+
+    def backends(self):
+        yield MmapBackend(self.path, size=1024 * 1024, slot_size=4096, counters=1024), \
+            MmapBackend(self.path, size=1024 * 1024, slot_size=4096, counters=1024)
+        yield RedisBackend(self.server.url), RedisBackend(self.server.url)
+
+    def test_entry_is_shared(self):
+        """Test that an entry stored by one worker is served to the other"""
+        for first, second in self.backends():
+            with self.subTest(backend=type(first).__name__):
+                worker1, worker2 = ResponseCache(first), ResponseCache(second)
+                worker1.put('/actors', (b'[1]', 'application/json'), {'actors'}, worker1.generation())
+                self.assertEqual(worker2.get('/actors'), (b'[1]', 'application/json'))
+
+    def test_invalidation_is_shared(self):
+        """Test that an invalidation made by one worker applies to the other"""
+        for first, second in self.backends():
+            with self.subTest(backend=type(first).__name__):
+                worker1, worker2 = ResponseCache(first), ResponseCache(second)
+                worker1.put('/movies', (b'[1]', 'application/json'), {'movies'}, worker1.generation())
+                worker2.invalidate('movies')
+                self.assertIsNone(worker1.get('/movies'))
+
+    def test_expired_value(self):
+        """Test that a value isn't served after its ttl"""
+        for backend, _ in self.backends():
+            with self.subTest(backend=type(backend).__name__):
+                backend.set('key', b'value', ttl=0.01)
+                time.sleep(0.02)
+                self.assertIsNone(backend.get('key'))
+
+    def test_redis_unavailable(self):
+        """Test that the cache is bypassed when redis can't be reached"""
+        url = self.server.url
+        self.server.stop()
+        cache = ResponseCache(RedisBackend(url, timeout=0.1))
+        cache.put('/actors', (b'[1]', 'application/json'), {'actors'}, cache.generation())
+        self.assertIsNone(cache.get('/actors'))
+        self.assertGreater(cache.stats()['errors'], 0)
+        self.server = RESPServer().start()
+
+    def test_redis_retry_interval(self):
+        """Test that a server that can't be reached isn't tried again before the retry interval"""
+        url = self.server.url
+        self.server.stop()
+        backend = RedisBackend(url, timeout=0.1, retry_interval=0.2)
+        connects = []
+        connect = backend._connect
+        backend._connect = lambda: (connects.append(1), connect())
+        self.assertIsNone(backend.get('a'))
+        self.assertIsNone(backend.get('a'))
+        self.assertEqual(len(connects), 1)
+        time.sleep(0.2)
+        self.server = RESPServer().start()
+        backend.port = self.server.server_address[1]
+        backend.set('a', b'1')
+        self.assertEqual(backend.get('a'), b'1')
+        self.assertEqual(len(connects), 2)
+
+    def test_lost_invalidation_is_replayed(self):
+        """Test that an invalidation made while redis can't be reached is applied once it can"""
+        worker1 = ResponseCache(RedisBackend(self.server.url))
+        backend = RedisBackend(self.server.url, timeout=0.1, retry_interval=0)
+        worker2 = ResponseCache(backend)
+        worker1.put('/actors', (b'[1]', 'application/json'), {'actors'}, worker1.generation())
+        port, backend.port = backend.port, 1
+        worker2.invalidate('actors')
+        backend.port = port
+        self.assertEqual(backend.missed_incrs, ['generation', 'tag:actors'])
+        # the worker that lost the invalidation records it before serving anything
+        self.assertIsNone(worker2.get('/actors'))
+        self.assertEqual(backend.missed_incrs, [])
+        self.assertIsNone(worker1.get('/actors'))
+
+    def test_jwks_is_shared(self):
+        """Test that a key set fetched by one worker is used by the other"""
+        fetches = []
+        def fetch():
+            fetches.append(1)
+            return {'keys': [{'kid': 'kid1', 'kty': 'oct', 'alg': 'HS256', 'k': 'c2VjcmV0'}]}
+        for first, second in self.backends():
+            with self.subTest(backend=type(first).__name__):
+                fetches.clear()
+                JWKSCache(fetch=fetch, shared=first).get_jwks('kid1')
+                worker2 = JWKSCache(fetch=fetch, shared=second)
+                self.assertIsNotNone(worker2.get_key('kid1'))
+                self.assertEqual(len(fetches), 1)
+
+    def test_mmap_layout_change(self):
+        """Test that a file mapped with another layout isn't initialized again"""
+        first = MmapBackend(self.path, size=1024 * 1024, slot_size=4096, counters=1024)
+        first.incr('tag:actors')
+        with self.assertRaises(RuntimeError):
+            MmapBackend(self.path, size=1024 * 1024, slot_size=8192, counters=1024)
+        self.assertEqual(first.get_counters(['tag:actors']), [1])
+
+        # another worker
+        path = os.path.join(self.directory.name, 'other')
+        worker = subprocess.Popen(
+            [sys.executable, '-c', 'import sys; from capstone.cache_backends import MmapBackend; '
+             f'backend = MmapBackend({path!r}, size=1024 * 1024, slot_size=4096, counters=1024); '
+             'print("mapped", flush=True); sys.stdin.read()'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.addCleanup(worker.wait)
+        self.addCleanup(worker.stdin.close)
+        while worker.stdout.readline() not in (b'mapped\n', b''):
+            pass
+        with self.assertRaises(RuntimeError):
+            MmapBackend(path, size=1024 * 1024, slot_size=8192, counters=1024)
+        worker.stdin.close()
+        worker.wait()
+        # initialized again once it is unused
+        backend = MmapBackend(path, size=1024 * 1024, slot_size=8192, counters=1024)
+        self.assertEqual(backend.incr('tag:actors'), 1)
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    """This class represents the request coalescing test case"""
+
+    def test_concurrent_calls_are_coalesced(self):
+        """Test that concurrent calls with the same key run the function once"""
+        flights = SingleFlight()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def query():
+            calls.append(1)
+            release.wait(5)
+            return 'rows'
+
+        def request():
+            results.append(flights.do('/movies', query))
+
+        threads = [threading.Thread(target=request) for _ in range(5)]
+        threads[0].start()
+        while not flights.stats()['in_flight']:
+            time.sleep(0.001)
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results), [('rows', False)] + [('rows', True)] * 4)
+
+    def test_failed_leader(self):
+        """Test that the error of the leader isn't shared"""
+        flights = SingleFlight()
+        with self.assertRaises(ValueError):
+            flights.do('/movies', lambda: int('x'))
+        self.assertEqual(flights.do('/movies', lambda: 'rows'), ('rows', False))
+        self.assertEqual(flights.stats()['in_flight'], 0)
+
+
+class JSONBackendTestCase(unittest.TestCase):
+    """This class represents the JSON backends test case"""
+
+    def setUp(self):
+        from datetime import date, datetime
+        self.document = {
+            "success": True,
+            "movies": [{"id": 1, "title": "Amélie", "release_date": date(2001, 4, 25)},
+                       {"id": 2, "title": "Terminator", "release_date": None}],
+            "next_cursor": None,
+            "updated_at": datetime(2021, 6, 1, 12, 30)
+        }
+
+    def test_stdlib_backend_matches_jsonify(self):
+        """Test that the stdlib backend emits the bytes of flask.jsonify"""
+        from flask import Flask, jsonify
+        app = Flask(__name__)
+        backend = StdlibBackend()
+        with app.app_context():
+            self.assertEqual(backend.dumps(self.document), jsonify(self.document).get_data())
+            app.debug = True
+            self.assertEqual(backend.dumps(self.document, pretty=True), jsonify(self.document).get_data())
+
+    @unittest.skipIf(orjson is None, 'orjson is not installed')
+    def test_orjson_backend_matches_stdlib(self):
+        """Test that orjson emits the same document as the stdlib backend without ASCII escapes"""
+        compact = StdlibBackend(ensure_ascii=False).dumps(self.document)
+        self.assertEqual(OrjsonBackend().dumps(self.document), compact)
+        self.assertEqual(json.loads(OrjsonBackend().dumps(self.document, pretty=True)), json.loads(compact))
+
+    def test_auto_backend_keeps_ascii_escapes(self):
+        """Test that auto only picks orjson when non-ASCII characters aren't escaped"""
+        self.assertIsInstance(create_json_backend({'JSON_BACKEND': 'auto'}), StdlibBackend)
+        backend = create_json_backend({'JSON_BACKEND': 'auto', 'JSON_AS_ASCII': False})
+        self.assertIsInstance(backend, OrjsonBackend if orjson is not None else StdlibBackend)
+
+
+class CompressionTestCase(unittest.TestCase):
+    """This class represents the content negotiation of the compression test case"""
+
+    def test_negotiate(self):
+        """Test that the preferred accepted encoding is chosen"""
+        compression = Compression(encodings=['zstd', 'br', 'gzip'])
+        self.assertEqual(compression.negotiate('gzip, deflate, br'), 'br')
+        self.assertEqual(compression.negotiate('gzip;q=1.0, br;q=0.5'), 'gzip')
+        self.assertEqual(compression.negotiate('*'), 'zstd')
+        self.assertIsNone(compression.negotiate('deflate'))
+        self.assertIsNone(compression.negotiate(None))
+        self.assertIsNone(Compression(encodings=['gzip']).negotiate('br'))
+
+
+class CastGraphTestCase(unittest.TestCase):
+    """Tests of the graph of the cast (capstone/graph.py)"""
+
+    def setUp(self):
+        self.graph = CastGraph()
+        links = [(1, 10), (2, 10), (2, 11), (3, 11), (4, 12)]
+        self.graph.build(array('i', [actor_id for actor_id, _ in links]),
+                         array('i', [movie_id for _, movie_id in links]), version=1)
+
+    def test_shortest_path(self):
+        self.assertEqual(self.graph.shortest_path(1, 3), [1, 10, 2, 11, 3])
+        self.assertEqual(self.graph.shortest_path(3, 1), [3, 11, 2, 10, 1])
+        self.assertEqual(self.graph.shortest_path(1, 1), [1])
+        self.assertIsNone(self.graph.shortest_path(1, 4))
+        self.assertIsNone(self.graph.shortest_path(1, 100))
+
+    def test_changes_are_applied(self):
+        self.graph.apply([([(3, 12)], 1)], 2)
+        self.assertEqual(self.graph.shortest_path(1, 4), [1, 10, 2, 11, 3, 12, 4])
+        self.graph.apply([([(1, 11)], 1), ([(2, 10)], -1)], 3)
+        self.assertEqual(self.graph.shortest_path(1, 4), [1, 11, 3, 12, 4])
+        # already in the graph
+        self.graph.apply([([(2, 10)], 1)], 3)
+        self.assertEqual(self.graph.version, 3)
+        self.assertEqual(list(self.graph.movies.neighbors(10)), [1])
+
+    def test_missing_change_is_not_applied(self):
+        self.graph.apply([([(3, 12)], 1)], 3)
+        self.assertEqual(self.graph.version, 1)
+        self.assertIsNone(self.graph.shortest_path(1, 4))
+
+    def test_search_does_not_see_later_compaction(self):
+        actors = self.graph.actors
+        self.graph.compact_ratio = 0
+        self.graph.apply([([(n, 13) for n in range(1001)], 1)], 2)
+        self.assertIsNot(self.graph.actors, actors)
+        self.assertEqual(list(actors.neighbors(1)), [10, 13])
+
+    def test_compact(self):
+        adjacency = self.graph.actors
+        adjacency.add(2, 12)
+        adjacency.remove(2, 10)
+        adjacency.add(7, 10)
+        adjacency = adjacency.compacted()
+        self.assertEqual(adjacency.changes, 0)
+        self.assertEqual(list(adjacency.neighbors(2)), [11, 12])
+        self.assertEqual(list(adjacency.neighbors(7)), [10])
+        self.assertEqual(adjacency.edges(), 6)
+
+
+class PoolTestCase(unittest.TestCase):
+    """This class represents the connection pool configuration test case"""
+
+    def config(self, **settings):
+        config = {'SQLALCHEMY_DATABASE_URI': 'postgresql://localhost/capstone',
+                  'DB_POOL': 'queue', 'DB_POOL_SIZE': 3, 'DB_STATEMENT_TIMEOUT': 5000}
+        config.update(settings)
+        return config
+
+    def test_queue_pool_options(self):
+        """Test that the pool options are read from the config"""
+        options = engine_options(self.config())
+        self.assertIs(options['poolclass'], TimedQueuePool)
+        self.assertEqual(options['pool_size'], 3)
+        self.assertEqual(options['connect_args']['options'], '-c statement_timeout=5000')
+
+    def test_pgbouncer_options(self):
+        """Test that no startup options are sent to PgBouncer"""
+        options = engine_options(self.config(DB_POOL='null', DB_PGBOUNCER=True))
+        self.assertNotIn('pool_size', options)
+        self.assertNotIn('options', options['connect_args'])
+
+    def test_sqlite_has_default_options(self):
+        """Test that the pool options only apply to PostgreSQL"""
+        self.assertEqual(engine_options({'SQLALCHEMY_DATABASE_URI': 'sqlite://'}), {})
+
+    def test_checkout_timeout_is_counted(self):
+        """Test that a checkout waiting longer than the pool timeout is counted"""
+        engine = create_engine('sqlite://', poolclass=TimedQueuePool,
+                               pool_size=1, max_overflow=0, pool_timeout=0.05)
+        timeouts = pool_stats.timeouts
+        with engine.connect():
+            with self.assertRaises(exc.TimeoutError):
+                engine.connect()
+        self.assertEqual(pool_stats.timeouts, timeouts + 1)
+        self.assertGreaterEqual(pool_stats.max_wait_time, 0.05)
+        engine.dispose()
+
+
+class ReplicaPoolTestCase(unittest.TestCase):
+    """This class represents the read replicas routing test case"""
+
+    def setUp(self):
+        self.pool = ReplicaPool(max_lag=5, check_interval=3600)
+        self.pool.replicas = [self.pool.add_replica(name, create_engine('sqlite://'))
+                              for name in ['replica1', 'replica2']]
+
+    def test_round_robin(self):
+        """Test that the replicas are used in turn"""
+        names = [self.pool.choose().name for _ in range(4)]
+        self.assertEqual(names, ['replica1', 'replica2', 'replica1', 'replica2'])
+
+    def test_lagging_replica_is_skipped(self):
+        """Test that a replica lagging beyond the threshold isn't used"""
+        self.pool.check(self.pool.replicas[0])
+        self.pool.replicas[0].lag = 60
+        names = [self.pool.choose().name for _ in range(2)]
+        self.assertEqual(names, ['replica2', 'replica2'])
+
+    def test_fallback_to_primary(self):
+        """Test that the primary is used when no replica is healthy"""
+        for replica in self.pool.replicas:
+            self.pool.check(replica)
+            replica.healthy = False
+        self.assertIsNone(self.pool.choose())
+        self.assertEqual(self.pool.stats()['fallbacks'], 1)
+
+
+@unittest.skipUnless(os.environ.get('DATABASE_URL', '').startswith('postgres'),
+                     "the ASGI app needs PostgreSQL (asyncpg)")
+class ASGITestCase(unittest.TestCase):
+    """This class represents the ASGI app test case,
+    its responses are compared with the responses of the Flask app"""
+
+    def setUp(self):
+        try:
+            from starlette.testclient import TestClient
+        except ImportError:
+            # not a requirement of the app
+            self.skipTest("starlette's test client needs requests")
+        from capstone.asgi import create_asgi_app
+        self.flask_app = create_app()
+        self.client = TestClient(create_asgi_app(self.flask_app))
+        self.client.__enter__()
+        self.headers = {'Authorization': 'Bearer ' + os.environ.get('CASTING_ASSISTANT_JWT'),
+                        'Accept': 'application/json'}
+
+    def tearDown(self):
+        self.client.__exit__(None, None, None)
+
+    def test_same_responses_as_flask(self):
+        """Test that the ASGI endpoints return the same responses as the Flask app"""
+        flask_client = self.flask_app.test_client()
+        for url in ['/actors?limit=2', '/movies?include=actors', '/actors/1',
+                    '/movies/1/actors', '/actors/1000', '/actors?cursor=invalid']:
+            res = self.client.get(url, headers=self.headers)
+            expected = flask_client.get(url, headers=self.headers)
+            self.assertEqual(res.status_code, expected.status_code, url)
+            self.assertEqual(res.content, expected.data, url)
+            self.assertEqual(res.headers.get('ETag'), expected.headers.get('ETag'), url)
+
+    def test_not_modified(self):
+        """Test that a request with the ETag of the data returns 304"""
+        res = self.client.get('/movies/1', headers=self.headers)
+        res = self.client.get('/movies/1', headers=dict(self.headers, **{'If-None-Match': res.headers['ETag']}))
+        self.assertEqual(res.status_code, 304)
+
+    def test_auth_error(self):
+        """Test that auth errors are returned like in the Flask app"""
+        res = self.client.get('/actors')
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(res.json()['code'], 'authorization_header_missing')
+
+    def test_write_is_forwarded_to_flask(self):
+        """Test that the requests without an ASGI endpoint are served by the Flask app"""
+        res = self.client.delete('/actors/1000', headers={
+            'Authorization': 'Bearer ' + os.environ.get('EXECUTIVE_PRODUCER_JWT')})
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(res.json()['message'], 'resource not found')
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()